@@ -1,109 +1,1026 @@
-from openai import OpenAI
 import asyncio
 import cv2
 import base64
+import copy
+import contextlib
 from PIL import Image
 import io
+import math
+import time
+import os
+import threading
+import weakref
+import numpy as np
+import openai
 
-class VideoAnalyzer:
-    def __init__(self, api_key: str, base_url: str = None, model_name: str = "gpt-4o"):
-        if base_url:
-            self.client = OpenAI(api_key=api_key, base_url=base_url)
+import metrics
+from extraction_service import extraction_service
+from frame_extract import (
+    STRATEGIES, ExtractionResult, VideoInfo, downscale, extract_frames, extract_storyboard, probe_video,
+    record_strategy_runs,
+)
+from llm_client import complete, get_async_client, usage_counts
+from frame_select import (
+    FRAME_SELECTION, CANDIDATE_FACTOR, CANDIDATE_MAX_DIMENSION, SCENE_CHANGE_THRESHOLD,
+    frame_fingerprint, gray_histograms, pick_keyframes, scene_scores, select_frames,
+)
+from sessions import compact_history
+
+FOLLOW_UP_HINT = "\n\n" + "-# Reply to this message to ask follow-up questions."
+# Frames sent with a single-request analysis
+MAX_FRAMES = 20
+ANALYSIS_PROMPT = "These are frames from a video. Please describe the contents of this video in detail."
+# Stands in for the analysis request when a follow-up is sent without the frames
+TEXT_ONLY_ANALYSIS_PROMPT = "Please describe the contents of the video whose frames you were shown, in detail."
+
+# --- Follow-up and prompt cache configuration ---
+# "auto" resends all frames with follow-ups while the provider serves them from its prompt
+# cache, and otherwise attaches only a few keyframes picked for the question.
+# "all", "keyframes" and "none" (description only) force one behaviour.
+FOLLOW_UP_FRAMES = os.getenv("FOLLOW_UP_FRAMES", "auto").lower()
+# How the provider is asked to cache the shared prompt prefix: "cache_control" adds
+# Anthropic-style breakpoints, "prompt_cache_key" sends OpenAI's cache routing key,
+# "none" relies on the stable prefix alone, and "auto" picks by model name.
+PROMPT_CACHE_HINTS = os.getenv("PROMPT_CACHE_HINTS", "auto").lower()
+# Follow-ups sent with all frames and no cached tokens before "auto" switches to keyframes.
+PROMPT_CACHE_PROBES = 2
+
+# --- Payload budget configuration ---
+# Total size of the base64 image data sent with one analysis request.
+PAYLOAD_BUDGET_BYTES = int(os.getenv("PAYLOAD_BUDGET_BYTES", str(4 * 1024 * 1024)))
+# Overrides the per-model maximum image side below when set.
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "0"))
+# Optional mosaic layout such as "2x2": several consecutive frames are tiled into one image.
+PAYLOAD_TILE_GRID = os.getenv("PAYLOAD_TILE_GRID", "")
+JPEG_MIN_QUALITY = 35
+JPEG_MAX_QUALITY = 90
+
+# Largest image side each model family actually looks at; anything bigger is resized
+# by the provider anyway and only costs upload time. Matched by substring of the model name.
+MODEL_MAX_IMAGE_DIMENSION = {
+    "gpt-4o": 1366,
+    "gpt-4.1": 1366,
+    "gemini": 1536,
+    "claude": 1568,
+}
+DEFAULT_MAX_IMAGE_DIMENSION = 1280
+
+# --- Segmented analysis configuration ---
+# Videos at least this long are split into segments that are described in parallel and
+# then merged into one timestamped description; 0 turns segmenting off.
+SEGMENTED_MIN_SECONDS = float(os.getenv("SEGMENTED_MIN_SECONDS", "600"))
+# Target segment length; boundaries move to a nearby scene change when there is one.
+SEGMENT_SECONDS = float(os.getenv("SEGMENT_SECONDS", "300"))
+MAX_SEGMENTS = int(os.getenv("MAX_SEGMENTS", "8"))
+SEGMENT_FRAMES = int(os.getenv("SEGMENT_FRAMES", "12"))
+# Segment requests in flight at once for one video (the global MODEL_CONCURRENCY still applies).
+SEGMENT_CONCURRENCY = int(os.getenv("SEGMENT_CONCURRENCY", "4"))
+# Segment frames are decoded and sent smaller, since many more of them are held at once.
+SEGMENT_MAX_DIMENSION = int(os.getenv("SEGMENT_MAX_DIMENSION", "768"))
+SEGMENT_CANDIDATE_FACTOR = 2
+# How far (as a fraction of the segment length) a boundary may move to reach a scene change.
+SEGMENT_SNAP_FRACTION = 0.2
+SEGMENT_MAX_TOKENS = 2000
+
+# Per model: follow-ups sent with all frames, how many were served from the provider's
+# prompt cache, and whether the backend rejected our cache hints.
+_prompt_cache = {}
+
+def _prompt_cache_state(model_name: str) -> dict:
+    return _prompt_cache.setdefault(model_name, {"probes": 0, "hits": 0, "hints_rejected": False})
+
+def prompt_cache_stats():
+    return {model_name: dict(state) for model_name, state in _prompt_cache.items()}
+
+# Analyzers alive in this process; each holds its video's frames until it is dropped
+_live_analyzers = weakref.WeakSet()
+metrics.add_collector(lambda: metrics.LIVE_ANALYZERS.set(len(_live_analyzers)))
+
+def _cache_hint_mode(model_name: str) -> str:
+    if _prompt_cache_state(model_name)["hints_rejected"]:
+        return "none"
+    if PROMPT_CACHE_HINTS != "auto":
+        return PROMPT_CACHE_HINTS
+    lowered = model_name.lower()
+    if "claude" in lowered:
+        return "cache_control"
+    if "gpt" in lowered or lowered.startswith(("o1", "o3", "o4")):
+        return "prompt_cache_key"
+    # Gemini and most other backends cache a repeated prefix implicitly
+    return "none"
+
+def _format_timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def _parse_tile_grid(value: str):
+    try:
+        columns, rows = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        return None
+    if columns < 1 or rows < 1 or columns * rows == 1:
+        return None
+    return columns, rows
+
+def _base64_size(byte_count: int) -> int:
+    return 4 * ((byte_count + 2) // 3)
+
+
+class PayloadBudget:
+    """
+    Fits a list of frames into a byte budget for the multimodal request.
+
+    Frames are area-downscaled to the model's maximum image side, optionally tiled into
+    mosaics, and each is JPEG-encoded at the highest quality that fits its share of the
+    remaining budget. Bytes one frame leaves unused roll over to the frames after it.
+    """
+    def __init__(self, target_bytes: int, max_dimension: int, tile_grid=None):
+        self.target_bytes = target_bytes
+        self.max_dimension = max_dimension
+        self.tile_grid = tile_grid
+        self.report = None
+        self._expected = 0
+        self._encoded = []
+        self._qualities = []
+        self._remaining = 0
+
+    @classmethod
+    def for_model(cls, model_name: str):
+        max_dimension = IMAGE_MAX_DIMENSION
+        if not max_dimension:
+            lowered = model_name.lower()
+            max_dimension = next(
+                (dimension for family, dimension in MODEL_MAX_IMAGE_DIMENSION.items() if family in lowered),
+                DEFAULT_MAX_IMAGE_DIMENSION,
+            )
+        return cls(PAYLOAD_BUDGET_BYTES, max_dimension, _parse_tile_grid(PAYLOAD_TILE_GRID))
+
+    def _tile(self, images):
+        columns, rows = self.tile_grid
+        height, width = images[0].shape[:2]
+        cell_width = self.max_dimension // columns
+        cell_height = max(1, round(cell_width * height / width))
+        mosaics = []
+        per_mosaic = columns * rows
+        for start in range(0, len(images), per_mosaic):
+            group = images[start:start + per_mosaic]
+            used_rows = (len(group) + columns - 1) // columns
+            canvas = np.zeros((cell_height * used_rows, cell_width * columns, 3), dtype=np.uint8)
+            for i, image in enumerate(group):
+                tile = cv2.resize(image, (cell_width, cell_height), interpolation=cv2.INTER_AREA)
+                row, column = divmod(i, columns)
+                canvas[row * cell_height:(row + 1) * cell_height, column * cell_width:(column + 1) * cell_width] = tile
+            mosaics.append(canvas)
+        return mosaics
+
+    def _encode_within(self, image, limit: int):
+        """
+        Binary-searches the highest JPEG quality whose output is at most `limit` bytes.
+        Returns the smallest encoding tried if nothing fits.
+        """
+        low, high = JPEG_MIN_QUALITY, JPEG_MAX_QUALITY
+        best = None
+        smallest = None
+        while low <= high:
+            quality = (low + high) // 2
+            _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            data = buffer.tobytes()
+            if smallest is None or len(data) < len(smallest[0]):
+                smallest = (data, quality)
+            if len(data) <= limit:
+                best = (data, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        return best or smallest
+
+    def encode(self, frames):
+        """
+        Encodes extracted frames into JPEG bytes that together fit the budget.
+        The sizes and qualities chosen are kept on `self.report`.
+        """
+        images = [downscale(frame.image, self.max_dimension) for frame in frames]
+        # JPEGs an ffmpeg strategy already produced at this size can be sent as they are
+        ready = [frame.jpeg if frame.image is image else None for frame, image in zip(frames, images)]
+        if self.tile_grid and len(images) > 1:
+            images = self._tile(images)
+            ready = [None] * len(images)
+
+        self.start(len(images))
+        for image, jpeg in zip(images, ready):
+            self._add_image(image, jpeg)
+        return self.finish(len(frames))
+
+    def start(self, count: int):
+        """
+        Begins encoding `count` frames one at a time with add(), for frames that are still
+        being decoded. Tiling needs every frame at once, so it is not applied.
+        """
+        self._expected = count
+        self._encoded = []
+        self._qualities = []
+        self._remaining = self.target_bytes
+
+    def add(self, frame) -> bytes:
+        image = downscale(frame.image, self.max_dimension)
+        return self._add_image(image, frame.jpeg if frame.image is image else None)
+
+    def _add_image(self, image, ready: bytes = None) -> bytes:
+        # Budget is in base64 bytes; convert this image's share to raw JPEG bytes.
+        share = self._remaining // max(self._expected - len(self._encoded), 1)
+        limit = share * 3 // 4
+        if ready is not None and len(ready) <= limit:
+            data = ready
+        else:
+            data, quality = self._encode_within(image, limit)
+            while len(data) > limit and max(image.shape[:2]) > 256:
+                # Even the lowest quality is too big: shrink the frame and try again.
+                image = downscale(image, int(max(image.shape[:2]) * 0.75))
+                data, quality = self._encode_within(image, limit)
+            self._qualities.append(quality)
+        self._encoded.append(data)
+        self._remaining -= _base64_size(len(data))
+        return data
+
+    def finish(self, frame_count: int):
+        """
+        Ends an encoding started with start(), fills in `self.report` and returns the JPEGs.
+        """
+        encoded, qualities = self._encoded, self._qualities
+        self.report = {
+            "frames": frame_count,
+            "images": len(encoded),
+            "tile_grid": "x".join(map(str, self.tile_grid)) if self.tile_grid and len(encoded) < frame_count else None,
+            "max_dimension": self.max_dimension,
+            "budget_bytes": self.target_bytes,
+            "jpeg_bytes": sum(len(data) for data in encoded),
+            "payload_bytes": sum(_base64_size(len(data)) for data in encoded),
+            "jpeg_quality": {"min": min(qualities), "max": max(qualities)} if qualities else None,
+        }
+        self._encoded = []
+        self._qualities = []
+        return encoded
+
+
+class FramePayload:
+    """
+    The encoded frames of one video plus how they were produced. Holds no decoded
+    images, so it is cheap to send back from an extraction worker process.
+    """
+    def __init__(self, jpegs, timestamps, strategy, video, timings, runs, selection, fingerprint, payload_report,
+                 segments=None):
+        self.jpegs = jpegs
+        self.base64_frames = []
+        self.timestamps = timestamps
+        self.strategy = strategy
+        self.video = video
+        self.timings = timings
+        self.runs = runs
+        self.selection = selection
+        self.fingerprint = fingerprint
+        self.payload_report = payload_report
+        # For a segmented analysis: [{"start", "end", "frames"}, ...] in order; the frames
+        # of each segment follow those of the one before in `jpegs` and `timestamps`.
+        self.segments = segments
+
+def build_frame_payload(video_path: str, payload_budget: PayloadBudget, max_frames: int = MAX_FRAMES,
+                        duration_hint: float = None, http_headers: dict = None, chapters: list = None) -> FramePayload:
+    """
+    Extracts, selects and budget-encodes the frames of a video into JPEG bytes.
+    Videos of SEGMENTED_MIN_SECONDS or longer get a segmented payload instead.
+    Module-level so it can run in an extraction worker process.
+    """
+    info = probe_video(video_path, duration_hint, http_headers)
+    if _is_segmented(info.duration):
+        return build_segmented_payload(video_path, payload_budget, info, chapters)
+    candidates, max_dimension = _candidate_options(payload_budget, max_frames)
+    result = extract_frames(video_path, max_frames=candidates, max_dimension=max_dimension, info=info)
+    return _finish_payload(result, payload_budget, max_frames)
+
+def build_storyboard_payload(board, payload_budget: PayloadBudget, max_frames: int = MAX_FRAMES,
+                             chapters: list = None) -> FramePayload:
+    """
+    Like build_frame_payload(), but the frames are cut from a site's storyboard (a
+    download_video.Storyboard) instead of decoded from the video.
+    """
+    if _is_segmented(board.duration):
+        count, candidates, max_dimension = _segment_options(payload_budget, board.duration)
+        result = extract_storyboard(board, candidates, max_dimension)
+        return _finish_segmented_payload(result, payload_budget, count, max_dimension, chapters)
+    candidates, max_dimension = _candidate_options(payload_budget, max_frames)
+    return _finish_payload(extract_storyboard(board, candidates, max_dimension), payload_budget, max_frames)
+
+def frame_size(payload_budget: PayloadBudget, duration: float = None) -> int:
+    """
+    The longest side, in pixels, frames of a video this long are decoded at. A source
+    larger than this costs more to fetch and decode without improving the frames.
+    """
+    if duration and _is_segmented(duration):
+        return _segment_options(payload_budget, duration)[2]
+    return _candidate_options(payload_budget, MAX_FRAMES)[1]
+
+def _is_segmented(duration: float) -> bool:
+    return bool(SEGMENTED_MIN_SECONDS) and duration >= SEGMENTED_MIN_SECONDS
+
+def _candidate_options(payload_budget: PayloadBudget, max_frames: int):
+    """
+    How many frames to decode, and at what size, for a single-request analysis.
+    """
+    if FRAME_SELECTION == "content":
+        # Decode a larger candidate pool, then keep the most distinct frames
+        return max_frames * CANDIDATE_FACTOR, min(CANDIDATE_MAX_DIMENSION, payload_budget.max_dimension)
+    return max_frames, payload_budget.max_dimension
+
+def _finish_payload(result, payload_budget: PayloadBudget, max_frames: int) -> FramePayload:
+    """
+    Selects and budget-encodes the decoded candidates of a single-request analysis.
+    """
+    selection = None
+    if FRAME_SELECTION == "content":
+        select_start = time.perf_counter()
+        result.frames, selection = select_frames(result.frames, max_frames)
+        result.timings["select"] = time.perf_counter() - select_start
+
+    jpegs = []
+    fingerprint = None
+    if result.frames:
+        fingerprint = frame_fingerprint(result.frames)
+        encode_start = time.perf_counter()
+        jpegs = payload_budget.encode(result.frames)
+        result.timings["encode"] = time.perf_counter() - encode_start
+
+    return FramePayload(
+        jpegs,
+        [frame.timestamp for frame in result.frames],
+        result.strategy,
+        result.info.as_dict(),
+        result.timings,
+        result.runs,
+        selection,
+        fingerprint,
+        payload_budget.report,
+    )
+
+def _segment_bounds(duration: float, frames, count: int, chapters: list = None):
+    """
+    Splits [0, duration] into `count` equal windows, then moves each inner boundary to
+    the nearest chapter start near it, or else to the strongest scene change among the
+    candidate frames near it, if there is one.
+    """
+    length = duration / count
+    window = length * SEGMENT_SNAP_FRACTION
+    bounds = [i * length for i in range(count + 1)]
+    starts = [chapter["start"] for chapter in chapters or ()]
+    scores = None
+    if len(frames) >= 2:
+        scores = scene_scores(gray_histograms(frames))
+        # The first frame always scores as a cut; it is not a real one
+        scores[0] = 0.0
+        timestamps = np.array([frame.timestamp for frame in frames], dtype=np.float64)
+    for i in range(1, count):
+        near = [start for start in starts if abs(start - bounds[i]) <= window]
+        if near:
+            # The uploader's own chapter marks are better cuts than any scene change
+            bounds[i] = min(near, key=lambda start: abs(start - bounds[i]))
+            continue
+        if scores is None:
+            continue
+        nearby = np.abs(timestamps - bounds[i]) <= window
+        if not nearby.any():
+            continue
+        best = int(np.argmax(np.where(nearby, scores, -1.0)))
+        if scores[best] >= SCENE_CHANGE_THRESHOLD:
+            bounds[i] = float(timestamps[best])
+    return bounds
+
+def _spread(frames, count: int):
+    if len(frames) <= count:
+        return frames
+    return [frames[int(i * len(frames) / count)] for i in range(count)]
+
+def build_segmented_payload(video_path: str, payload_budget: PayloadBudget, info, chapters: list = None) -> FramePayload:
+    """
+    Samples a long video once, splits the samples into segments at scene changes near
+    fixed-length windows, and keeps SEGMENT_FRAMES frames per segment. Each segment is
+    encoded within its own payload budget, since each is sent in a separate request.
+    """
+    count, candidates, max_dimension = _segment_options(payload_budget, info.duration)
+    result = extract_frames(video_path, max_frames=candidates, max_dimension=max_dimension, info=info)
+    return _finish_segmented_payload(result, payload_budget, count, max_dimension, chapters)
+
+def _segment_options(payload_budget: PayloadBudget, duration: float):
+    """
+    Number of segments, frames to decode and their size for a segmented analysis.
+    """
+    count = min(MAX_SEGMENTS, max(2, math.ceil(duration / SEGMENT_SECONDS)))
+    max_dimension = min(SEGMENT_MAX_DIMENSION, payload_budget.max_dimension)
+    factor = SEGMENT_CANDIDATE_FACTOR if FRAME_SELECTION == "content" else 1
+    return count, count * SEGMENT_FRAMES * factor, max_dimension
+
+def _finish_segmented_payload(result, payload_budget: PayloadBudget, count: int, max_dimension: int,
+                              chapters: list = None) -> FramePayload:
+    """
+    Splits the decoded candidates of a long video into segments, selects frames in
+    each, and encodes every segment within its own budget.
+    """
+    info = result.info
+    select_start = time.perf_counter()
+    bounds = _segment_bounds(info.duration, result.frames, count, chapters)
+    segments = []
+    groups = []
+    selection = {"candidates": len(result.frames), "scene_changes": 0, "duplicates_dropped": 0, "selected": 0}
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        last = i == count - 1
+        window = [frame for frame in result.frames if start <= frame.timestamp and (last or frame.timestamp < end)]
+        if FRAME_SELECTION == "content":
+            chosen, stats = select_frames(window, SEGMENT_FRAMES)
+            for key in ("scene_changes", "duplicates_dropped"):
+                selection[key] += stats[key]
         else:
-            self.client = OpenAI(api_key=api_key)
+            chosen = _spread(window, SEGMENT_FRAMES)
+        if chosen:
+            segments.append({"start": round(start, 3), "end": round(end, 3), "frames": len(chosen)})
+            groups.append(chosen)
+    frames = [frame for group in groups for frame in group]
+    selection["selected"] = len(frames)
+    result.timings["select"] = time.perf_counter() - select_start
+
+    jpegs = []
+    fingerprint = None
+    report = None
+    if frames:
+        fingerprint = frame_fingerprint(frames)
+        encode_start = time.perf_counter()
+        # One frame per image, so every image can be labelled with its timestamp
+        segment_budget = PayloadBudget(payload_budget.target_bytes, max_dimension)
+        reports = []
+        for group in groups:
+            jpegs += segment_budget.encode(group)
+            reports.append(segment_budget.report)
+        result.timings["encode"] = time.perf_counter() - encode_start
+        qualities = [r["jpeg_quality"] for r in reports if r["jpeg_quality"]]
+        report = {
+            "frames": len(frames),
+            "images": len(jpegs),
+            "tile_grid": None,
+            "max_dimension": max_dimension,
+            "budget_bytes": payload_budget.target_bytes,
+            "jpeg_bytes": sum(r["jpeg_bytes"] for r in reports),
+            "payload_bytes": sum(r["payload_bytes"] for r in reports),
+            "jpeg_quality": {
+                "min": min(q["min"] for q in qualities), "max": max(q["max"] for q in qualities),
+            } if qualities else None,
+            "segments": len(segments),
+        }
+
+    return FramePayload(
+        jpegs,
+        [frame.timestamp for frame in frames],
+        result.strategy,
+        result.info.as_dict(),
+        result.timings,
+        result.runs,
+        selection,
+        fingerprint,
+        report,
+        segments,
+    )
+
+async def build_pipelined_payload(source, payload_budget: PayloadBudget, max_frames: int = MAX_FRAMES,
+                                  stdin=None, download=None, chapters: list = None) -> FramePayload:
+    """
+    Builds the frame payload while the video is still arriving. ffmpeg decodes `source.url`,
+    or the pipe `stdin` from a download in progress, and each frame goes onto an asyncio
+    queue as soon as it is written. When every decoded frame is kept (uniform selection,
+    no tiling), frames are budget-encoded and base64-encoded as they come off the queue,
+    so the request is ready right after the last frame. Content selection and segmenting
+    need all candidates first, so for them only downloading and decoding overlap.
+
+    `source` is a download_video.StreamSource. `download`, if given, has a blocking wait()
+    that returns when the download finishes; it is used for timing only. The returned
+    payload has `base64_frames` filled in, and no frames if ffmpeg is missing or failed.
+    """
+    start_time = time.perf_counter()
+    metadata = source.info
+    fps = float(metadata.get("fps") or 0.0)
+    duration = float(source.duration or 0.0)
+    info = VideoInfo(
+        source.url or "pipe:0", int(duration * fps), fps, metadata.get("width") or 0, metadata.get("height") or 0,
+        metadata.get("vcodec") or "", duration,
+    )
+    info.http_headers = dict(source.http_headers)
+    if not duration and source.url:
+        # Some sites report no duration; a readable URL can still be probed for it
+        info = await asyncio.to_thread(probe_video, source.url, None, source.http_headers)
+    strategy = STRATEGIES["ffmpeg"]
+    timings = {}
+    runs = []
+    if not strategy.supports(info):
+        return FramePayload([], [], strategy.name, info.as_dict(), timings, runs, None, None, None)
+
+    segmented = _is_segmented(info.duration)
+    if segmented:
+        count, candidates, max_dimension = _segment_options(payload_budget, info.duration)
+    else:
+        candidates, max_dimension = _candidate_options(payload_budget, max_frames)
+    streaming = not segmented and FRAME_SELECTION != "content" and not payload_budget.tile_grid
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    spans = {}
+    errors = []
+
+    def decode():
+        decode_start = time.perf_counter()
+        frames = strategy.iter_frames(info, candidates, max_dimension, stdin=stdin)
+        try:
+            for frame in frames:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, frame)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frames.close()
+            if stdin is not None:
+                # With no reader left, a download still writing to the pipe fails instead of blocking
+                stdin.close()
+            spans["decode"] = (decode_start, time.perf_counter())
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    def wait_for_download():
+        download.wait()
+        spans["download"] = (start_time, time.perf_counter())
+
+    def encode(frame):
+        encode_start = time.perf_counter()
+        jpeg = payload_budget.add(frame)
+        encoded = base64.b64encode(jpeg).decode("utf-8")
+        spans.setdefault("encode", []).append((encode_start, time.perf_counter()))
+        return encoded
+
+    waiters = [asyncio.to_thread(decode)]
+    if download:
+        waiters.append(asyncio.to_thread(wait_for_download))
+    stages = asyncio.gather(*waiters)
+    frames = []
+    base64_frames = []
+    try:
+        if streaming:
+            payload_budget.start(max_frames)
+        while (frame := await queue.get()) is not None:
+            # ffmpeg's sampling grid can produce one frame past the last slot
+            if streaming and len(frames) >= max_frames:
+                continue
+            spans.setdefault("first_frame", time.perf_counter())
+            frames.append(frame)
+            if streaming:
+                base64_frames.append(await asyncio.to_thread(encode, frame))
+    finally:
+        stop.set()
+        await stages
+
+    decode_seconds = spans["decode"][1] - spans["decode"][0]
+    runs.append((strategy.name, decode_seconds, len(frames), bool(errors) or not frames))
+    timings[strategy.name] = decode_seconds
+    if errors or not frames:
+        print(f"Pipelined frame extraction failed: {errors[0] if errors else 'no frames decoded'}")
+        return FramePayload([], [], strategy.name, info.as_dict(), timings, runs, None, None, None)
+
+    result = ExtractionResult(frames, strategy.name, info, timings, runs)
+    if streaming:
+        jpegs = payload_budget.finish(len(frames))
+        timings["encode"] = sum(end - start for start, end in spans["encode"])
+        payload = FramePayload(
+            jpegs, [frame.timestamp for frame in frames], strategy.name, info.as_dict(), timings, runs, None,
+            await asyncio.to_thread(frame_fingerprint, frames), payload_budget.report,
+        )
+    else:
+        if segmented:
+            payload = await asyncio.to_thread(
+                _finish_segmented_payload, result, payload_budget, count, max_dimension, chapters
+            )
+        else:
+            payload = await asyncio.to_thread(_finish_payload, result, payload_budget, max_frames)
+        base64_frames = [base64.b64encode(jpeg).decode("utf-8") for jpeg in payload.jpegs]
+    payload.jpegs = None
+    payload.base64_frames = base64_frames
+
+    # Overlap: frames decoded while the download was still running, plus encoding done
+    # while decoding was still running. Both would be spent one after another without the pipeline.
+    timings["total"] = time.perf_counter() - start_time
+    timings["first_frame"] = spans["first_frame"] - start_time
+    decode_end = spans["decode"][1]
+    overlap = sum(min(end, decode_end) - start for start, end in spans.get("encode", []) if start < decode_end)
+    if "download" in spans:
+        timings["download"] = spans["download"][1] - spans["download"][0]
+        overlap += max(0.0, min(spans["download"][1], decode_end) - spans["first_frame"])
+    timings["overlap"] = overlap
+    return payload
+
+
+class VideoAnalyzer:
+    def __init__(self, api_key: str, base_url: str = None, model_name: str = "gpt-4o", stage_limits=None):
+        # Shared across analyzers so requests reuse pooled keep-alive connections
+        self.client = get_async_client(api_key, base_url)
         self.model_name = model_name
-        self.conversation_history = []
+        # Follow-up turns since the analysis, and short notes on older turns compacted out of it
+        self.history = []
+        self.summary = []
+        self.extraction = None
+        self.frames = []
+        self.timestamps = []
+        self.fingerprint = None
+        self.description = None
+        # The site's chapter markers, [{"start", "end", "title"}, ...], if it has any
+        self.chapters = []
+        # Token usage, cache hits and latency of the model requests, per phase ("analysis", "follow_up")
+        self.usage = {}
+        self.payload_budget = PayloadBudget.for_model(model_name)
+        # Optional scheduler.StageLimits shared by all analyzers to cap concurrent model calls
+        self.stage_limits = stage_limits
+        _live_analyzers.add(self)
         self.system_instruction = "You are a video analyzer, you have to watch the video user provided, and respond with detailed description of the video. User may ask follow-up questions. User is using language zh-tw, please also use zh-tw to reply them."
 
-    def _process_video_frames(self, video_path: str, max_frames: int = 20):
+    def _stage(self, name: str):
+        if self.stage_limits:
+            return self.stage_limits.stage(name)
+        return contextlib.nullcontext()
+
+    def _process_video_frames(self, video_path: str, max_frames: int = MAX_FRAMES, duration_hint: float = None, http_headers: dict = None):
         """
         Extracts frames from a video, converts them to base64, and returns a list.
+        The extraction strategy and its timings are kept on `self.extraction` for reporting.
         """
-        video = cv2.VideoCapture(video_path)
-        total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-        if total_frames == 0:
-            return []
-        
-        # Ensure we don't try to read more frames than exist
-        max_frames = min(max_frames, total_frames)
-        
-        # Calculate the interval to get an even distribution of frames
-        interval = total_frames // max_frames if max_frames > 0 else total_frames
-
-        base64_frames = []
-        for i in range(max_frames):
-            frame_id = i * interval
-            video.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
-            success, frame = video.read()
-            if not success:
-                continue
+        payload = build_frame_payload(video_path, self.payload_budget, max_frames, duration_hint, http_headers)
+        payload.base64_frames = [base64.b64encode(jpeg).decode("utf-8") for jpeg in payload.jpegs]
+        payload.jpegs = None
+        self._apply_payload(payload)
+        return self.frames
 
-            # Convert frame to JPEG in memory
-            _, buffer = cv2.imencode(".jpg", frame)
-            base64_frame = base64.b64encode(buffer).decode("utf-8")
-            base64_frames.append(base64_frame)
-        
-        video.release()
-        return base64_frames
+    def _apply_payload(self, payload):
+        record_strategy_runs(payload.runs)
+        metrics.observe_extraction(payload.strategy, payload.timings, payload.payload_report)
+        self.extraction = payload
+        self.fingerprint = payload.fingerprint
+        self.frames = payload.base64_frames
+        self.timestamps = payload.timestamps
 
-    async def analyze_video_from_path(self, video_path: str):
+    async def prepare_frames(self, video_path: str, duration_hint: float = None, http_headers: dict = None):
         """
-        Analyzes a video from a file path by processing its frames.
+        Extracts and encodes the frames for a video file or stream URL in the extraction
+        process pool. Returns the number of frames ready to send; 0 means extraction failed.
         """
-        base64_frames = await asyncio.to_thread(self._process_video_frames, video_path)
-        if not base64_frames:
-            return "Error: Could not extract frames from the video. It might be corrupted or in an unsupported format."
+        payload = await extraction_service.extract(
+            build_frame_payload, video_path, self.payload_budget, MAX_FRAMES, duration_hint, http_headers, self.chapters
+        )
+        self._apply_payload(payload)
+        return len(self.frames)
 
-        # Reset history for new video
+    async def prepare_frames_pipelined(self, source, stdin=None, download=None):
+        """
+        Like prepare_frames(), but decodes and encodes the frames while the video is still
+        downloading (see build_pipelined_payload). Runs in this process: ffmpeg does the
+        decoding in its own, and encoding happens in threads.
+        """
+        payload = await build_pipelined_payload(source, self.payload_budget, MAX_FRAMES, stdin, download, self.chapters)
+        self._apply_payload(payload)
+        return len(self.frames)
+
+    async def prepare_frames_from_storyboard(self, board):
+        """
+        Like prepare_frames(), but cuts the frames from a site's storyboard, so the video is
+        never downloaded. Runs in a thread of this process, as it mostly waits on the network.
+        """
+        payload = await asyncio.to_thread(build_storyboard_payload, board, self.payload_budget, MAX_FRAMES, self.chapters)
+        payload.base64_frames = [base64.b64encode(jpeg).decode("utf-8") for jpeg in payload.jpegs]
+        payload.jpegs = None
+        self._apply_payload(payload)
+        return len(self.frames)
+
+    def frame_size(self, duration: float = None) -> int:
+        """
+        The longest side frames of a video this long are decoded at for this model.
+        """
+        return frame_size(self.payload_budget, duration)
+
+    def _chapter_text(self) -> str:
+        if not self.chapters:
+            return ""
+        marks = "; ".join(f"{_format_timestamp(chapter['start'])} {chapter['title']}" for chapter in self.chapters)
+        return f" The uploader divided the video into these chapters: {marks}."
+
+    async def analyze_video_from_path(self, video_path: str, duration_hint: float = None, http_headers: dict = None):
+        """
+        Analyzes a video from a file path (or stream URL) by processing its frames.
+        """
+        await self.prepare_frames(video_path, duration_hint=duration_hint, http_headers=http_headers)
+        return await self.analyze_frames()
+
+    def _build_analysis_messages(self, hints: str = "none"):
+        """
+        Builds the system prompt and the user message carrying every frame.
+        The messages are rebuilt for each request rather than kept, so the frames
+        are held only once, in `self.frames`. They are also the exact prefix of every
+        follow-up sent with all frames, so a provider can serve them from its cache.
+        """
         user_content = [
             {
                 "type": "text",
-                "text": "These are frames from a video. Please describe the contents of this video in detail.",
+                "text": ANALYSIS_PROMPT + self._chapter_text(),
             }
         ]
-        for frame in base64_frames:
+        report = self.extraction.payload_report if self.extraction else None
+        if report and report["tile_grid"]:
+            user_content[0]["text"] += (
+                f" Each image is a {report['tile_grid']} grid of consecutive frames, in reading order."
+            )
+        for frame in self.frames:
             user_content.append({
                 "type": "image_url",
                 "image_url": {"url": f"data:image/jpeg;base64,{frame}"},
             })
+        if hints == "cache_control":
+            # Everything up to the last frame is the cacheable prefix
+            user_content[-1]["cache_control"] = {"type": "ephemeral"}
 
-        self.conversation_history = [
+        return [
             {"role": "system", "content": self.system_instruction},
             {"role": "user", "content": user_content}
         ]
 
-        try:
-            response = await asyncio.to_thread(
-                self.client.chat.completions.create,
-                model=self.model_name,
-                messages=self.conversation_history,
-                max_tokens=9000,
+    def _follow_up_frames_mode(self) -> str:
+        if not self.frames or FOLLOW_UP_FRAMES == "none":
+            return "none"
+        if len(self.frames) > MAX_FRAMES:
+            # A segmented analysis has far more frames than one request should carry
+            return "keyframes"
+        if FOLLOW_UP_FRAMES != "auto":
+            return FOLLOW_UP_FRAMES
+        state = _prompt_cache_state(self.model_name)
+        if state["probes"] >= PROMPT_CACHE_PROBES and not state["hits"]:
+            # The provider does not cache the frames, so resending them costs full price every time
+            return "keyframes"
+        return "all"
+
+    def _keyframe_content(self, question: str):
+        """
+        The question with a few frames attached, picked by relevance to it.
+        """
+        indices = pick_keyframes(question, self.description, len(self.frames), self.timestamps)
+        if self.timestamps and len(self.timestamps) == len(self.frames):
+            labels = ", ".join(_format_timestamp(self.timestamps[i]) for i in indices)
+        else:
+            labels = ", ".join(f"frame {i + 1} of {len(self.frames)}" for i in indices)
+        content = [{"type": "text", "text": f"Frames from the video that may help with the next question ({labels}):"}]
+        content += [
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self.frames[i]}"}}
+            for i in indices
+        ]
+        content.append({"type": "text", "text": question})
+        return content
+
+    def _build_follow_up_messages(self, question: str, frames_mode: str, hints: str = "none"):
+        """
+        Builds the messages for a follow-up. The analysis comes first, so the prefix is the
+        same for every question: with all its frames in "all" mode, as text otherwise. Then
+        a summary of compacted turns, the recent turns, and the question, which carries a
+        few relevant keyframes in "keyframes" mode.
+        """
+        if frames_mode == "all":
+            messages = self._build_analysis_messages(hints)
+        else:
+            messages = [
+                {"role": "system", "content": self.system_instruction},
+                {"role": "user", "content": TEXT_ONLY_ANALYSIS_PROMPT},
+            ]
+        if hints == "cache_control":
+            messages.append({
+                "role": "assistant",
+                "content": [{"type": "text", "text": self.description, "cache_control": {"type": "ephemeral"}}],
+            })
+        else:
+            messages.append({"role": "assistant", "content": self.description})
+        if self.summary:
+            messages.append({
+                "role": "system",
+                "content": "Earlier follow-up questions and answers, shortened:\n\n" + "\n\n".join(self.summary),
+            })
+        messages.extend(self.history)
+        if frames_mode == "keyframes":
+            messages.append({"role": "user", "content": self._keyframe_content(question)})
+        else:
+            messages.append({"role": "user", "content": question})
+        return messages
+
+    def _hint_options(self, hints: str) -> dict:
+        if hints == "prompt_cache_key" and self.fingerprint:
+            # Routes requests for the same video to the same cache
+            return {"extra_body": {"prompt_cache_key": f"video:{self.fingerprint}"}}
+        return {}
+
+    async def _complete(self, build_messages, phase: str, on_delta, max_tokens: int):
+        """
+        Sends one model request with prompt cache hints and records its usage under `phase`.
+        If the backend rejects the hints, they are turned off for this model and the
+        request is sent again without them.
+        """
+        hints = _cache_hint_mode(self.model_name)
+        async with self._stage("model"):
+            # Timed inside the stage, so waiting for a free model slot is not counted as latency
+            started = time.perf_counter()
+            try:
+                try:
+                    completion = await complete(
+                        self.client,
+                        on_delta=on_delta,
+                        model=self.model_name,
+                        messages=build_messages(hints),
+                        max_tokens=max_tokens,
+                        **self._hint_options(hints),
+                    )
+                except openai.BadRequestError as e:
+                    if hints == "none":
+                        raise
+                    print(f"{self.model_name} rejected {hints} cache hints ({e}); sending requests without them.")
+                    _prompt_cache_state(self.model_name)["hints_rejected"] = True
+                    completion = await complete(
+                        self.client,
+                        on_delta=on_delta,
+                        model=self.model_name,
+                        messages=build_messages("none"),
+                        max_tokens=max_tokens,
+                    )
+            except Exception:
+                metrics.MODEL_ERRORS.inc(phase=phase)
+                raise
+        self._record_usage(phase, completion, time.perf_counter() - started)
+        return completion
+
+    def _record_usage(self, phase: str, completion, seconds: float):
+        totals = self.usage.setdefault(phase, {
+            "requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "seconds": 0.0,
+        })
+        totals["requests"] += 1
+        counts = usage_counts(completion.usage)
+        for key, value in counts.items():
+            totals[key] += value
+        metrics.observe_model_request(phase, seconds, counts, completion.first_token_seconds)
+        totals["seconds"] = round(totals["seconds"] + seconds, 3)
+        if completion.first_token_seconds is not None:
+            totals["last_first_token_seconds"] = round(completion.first_token_seconds, 3)
+        totals["cache_hit_ratio"] = (
+            round(totals["cached_tokens"] / totals["prompt_tokens"], 4) if totals["prompt_tokens"] else None
+        )
+
+    def restore(self, frames: list, description: str, history: list = None, summary: list = None,
+                timestamps: list = None, usage: dict = None, fingerprint: str = None, chapters: list = None):
+        """
+        Rebuilds the conversation from stored frames, description and follow-up turns, so
+        follow-up questions work without re-running the analysis. The fingerprint and
+        chapters keep the follow-ups' prompt prefix and cache key the same as the analysis'.
+        """
+        self.frames = frames
+        self.description = description
+        self.history = list(history or [])
+        self.summary = list(summary or [])
+        self.timestamps = list(timestamps or [])
+        self.usage = copy.deepcopy(usage or {})
+        self.fingerprint = fingerprint
+        self.chapters = list(chapters or [])
+
+    def _build_segment_messages(self, index: int, segment: dict, frames: list, timestamps: list):
+        """
+        Builds the request for one segment: its frames, each labelled with its timestamp.
+        """
+        total = len(self.extraction.segments)
+        user_content = [{
+            "type": "text",
+            "text": (
+                f"These are frames from part {index + 1} of {total} of a video, from "
+                f"{_format_timestamp(segment['start'])} to {_format_timestamp(segment['end'])}. "
+                "Each frame follows its timestamp. Describe in detail what happens in this part, and when."
+            ),
+        }]
+        for frame, timestamp in zip(frames, timestamps):
+            user_content.append({"type": "text", "text": f"[{_format_timestamp(timestamp)}]"})
+            user_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{frame}"}})
+        return [
+            {"role": "system", "content": self.system_instruction},
+            {"role": "user", "content": user_content},
+        ]
+
+    def _build_reduce_messages(self, summaries: list):
+        """
+        Builds the request that merges the segment descriptions into one.
+        """
+        parts = []
+        for i, (segment, summary) in enumerate(zip(self.extraction.segments, summaries)):
+            parts.append(
+                f"## Part {i + 1} ({_format_timestamp(segment['start'])}-{_format_timestamp(segment['end'])})\n"
+                + (summary or "(This part could not be analyzed.)")
             )
-            reply = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": reply})
-            return reply + "\n\n" + "-# Reply to this message to ask follow-up questions."
+        return [
+            {"role": "system", "content": self.system_instruction},
+            {"role": "user", "content": (
+                "These are descriptions of consecutive parts of one video. Combine them into one detailed "
+                "description of the whole video, in chronological order, and mark the main events with "
+                "their timestamps." + self._chapter_text() + "\n\n" + "\n\n".join(parts)
+            )},
+        ]
+
+    async def _analyze_segments(self, on_delta=None, on_progress=None):
+        """
+        Map-reduce analysis of a segmented payload: every segment is described in its own
+        request, SEGMENT_CONCURRENCY at a time, then one request merges the descriptions.
+        Only the merge is streamed. Returns the merged description.
+        """
+        segments = self.extraction.segments
+        limit = asyncio.Semaphore(SEGMENT_CONCURRENCY)
+        finished = 0
+
+        async def describe(index, segment, start):
+            nonlocal finished
+            frames = self.frames[start:start + segment["frames"]]
+            timestamps = self.timestamps[start:start + segment["frames"]]
+            async with limit:
+                try:
+                    completion = await self._complete(
+                        lambda hints: self._build_segment_messages(index, segment, frames, timestamps),
+                        "segments", None, SEGMENT_MAX_TOKENS,
+                    )
+                    summary = completion.text
+                except Exception as e:
+                    print(f"Error analyzing segment {index + 1}/{len(segments)}: {e}")
+                    summary = None
+            finished += 1
+            if on_progress:
+                on_progress(finished, len(segments))
+            return summary
+
+        offsets = [sum(segment["frames"] for segment in segments[:i]) for i in range(len(segments))]
+        summaries = await asyncio.gather(*(
+            describe(i, segment, offset) for i, (segment, offset) in enumerate(zip(segments, offsets))
+        ))
+        if not any(summaries):
+            raise RuntimeError("none of the video segments could be analyzed")
+        completion = await self._complete(lambda hints: self._build_reduce_messages(summaries), "analysis", on_delta, 9000)
+        return completion.text
+
+    async def analyze_frames(self, on_delta=None, on_progress=None):
+        """
+        Sends the frames from prepare_frames() to the model and returns its description.
+        If `on_delta` is given, the reply is streamed and passed to it piece by piece.
+        Segmented payloads are analyzed per segment first; `on_progress(done, total)`
+        is called as each segment finishes.
+        """
+        if not self.frames:
+            return "Error: Could not extract frames from the video. It might be corrupted or in an unsupported format."
+
+        # Reset history for new video
+        self.history = []
+        self.summary = []
+
+        try:
+            if self.extraction and self.extraction.segments:
+                reply = await self._analyze_segments(on_delta, on_progress)
+            else:
+                completion = await self._complete(self._build_analysis_messages, "analysis", on_delta, 9000)
+                reply = completion.text
+            self.description = reply
+            return reply + FOLLOW_UP_HINT
         except Exception as e:
             print(f"Error analyzing video: {e}")
             return f"Error: Could not analyze the video. {e}"
 
-    async def ask_question(self, question: str):
+    async def ask_question(self, question: str, on_delta=None):
         """
         Asks a follow-up question about the video.
+        If `on_delta` is given, the answer is streamed and passed to it piece by piece.
         """
-        if not self.conversation_history:
+        if not self.description:
             return "Error: You need to analyze a video first before asking follow-up questions."
 
-        self.conversation_history.append({"role": "user", "content": question})
-
+        frames_mode = self._follow_up_frames_mode()
         try:
-            response = await asyncio.to_thread(
-                self.client.chat.completions.create,
-                model=self.model_name,
-                messages=self.conversation_history,
-                max_tokens=4095,
+            completion = await self._complete(
+                lambda hints: self._build_follow_up_messages(question, frames_mode, hints), "follow_up", on_delta, 4095
             )
-            reply = response.choices[0].message.content
-            self.conversation_history.append({"role": "assistant", "content": reply})
+            self.usage["follow_up"]["frames_mode"] = frames_mode
+            if frames_mode == "all":
+                state = _prompt_cache_state(self.model_name)
+                state["probes"] += 1
+                if usage_counts(completion.usage)["cached_tokens"]:
+                    state["hits"] += 1
+            reply = completion.text
+            self.history += [{"role": "user", "content": question}, {"role": "assistant", "content": reply}]
+            # Older turns are folded into a short summary so follow-up requests stay small
+            self.history, self.summary = compact_history(self.history, self.summary)
             return reply
         except Exception as e:
             print(f"Error during follow-up: {e}")
@@ -1,154 +1,778 @@
 import asyncio
+import json
 import uuid
 import os
 import time
 from fastapi import FastAPI, BackgroundTasks, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
+from typing import Optional
 from contextlib import asynccontextmanager
 
+import metrics
 from load_config import openai_api_key, openai_base_url
-from analyze import VideoAnalyzer
-from download_video import download_video, remove_video
+from analyze import FOLLOW_UP_HINT, VideoAnalyzer, prompt_cache_stats
+from cache import CACHE_ENABLED, ResultCache
+from extraction_service import extraction_service
+from llm_client import close_clients
+from frame_extract import strategy_stats
+from download_video import (
+    DOWNLOAD_MODE, VideoPipe, VideoRejected, canonical_video_key, chapters, download_video, metadata_cache, preflight,
+    probe_download, resolve_stream, resolve_video, storyboard,
+)
+from media_store import MediaQuotaExceeded, media_store
+from scheduler import ANALYSIS_WORKERS, STAGE_LIMITS, QueueFull, StageLimits
+from sessions import SESSION_SPILL_PATH, Session, SessionStore
+from state import create_state
 
 # --- Globals for state management ---
-# In a production environment, consider using Redis or a database instead of in-memory dicts.
-tasks: Dict[str, Dict[str, Any]] = {}
-analyzers: Dict[str, VideoAnalyzer] = {}
+# Tasks, their events and the job queue; shared between processes unless STATE_BACKEND is "memory"
+state = create_state()
 OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "[EXPRESS] gemini-2.5-pro")
 DEBUG_TIMING = os.getenv("DEBUG_TIMING", "false").lower() in ("true", "1", "t")
+DOWNLOAD_FAILED = "Download Failed: The video might be private, region-locked, or the URL is invalid."
+# Longest a GET /result?wait=N long-poll is held open
+MAX_RESULT_WAIT = 120
+# How often finished tasks and idle follow-up sessions are swept
+CLEANUP_INTERVAL_SECONDS = 300
+# Whether this process also runs analysis jobs; turn off when separate worker.py processes do
+ANALYSIS_IN_API = os.getenv("ANALYSIS_IN_API", "true").lower() in ("true", "1", "t")
+# With a shared backend, streamed text is written to it in batches at most this often
+DELTA_FLUSH_INTERVAL = 0.1
+# Follow-up conversations, kept within a memory budget and spilled to SQLite beyond it.
+# Processes sharing task state also share sessions, so every session goes straight to disk.
+sessions = SessionStore(max_bytes=0) if state.shared else SessionStore()
+if state.shared and not SESSION_SPILL_PATH:
+    print("Warning: SESSION_SPILL_PATH is empty, so follow-up questions only work in the process that ran the analysis.")
+result_cache = ResultCache() if CACHE_ENABLED else None
+stage_limits = StageLimits(STAGE_LIMITS)
+
+def _collect_queue():
+    queue = state.queue_stats()
+    metrics.QUEUE_DEPTH.set(queue["depth"])
+    metrics.QUEUE_ACTIVE.set(queue["active"])
+    for name, stage in stage_limits.stats().items():
+        metrics.STAGE_ACTIVE.set(stage["active"], stage=name)
+        metrics.STAGE_WAITING.set(stage["waiting"], stage=name)
+        metrics.STAGE_LIMIT.set(stage["limit"], stage=name)
+
+metrics.add_collector(_collect_queue)
 
 # --- FastAPI App Initialization ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Counts busy and waiting threads of asyncio.to_thread() for /metrics
+    metrics.install_thread_pool()
+    # Downloads go to this process's own directory; ones left by crashed processes are removed
+    await asyncio.to_thread(media_store.open)
     # Start a background task to clean up old tasks
     asyncio.create_task(cleanup_old_tasks())
+    # Spawn the extraction workers now so the first video doesn't pay for it
+    extraction_service.start()
+    workers = []
+    if ANALYSIS_IN_API or not state.shared:
+        workers = state.start_workers(run_job, ANALYSIS_WORKERS)
     yield
-    # Any cleanup on shutdown can go here
+    for worker in workers:
+        worker.cancel()
+    extraction_service.shutdown()
+    await close_clients()
+    # Keep follow-up sessions across restarts
+    await asyncio.to_thread(sessions.close)
+    await asyncio.to_thread(media_store.close)
 
 app = FastAPI(lifespan=lifespan)
 
 # --- Pydantic Models ---
 class AnalyzeRequest(BaseModel):
     video_url: str
+    # Used to share the queue fairly between users; lower priority values run first
+    user_id: Optional[str] = None
+    priority: int = 0
 
 class AskRequest(BaseModel):
     task_id: str
     question: str
 
+# --- Streaming ---
+class TaskStream:
+    """
+    Model output of one follow-up answer as it happens.
+    A reader that connects late first receives everything produced so far, then each
+    new event. `done` is set once the final status and result are known.
+    """
+    def __init__(self):
+        self.events = []
+        self.final = None
+        self.done = asyncio.Event()
+        # The task writing the answer; the event loop itself only keeps a weak reference to it
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def status(self, status: str):
+        self.events.append(("status", status))
+        self._notify()
+
+    def append(self, text: str):
+        self.events.append(("delta", text))
+        self._notify()
+
+    def close(self, status: str, result: str):
+        self.final = {"status": status, "result": result}
+        self.done.set()
+        self._notify()
+
+    async def follow(self, kinds=("delta",)):
+        """
+        Yields ("status", {"status": ...}) and/or ("delta", {"text": ...}) events, as
+        selected by `kinds`, until the stream closes, then one ("done", {...}).
+        Consecutive deltas are sent as one event.
+        """
+        sent = 0
+        while True:
+            changed = self._changed
+            if sent < len(self.events):
+                kind, value = self.events[sent]
+                sent += 1
+                if kind == "delta":
+                    pieces = [value]
+                    while sent < len(self.events) and self.events[sent][0] == "delta":
+                        pieces.append(self.events[sent][1])
+                        sent += 1
+                    if "delta" in kinds:
+                        yield "delta", {"text": "".join(pieces)}
+                elif kind in kinds:
+                    yield kind, {"status": value}
+                continue
+            if self.final:
+                yield "done", self.final
+                return
+            await changed.wait()
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(events) -> StreamingResponse:
+    async def body():
+        async for event, data in events:
+            yield _sse(event, data)
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def _follow_task(task_id: str, kinds=("delta",)):
+    """
+    Like TaskStream.follow, but reads an analysis task's event log from the state backend,
+    so the analysis can be running in any process. Ends early if the task is cleaned up.
+    """
+    sent = 0
+    while True:
+        events = await state.wait_events(task_id, sent, timeout=CLEANUP_INTERVAL_SECONDS)
+        if not events and not await state.call(state.get_task, task_id):
+            return
+        sent += len(events)
+        pieces = []
+        for kind, value in events:
+            if kind == "delta":
+                pieces.append(value)
+                continue
+            if pieces and "delta" in kinds:
+                yield "delta", {"text": "".join(pieces)}
+            pieces = []
+            if kind == "done":
+                yield "done", value
+                return
+            if kind in kinds:
+                yield kind, {"status": value}
+        if pieces and "delta" in kinds:
+            yield "delta", {"text": "".join(pieces)}
+
+# --- Request Coalescing ---
+class AnalysisFlight:
+    """
+    One running analysis of a video. Tasks that ask for the same video while it runs
+    follow the task that started it (see StateBackend), so its status, events and result
+    are written once, to the leader. Each task still gets its own follow-up session,
+    so follow-up conversations stay separate.
+
+    With a shared backend the writes run in a thread, one after another in the order
+    they were made, so the event loop never waits on the backend; drain() waits for them.
+    """
+    def __init__(self, video_key: str, task_id: str):
+        self.video_key = video_key
+        self.task_id = task_id
+        self.state = {}
+        self._pending = []
+        self._flushed = 0.0
+        self._writes = None
+
+    def _write(self, method, *args):
+        if not state.shared:
+            method(*args)
+            return
+        self._writes = asyncio.ensure_future(self._write_after(self._writes, method, args))
+
+    @staticmethod
+    async def _write_after(previous, method, args):
+        if previous:
+            await previous
+        try:
+            await asyncio.to_thread(method, *args)
+        except Exception as e:
+            print(f"Could not write task state: {e}")
+
+    async def drain(self):
+        if self._writes:
+            await self._writes
+
+    def _flush(self):
+        if self._pending:
+            self._write(state.append_events, self.task_id, [("delta", "".join(self._pending))])
+            self._pending = []
+        self._flushed = time.monotonic()
+
+    def append(self, text: str):
+        self._pending.append(text)
+        if not state.shared or time.monotonic() - self._flushed >= DELTA_FLUSH_INTERVAL:
+            self._flush()
+
+    def update(self, **fields):
+        self.state.update(fields)
+        self._write(state.update_task, self.task_id, fields)
+        if "status" in fields:
+            self._flush()
+        if fields.get("status") in ("completed", "failed"):
+            self._write(
+                state.append_events, self.task_id, [("done", {"status": fields["status"], "result": fields.get("result")})]
+            )
+        elif "status" in fields:
+            self._write(state.append_events, self.task_id, [("status", fields["status"])])
+
+    async def finish(self, analyzer: VideoAnalyzer, **fields):
+        """
+        Stores the final fields and opens a follow-up session for the leader and every
+        follower. The sessions share a single copy of the frames. The flight is ended
+        first, so a task cannot join after the followers were read and miss its session.
+        """
+        await state.call(state.end_flight, self.video_key, self.task_id)
+        if analyzer.description:
+            for task_id in [self.task_id, *await state.call(state.followers, self.task_id)]:
+                await _save_session(task_id, analyzer)
+        self.update(**fields)
+
+# --- Follow-up Sessions ---
+async def _save_session(task_id: str, analyzer: VideoAnalyzer):
+    session = Session(
+        task_id, analyzer.fingerprint or task_id, analyzer.description, list(analyzer.history),
+        list(analyzer.summary), list(analyzer.timestamps), analyzer.usage,
+        fingerprint=analyzer.fingerprint, chapters=list(analyzer.chapters),
+    )
+    await asyncio.to_thread(sessions.save, session, analyzer.frames)
+
+async def _load_analyzer(task_id: str):
+    """
+    Rebuilds an analyzer from the task's follow-up session, or returns None if there is none.
+    """
+    session = await asyncio.to_thread(sessions.load, task_id)
+    if not session:
+        return None
+    analyzer = VideoAnalyzer(
+        api_key=openai_api_key, base_url=openai_base_url, model_name=OPENAI_MODEL_NAME, stage_limits=stage_limits
+    )
+    analyzer.restore(
+        session.frames, session.description, session.history, session.summary, session.timestamps, session.usage,
+        fingerprint=session.fingerprint, chapters=session.chapters,
+    )
+    return analyzer
+
+async def _record_follow_up(task_id: str, analyzer: VideoAnalyzer):
+    await state.call(state.update_task, task_id, {"usage": analyzer.usage})
+
 # --- Background Task for Video Analysis ---
-async def run_analysis(task_id: str, url: str):
+def _finish_timings(flight: AnalysisFlight, timings: metrics.Timings, outcome: str) -> dict:
+    """
+    Records a finished analysis in the metrics and returns its per-stage timings for /status.
+    """
+    try:
+        if "download" in timings.stages:
+            metrics.DOWNLOAD_SECONDS.observe(timings.stages["download"], source=flight.state.get("source", "download"))
+        metrics.ANALYSIS_SECONDS.observe(timings.elapsed(), outcome=outcome)
+        return timings.as_dict()
+    except Exception as e:
+        # Called from the error paths too, which must still mark the task as finished
+        print(f"Could not record timings for {flight.video_key}: {e}")
+        return {}
+
+async def _complete_from_cache(flight: AnalysisFlight, analyzer: VideoAnalyzer, entry, hit: str, start_time: float,
+                               timings: metrics.Timings):
+    """
+    Finishes a flight with a cached result and opens follow-up sessions for it.
+    """
+    analyzer.restore(entry.frames, entry.result, fingerprint=entry.fingerprint, chapters=analyzer.chapters)
+    result = entry.result + FOLLOW_UP_HINT
+    if DEBUG_TIMING:
+        result += (
+            f"\n\n---\n"
+            f"**⏱️ Timing Report:**\n"
+            f"**- Cache hit ({hit}): `{time.time() - start_time:.2f}s`**"
+        )
+    await flight.finish(
+        analyzer, cache=hit, status="completed", result=result, usage=analyzer.usage,
+        timings=_finish_timings(flight, timings, "cached"),
+    )
+
+async def _answer_from_cache(task_id: str, video_key: str) -> bool:
+    """
+    Completes a new task straight from the result cache if the video was analyzed
+    before, so it neither waits in the job queue nor counts against its limit.
+    """
+    start_time = time.time()
+    timings = metrics.Timings()
+    with timings.stage("cache"):
+        entry = await asyncio.to_thread(result_cache.get_by_video, video_key, OPENAI_MODEL_NAME)
+    if not entry:
+        return False
+    flight = AnalysisFlight(video_key, task_id)
+    analyzer = VideoAnalyzer(
+        api_key=openai_api_key, base_url=openai_base_url, model_name=OPENAI_MODEL_NAME, stage_limits=stage_limits
+    )
+    await _complete_from_cache(flight, analyzer, entry, "video", start_time, timings)
+    await flight.drain()
+    return True
+
+async def _prepare_pipelined(analyzer: VideoAnalyzer, source, timings: metrics.Timings) -> int:
+    """
+    Runs the pipelined extraction for a resolved video: ffmpeg reads the stream URL
+    itself when there is one, and otherwise reads yt-dlp's download through a pipe.
+    The pipe is a download for as long as ffmpeg reads it, so it also holds a download slot.
+    """
+    if source.url:
+        async with stage_limits.stage("decode", timings):
+            return await analyzer.prepare_frames_pipelined(source)
+    async with stage_limits.stage("download", timings), stage_limits.stage("decode", timings):
+        pipe = await asyncio.to_thread(VideoPipe, source)
+        try:
+            return await analyzer.prepare_frames_pipelined(source, stdin=pipe.stdout, download=pipe)
+        finally:
+            await asyncio.to_thread(pipe.close)
+
+async def run_analysis(flight: AnalysisFlight, url: str):
     """
     This function runs in the background to download, encode, and analyze the video.
     It also records the time taken for each step.
     """
-    video_filename = None
+    reservation = None
+    video_key = flight.video_key
     start_time = time.time()
+    timings = metrics.Timings()
+    queued = await state.call(state.queue_info, flight.task_id)
+    if queued:
+        flight.update(queue_wait_seconds=queued["wait_seconds"])
+        timings.add("queue_wait", queued["wait_seconds"])
+        metrics.QUEUE_WAIT_SECONDS.observe(queued["wait_seconds"])
     try:
-        # 1. Download the video
-        tasks[task_id]["status"] = "downloading"
-        # Run synchronous download in a thread to avoid blocking the event loop
-        video_filename = await asyncio.to_thread(download_video, url)
-        download_end_time = time.time()
-        if not video_filename:
-            tasks[task_id]["status"] = "failed"
-            tasks[task_id]["result"] = "Download Failed: The video might be private, region-locked, or the URL is invalid."
+        analyzer = VideoAnalyzer(
+            api_key=openai_api_key, base_url=openai_base_url, model_name=OPENAI_MODEL_NAME, stage_limits=stage_limits
+        )
+        frame_count = 0
+
+        # 0. A video we have already analyzed needs no download at all
+        if result_cache:
+            with timings.stage("cache"):
+                entry = await asyncio.to_thread(result_cache.get_by_video, video_key, OPENAI_MODEL_NAME)
+            if entry:
+                await _complete_from_cache(flight, analyzer, entry, "video", start_time, timings)
+                return
+
+        # 1. Metadata first: over-limit videos are refused before anything is fetched, and
+        # the steps below reuse it instead of extracting it again
+        flight.update(status="downloading")
+        with timings.stage("preflight"):
+            info = await asyncio.to_thread(preflight, url)
+        if not info:
+            flight.update(status="failed", result=DOWNLOAD_FAILED, timings=_finish_timings(flight, timings, "failed"))
             return
+        analyzer.chapters = chapters(info)
+        # The cheapest source that still gives frames as large as this model gets them
+        frame_size = analyzer.frame_size(info.get("duration"))
+
+        # 1a. Cut frames from the site's storyboard images, without fetching the video
+        if DOWNLOAD_MODE == "storyboard":
+            board = storyboard(info)
+            if board:
+                flight.update(source="storyboard")
+                async with stage_limits.stage("decode", timings):
+                    frame_count = await analyzer.prepare_frames_from_storyboard(board)
+            if not frame_count:
+                print(f"No storyboard frames for {video_key}, downloading instead.")
 
-        # 2. Send to analysis
-        tasks[task_id]["status"] = "analyzing"
-        analyzer = VideoAnalyzer(api_key=openai_api_key, base_url=openai_base_url, model_name=OPENAI_MODEL_NAME)
-        analyzers[task_id] = analyzer # Store the analyzer instance for follow-up questions
-        
-        reply_text = await analyzer.analyze_video_from_path(video_filename)
+        # 1b. Or read frames straight from the stream URL when possible
+        elif DOWNLOAD_MODE == "stream":
+            async with stage_limits.stage("download", timings):
+                stream = await asyncio.to_thread(resolve_stream, url, frame_size=frame_size)
+            if stream:
+                flight.update(source="stream")
+                async with stage_limits.stage("decode", timings):
+                    frame_count = await analyzer.prepare_frames(
+                        stream.url, duration_hint=stream.duration, http_headers=stream.http_headers
+                    )
+                if not frame_count:
+                    print(f"Could not read frames from the stream for {video_key}, downloading instead.")
+
+        # 1c. Or decode and encode frames while the video downloads
+        elif DOWNLOAD_MODE == "pipe":
+            async with stage_limits.stage("download", timings):
+                source = await asyncio.to_thread(resolve_video, url, frame_size=frame_size)
+            if source:
+                flight.update(source="stream" if source.url else "pipe")
+                frame_count = await _prepare_pipelined(analyzer, source, timings)
+                if not frame_count:
+                    print(f"Could not pipeline frames for {video_key}, downloading instead.")
+
+        # 2. Otherwise download the video
+        if not frame_count:
+            flight.update(status="downloading", source="download")
+            video_filename = None
+            # Run synchronous download in a thread to avoid blocking the event loop
+            async with stage_limits.stage("download", timings):
+                plan = await asyncio.to_thread(probe_download, url, frame_size=frame_size)
+                if plan:
+                    # Waits for disk space before the download starts, not after it has filled the disk
+                    reservation = await media_store.admit(plan.estimated_bytes)
+                    video_filename = await asyncio.to_thread(
+                        download_video, url, filename=reservation.path, info=plan.info
+                    )
+            if not video_filename:
+                flight.update(status="failed", result=DOWNLOAD_FAILED, timings=_finish_timings(flight, timings, "failed"))
+                return
+        download_end_time = time.time()
+
+        # 3. Send to analysis
+        flight.update(status="analyzing")
+
+        if not frame_count:
+            async with stage_limits.stage("decode", timings):
+                await analyzer.prepare_frames(video_filename)
+
+        # The same clip may have been analyzed under another URL
+        if result_cache and analyzer.fingerprint:
+            with timings.stage("cache"):
+                entry = await asyncio.to_thread(
+                    result_cache.get_by_fingerprint, analyzer.fingerprint, OPENAI_MODEL_NAME, video_key
+                )
+            if entry:
+                await _complete_from_cache(flight, analyzer, entry, "fingerprint", start_time, timings)
+                return
+
+        with timings.stage("model"):
+            reply_text = await analyzer.analyze_frames(
+                on_delta=flight.append,
+                on_progress=lambda done, total: flight.update(segments={"done": done, "total": total}),
+            )
         analysis_end_time = time.time()
+        if result_cache and analyzer.description:
+            await asyncio.to_thread(
+                result_cache.put, video_key, analyzer.fingerprint, OPENAI_MODEL_NAME, analyzer.frames, analyzer.description
+            )
 
-        # 3. Format timing report and store the results
+        # 4. Format timing report and store the results
         download_duration = download_end_time - start_time
         analysis_duration = analysis_end_time - download_end_time
         total_duration = analysis_end_time - start_time
 
-        tasks[task_id]["status"] = "completed"
+        report = {}
+        extraction = analyzer.extraction
+        if extraction:
+            report["extraction"] = {
+                "strategy": extraction.strategy,
+                "video": extraction.video,
+                "timings": {name: round(seconds, 4) for name, seconds in extraction.timings.items()},
+                "selection": extraction.selection,
+            }
+            if extraction.segments:
+                report["extraction"]["segments"] = extraction.segments
+            if extraction.payload_report:
+                report["payload"] = extraction.payload_report
+
+        result = reply_text
         if DEBUG_TIMING:
             timing_report = (
                 f"\n\n---\n"
                 f"**⏱️ Timing Report:**\n"
-                f"- Download: `{download_duration:.2f}s`\n"
+                f"- Download ({flight.state['source']}): `{download_duration:.2f}s`\n"
                 f"- Analysis: `{analysis_duration:.2f}s`\n"
+            )
+            if extraction:
+                extraction_timings = extraction.timings
+                timing_report += (
+                    f"  - Frame extraction (`{extraction.strategy}`, {len(extraction.timestamps)} frames): "
+                    f"`{extraction_timings['total']:.2f}s`\n"
+                )
+                stages = [
+                    f"{label}: `{extraction_timings[key]:.2f}s`"
+                    for label, key in (("Decode", extraction.strategy), ("Select", "select"), ("Encode", "encode"))
+                    if key in extraction_timings
+                ]
+                if stages:
+                    timing_report += f"    - {', '.join(stages)}\n"
+                if "overlap" in extraction_timings:
+                    timing_report += (
+                        f"    - Pipelined: first frame after `{extraction_timings['first_frame']:.2f}s`, "
+                        f"stages overlapped for `{extraction_timings['overlap']:.2f}s`\n"
+                    )
+                if extraction.segments:
+                    timing_report += f"  - Segments: {len(extraction.segments)}, analyzed in parallel and merged\n"
+            payload = extraction.payload_report if extraction else None
+            if payload:
+                timing_report += f"  - Payload: {payload['images']} images, `{payload['payload_bytes'] / 1024:.0f} KiB`\n"
+            timing_report += (
                 f"**- Total: `{total_duration:.2f}s`**"
             )
-            tasks[task_id]["result"] = reply_text + timing_report
-        else:
-            tasks[task_id]["result"] = reply_text
+            result = reply_text + timing_report
+        outcome = "completed" if analyzer.description else "failed"
+        await flight.finish(
+            analyzer, status="completed", result=result, usage=analyzer.usage,
+            timings=_finish_timings(flight, timings, outcome), **report,
+        )
 
+    except (VideoRejected, MediaQuotaExceeded) as e:
+        flight.update(status="failed", result=str(e), timings=_finish_timings(flight, timings, "rejected"))
     except Exception as e:
-        print(f"An unexpected error occurred during analysis for task {task_id}: {e}")
-        tasks[task_id]["status"] = "failed"
-        tasks[task_id]["result"] = f"An unexpected error occurred: {e}"
+        print(f"An unexpected error occurred during analysis for {video_key}: {e}")
+        flight.update(
+            status="failed", result=f"An unexpected error occurred: {e}",
+            timings=_finish_timings(flight, timings, "failed"),
+        )
     finally:
-        # 5. Clean up the downloaded file
-        if video_filename:
+        await flight.drain()
+        await state.call(state.end_flight, video_key, flight.task_id)
+        # 5. Clean up the downloaded file, with any partial files yt-dlp left next to it
+        if reservation:
             # Run synchronous remove in a thread
-            await asyncio.to_thread(remove_video, video_filename)
+            await asyncio.to_thread(reservation.release)
+
+async def run_job(job: dict):
+    """
+    Runs one queued analysis job, in the API process or in a worker.py process.
+    """
+    await run_analysis(AnalysisFlight(job["video_key"], job["task_id"]), job["video_url"])
 
 # --- Background Task for Cleanup ---
 async def cleanup_old_tasks():
     """
-    Periodically cleans up tasks and analyzers that are older than a certain threshold.
+    Periodically cleans up tasks older than an hour and follow-up sessions past their TTL.
     """
     while True:
-        await asyncio.sleep(3600)  # Run every hour
-        now = time.time()
-        task_ids_to_delete = []
-        for task_id, task_data in tasks.items():
-            # Check if 'start_time' exists and if the task is older than 1 hour
-            if "start_time" in task_data and (now - task_data["start_time"]) > 3600:
-                task_ids_to_delete.append(task_id)
-
-        for task_id in task_ids_to_delete:
-            if task_id in tasks:
-                del tasks[task_id]
-            if task_id in analyzers:
-                del analyzers[task_id]
-        if task_ids_to_delete:
-            print(f"Cleaned up {len(task_ids_to_delete)} old tasks.")
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+        # Tasks older than 1 hour, with their events
+        deleted = await state.call(state.delete_tasks, time.time() - 3600)
+        if deleted:
+            print(f"Cleaned up {deleted} old tasks.")
+        expired = await asyncio.to_thread(sessions.expire)
+        if expired:
+            print(f"Expired {expired} idle follow-up sessions.")
+        # Downloads of worker processes that died since startup
+        await asyncio.to_thread(media_store.sweep)
 
 # --- API Endpoints ---
 @app.post("/analyze")
 async def analyze_video(request: AnalyzeRequest):
     task_id = str(uuid.uuid4())
-    tasks[task_id] = {"status": "pending", "result": None, "start_time": time.time()}
-    asyncio.create_task(run_analysis(task_id, request.video_url))
-    return {"task_id": task_id, "message": "Video analysis started."}
+    await state.call(state.create_task, task_id, {"status": "pending", "result": None, "start_time": time.time()})
+    video_key = await asyncio.to_thread(canonical_video_key, request.video_url)
+    if result_cache and await _answer_from_cache(task_id, video_key):
+        return {"task_id": task_id, "message": "Video analysis served from the cache."}
+
+    # Concurrent requests for the same video share one download and one model call
+    leader = await state.call(state.start_flight, video_key, task_id)
+    if leader != task_id:
+        return {"task_id": task_id, "message": "Video analysis already in progress; joined it."}
+
+    job = {
+        "task_id": task_id, "video_url": request.video_url, "video_key": video_key,
+        "user_id": request.user_id, "priority": request.priority, "enqueued_at": time.time(),
+    }
+    # Written before the job is queued, so a worker's first status cannot precede it
+    await state.call(state.update_task, task_id, {"job_id": task_id})
+    await state.call(state.append_events, task_id, [("status", "pending")])
+    try:
+        await state.call(state.enqueue, job)
+    except QueueFull as e:
+        # Tasks that joined in the meantime fail along with this one
+        error = "Too many videos are being analyzed right now. Please try again later."
+        await state.call(state.update_task, task_id, {"status": "failed", "result": error})
+        await state.call(state.append_events, task_id, [("done", {"status": "failed", "result": error})])
+        await state.call(state.end_flight, video_key, task_id)
+        return JSONResponse(
+            status_code=429,
+            content={"error": error, "retry_after": e.retry_after},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return {"task_id": task_id, "message": "Video analysis queued."}
 
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    task = tasks.get(task_id)
+    task = await state.call(state.get_task, task_id)
     if not task:
         return {"error": "Task not found"}
-    return {"task_id": task_id, "status": task["status"]}
+    response = {"task_id": task_id, "status": task["status"]}
+    queued = await state.call(state.queue_info, task["job_id"]) if "job_id" in task else None
+    if queued:
+        response["queue"] = {
+            "position": queued["position"],
+            "depth": (await state.call(state.queue_stats))["depth"],
+            "wait_seconds": queued["wait_seconds"],
+        }
+    for key in ("coalesced", "queue_wait_seconds", "timings", "cache", "extraction", "payload", "usage", "segments"):
+        if key in task:
+            response[key] = task[key]
+    return response
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Stage latency histograms, token usage and saturation gauges of this process, in
+    the Prometheus text format.
+    """
+    return Response(await asyncio.to_thread(metrics.render), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/stats/extraction")
+async def get_extraction_stats():
+    """
+    Cumulative runs, frames and decode seconds for each frame extraction strategy.
+    """
+    return strategy_stats()
+
+@app.get("/stats/queue")
+async def get_queue_stats():
+    """
+    Queue depth and wait times of the analysis queue, and this process's per-stage concurrency.
+    """
+    return {**await state.call(state.queue_stats), "backend": type(state).__name__, "stages": stage_limits.stats()}
+
+@app.get("/stats/cache")
+async def get_cache_stats():
+    """
+    Hit/miss counters and size of the result cache.
+    """
+    if not result_cache:
+        return {"enabled": False}
+    return {"enabled": True, **await asyncio.to_thread(result_cache.stats)}
+
+@app.get("/stats/sessions")
+async def get_session_stats():
+    """
+    Memory use, spills and restores of the follow-up session store.
+    """
+    return await asyncio.to_thread(sessions.stats)
+
+@app.get("/stats/prompt-cache")
+async def get_prompt_cache_stats():
+    """
+    Per model: follow-ups sent with all frames, how many the provider served from its
+    prompt cache, and whether cache hints were rejected.
+    """
+    return prompt_cache_stats()
+
+@app.get("/stats/media")
+async def get_media_stats():
+    """
+    Disk use of downloads against the quota, across all processes sharing MEDIA_DIR.
+    """
+    return await asyncio.to_thread(media_store.stats)
+
+@app.get("/stats/metadata")
+async def get_metadata_stats():
+    """
+    Hits, misses and size of the video metadata cache.
+    """
+    return metadata_cache.stats()
 
 @app.get("/result/{task_id}")
-async def get_result(task_id: str):
-    task = tasks.get(task_id)
+async def get_result(task_id: str, wait: float = 0):
+    """
+    Returns the result of a task. With `wait`, holds the request open for up to that
+    many seconds (capped at MAX_RESULT_WAIT) until the task finishes.
+    """
+    task = await state.call(state.get_task, task_id)
     if not task:
         return {"error": "Task not found"}
+    if wait > 0 and task["status"] not in ("completed", "failed"):
+        deadline = time.monotonic() + min(wait, MAX_RESULT_WAIT)
+        seen = 0
+        while (remaining := deadline - time.monotonic()) > 0:
+            events = await state.wait_events(task_id, seen, remaining)
+            seen += len(events)
+            if any(kind == "done" for kind, _ in events):
+                break
+        task = await state.call(state.get_task, task_id) or task
     if task["status"] != "completed":
         return {"error": f"Task is still in progress with status: {task['status']}"}
     return {"task_id": task_id, "status": task["status"], "result": task["result"]}
 
+@app.get("/stream/{task_id}")
+async def stream_result(task_id: str):
+    """
+    Server-sent events with the analysis text as the model writes it: "delta" events
+    carry new text, and a final "done" event carries the status and complete result.
+    """
+    if not await state.call(state.get_task, task_id):
+        return {"error": "Task not found"}
+    return _sse_response(_follow_task(task_id))
+
+@app.get("/events/{task_id}")
+async def task_events(task_id: str):
+    """
+    Server-sent events for every state change of a task: "status" events on each
+    transition, "delta" events with the analysis text as it is written, and a final
+    "done" event with the status and complete result.
+    """
+    if not await state.call(state.get_task, task_id):
+        return {"error": "Task not found"}
+    return _sse_response(_follow_task(task_id, kinds=("status", "delta")))
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: AskRequest):
+    """
+    Like /ask, but streams the answer as server-sent events in the same format as /stream.
+    """
+    analyzer = await _load_analyzer(request.task_id)
+    if not analyzer:
+        return {"error": "Analyzer not found for this task. The task may have failed, not exist, or you need to analyze a video first."}
+
+    stream = TaskStream()
+
+    async def answer():
+        try:
+            reply = await analyzer.ask_question(request.question, on_delta=stream.append)
+            if not reply.startswith("Error:"):
+                await _record_follow_up(request.task_id, analyzer)
+                await _save_session(request.task_id, analyzer)
+            stream.close("failed" if reply.startswith("Error:") else "completed", reply)
+        except Exception as e:
+            print(f"Error during streamed follow-up for task {request.task_id}: {e}")
+            stream.close("failed", f"Could not get a response. {e}")
+
+    stream.task = asyncio.create_task(answer())
+    return _sse_response(stream.follow())
+
 @app.post("/ask")
 async def ask_question(request: AskRequest):
     task_id = request.task_id
     question = request.question
 
-    analyzer = analyzers.get(task_id)
+    analyzer = await _load_analyzer(task_id)
     if not analyzer:
         return {"error": "Analyzer not found for this task. The task may have failed, not exist, or you need to analyze a video first."}
 
     try:
         # Running async function in a sync context from the main thread
         reply = await analyzer.ask_question(question)
+        if not reply.startswith("Error:"):
+            await _record_follow_up(task_id, analyzer)
+            await _save_session(task_id, analyzer)
         return {"task_id": task_id, "answer": reply}
     except Exception as e:
         print(f"Error during follow-up for task {task_id}: {e}")
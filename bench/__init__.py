@@ -0,0 +1,5 @@
+"""
+Benchmarks and load tests that run offline: synthetic videos, a fake OpenAI-compatible
+server, and stand-ins for yt-dlp and Discord. Run the modules from the repository root,
+e.g. `python -m bench.load` or `python -m bench.micro`.
+"""
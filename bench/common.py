@@ -0,0 +1,194 @@
+import datetime
+import json
+import math
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+# Generated videos are cached here between runs
+MEDIA_DIR = os.getenv("BENCH_MEDIA_DIR", os.path.join(BENCH_DIR, "media"))
+RESULTS_DIR = os.getenv("BENCH_RESULTS_DIR", os.path.join(BENCH_DIR, "results"))
+# Bumped whenever the layout of a result file changes, so compare.py can refuse mismatches
+RESULT_SCHEMA = 1
+
+
+def summarize(values) -> dict:
+    """
+    Count, mean, nearest-rank p50/p95/p99 and max of a list of numbers. The
+    statistics are None when there are no values.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+
+    def rank(percent):
+        return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 6),
+        "p50": round(rank(50), 6),
+        "p95": round(rank(95), 6),
+        "p99": round(rank(99), 6),
+        "max": round(ordered[-1], 6),
+    }
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# --- Memory ---
+def _children(pid: int):
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def tree_rss(pid: int) -> int:
+    """
+    Resident memory of a process and all its descendants (e.g. the extraction pool), in bytes.
+    Reads /proc, so it is 0 on systems without it.
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += _rss(current)
+        pending.extend(_children(current))
+    return total
+
+def own_peak_rss() -> int:
+    """
+    Peak resident memory of this process so far, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """
+    Samples the memory of a process tree in a background thread and keeps the peak
+    for each named phase, e.g. `with sampler.phase("analyze"): ...`.
+    """
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peaks = {}
+        self._current = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            phase = self._current
+            if phase:
+                self.peaks[phase] = max(self.peaks.get(phase, 0), tree_rss(self.pid))
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @contextmanager
+    def phase(self, name: str):
+        self.peaks[name] = tree_rss(self.pid)
+        self._current = name
+        try:
+            yield
+        finally:
+            self._current = None
+            self.peaks[name] = max(self.peaks[name], tree_rss(self.pid))
+
+
+# --- Results ---
+def _git(*args):
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=REPO_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def environment() -> dict:
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def write_result(kind: str, label: str, config: dict, results: dict, path: str = None) -> str:
+    """
+    Writes one benchmark run as JSON: the environment it ran in, its configuration and
+    its results. Returns the path; by default a new file in RESULTS_DIR.
+    """
+    created = datetime.datetime.now(datetime.timezone.utc)
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = f"{kind}-{label}" if label else kind
+        path = os.path.join(RESULTS_DIR, f"{name}-{created:%Y%m%dT%H%M%SZ}.json")
+    document = {
+        "schema": RESULT_SCHEMA,
+        "kind": kind,
+        "label": label,
+        "created": created.isoformat(timespec="seconds"),
+        "environment": environment(),
+        "config": config,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return path
+
+def print_summaries(title: str, summaries: dict, unit: str = "s", scale: float = 1.0):
+    """
+    Prints {name: summarize(...)} as an aligned table, with values multiplied by `scale`.
+    """
+    labels = {name: f"{name} ({unit})" for name in summaries}
+    width = max([len(label) for label in labels.values()] + [10])
+    print(f"\n{title}")
+    print(f"  {'':{width}} {'count':>6} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}")
+    for name, summary in summaries.items():
+        cells = [
+            f"{summary[key] * scale:>10.3f}" if summary[key] is not None else f"{'-':>10}"
+            for key in ("p50", "p95", "p99", "max")
+        ]
+        print(f"  {labels[name]:{width}} {summary['count']:>6} {' '.join(cells)}")
+
+def wait_for(check, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return
+        time.sleep(0.1)
+    raise TimeoutError(f"Timed out waiting for {what}")
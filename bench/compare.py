@@ -0,0 +1,67 @@
+import argparse
+import json
+import sys
+
+from bench.common import RESULT_SCHEMA
+
+# Leaf names where a larger value is better; every other compared number is a cost
+HIGHER_IS_BETTER = ("throughput_per_second",)
+# Leaf names compared at all: latency statistics, memory and throughput
+COMPARED = ("mean", "p50", "p95", "p99", "peak_rss_bytes", "idle_rss_bytes", "progressive_seconds", *HIGHER_IS_BETTER)
+
+
+def _leaves(node, path=()):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _leaves(value, (*path, key))
+    elif isinstance(node, (int, float)) and not isinstance(node, bool):
+        yield path, node
+
+def compare(baseline: dict, current: dict, threshold: float):
+    """
+    Yields (path, baseline, current, relative change, regressed) for every compared
+    number present in both results. A change counts as a regression when it is worse
+    than `threshold` (e.g. 0.1 for 10%).
+    """
+    current_leaves = dict(_leaves(current["results"]))
+    for path, old in _leaves(baseline["results"]):
+        if path[-1] not in COMPARED or path not in current_leaves:
+            continue
+        new = current_leaves[path]
+        change = (new - old) / old if old else 0.0
+        worse = -change if path[-1] in HIGHER_IS_BETTER else change
+        yield path, old, new, change, worse > threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two benchmark result files and flags regressions.")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression.")
+    parser.add_argument("--all", action="store_true", help="List every compared value, not only regressions.")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    for document, path in ((baseline, args.baseline), (current, args.current)):
+        if document.get("schema") != RESULT_SCHEMA:
+            sys.exit(f"{path} uses result schema {document.get('schema')}, expected {RESULT_SCHEMA}")
+    if baseline["kind"] != current["kind"]:
+        sys.exit(f"Cannot compare a {baseline['kind']} result with a {current['kind']} result")
+    if baseline["config"] != current["config"]:
+        print("Warning: the runs used different configurations.")
+
+    regressions = 0
+    for path, old, new, change, regressed in compare(baseline, current, args.threshold):
+        regressions += regressed
+        if regressed or args.all:
+            marker = "REGRESSED" if regressed else ""
+            print(f"{'.'.join(path):70} {old:>14.4f} {new:>14.4f} {change:>+8.1%} {marker}")
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
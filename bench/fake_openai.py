@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Rough prompt token cost of one image and of the text around it, for plausible usage numbers
+IMAGE_TOKENS = 765
+CHARS_PER_TOKEN = 4
+
+
+class FakeModel:
+    """
+    Latency and failure behaviour of the fake chat completions endpoint.
+    `latency` is the time before the first token, `token_delay` the time between tokens.
+    A fraction `error_rate` of requests is answered with a 429 before any output.
+    """
+    def __init__(self, latency: float = 1.0, token_delay: float = 0.01, tokens: int = 200,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.rejected = 0
+        self.images = 0
+
+
+def _prompt_tokens(messages) -> tuple:
+    images = 0
+    characters = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            characters += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                images += 1
+            else:
+                characters += len(part.get("text", ""))
+    return images * IMAGE_TOKENS + characters // CHARS_PER_TOKEN, images
+
+def _chunk(model: str, delta: dict = None, finish_reason=None, usage=None) -> str:
+    body = {
+        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}],
+    }
+    if usage:
+        body["usage"] = usage
+    return f"data: {json.dumps(body)}\n\n"
+
+def create_app(fake: FakeModel) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        fake.requests += 1
+        if fake.random.random() < fake.error_rate:
+            fake.rejected += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached (fake)", "type": "rate_limit"}},
+                status_code=429, headers={"Retry-After": "0.2"},
+            )
+        prompt_tokens, images = _prompt_tokens(body.get("messages", []))
+        fake.images += images
+        completion_tokens = min(fake.tokens, body.get("max_tokens") or fake.tokens)
+        words = [f"word{i} " for i in range(completion_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        model = body.get("model", "fake")
+
+        if body.get("stream"):
+            async def events():
+                await asyncio.sleep(fake.latency)
+                yield _chunk(model, {"role": "assistant", "content": ""})
+                for word in words:
+                    yield _chunk(model, {"content": word})
+                    if fake.token_delay:
+                        await asyncio.sleep(fake.token_delay)
+                yield _chunk(model, finish_reason="stop")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    yield _chunk(model, usage=usage)
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(fake.latency + fake.token_delay * completion_tokens)
+        return {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": fake.requests, "rejected": fake.rejected, "images": fake.images}
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A local OpenAI-compatible chat completions server with fixed latency.")
+    parser.add_argument("--port", type=int, default=8911)
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds before the first token.")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Seconds between streamed tokens.")
+    parser.add_argument("--tokens", type=int, default=200, help="Completion length in tokens.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429.")
+    args = parser.parse_args()
+    fake = FakeModel(args.latency, args.token_delay, args.tokens, args.error_rate)
+    uvicorn.run(create_app(fake), host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import os
+import shutil
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import cv2
+
+from bench.common import MEDIA_DIR
+from download_video import DownloadPlan, StreamSource, check_limits
+
+# Benchmark URLs look like http://bench.invalid/<file in MEDIA_DIR>?n=<request number>
+FAKE_HOST = "bench.invalid"
+
+
+def fake_url(path: str, request: int = None) -> str:
+    url = f"http://{FAKE_HOST}/{os.path.basename(path)}"
+    return url if request is None else f"{url}?n={request}"
+
+
+# --- yt-dlp stand-in ---
+class FakeResolver:
+    """
+    Replaces yt-dlp for benchmark URLs: they resolve to local synthetic videos, and a
+    download copies the file after a simulated delay. `latency` is added to every metadata
+    fetch, and to downloads made without one; `bandwidth` (bytes per second, 0 for
+    unlimited) paces downloads. Resolving after preflight() is free, as with the metadata cache.
+    """
+    def __init__(self, media_dir: str = MEDIA_DIR, latency: float = 0.0, bandwidth: float = 0.0):
+        self.media_dir = media_dir
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._probes = {}
+
+    def path(self, url: str) -> str:
+        parts = urlsplit(url)
+        if parts.hostname != FAKE_HOST:
+            raise ValueError(f"Not a benchmark URL: {url}")
+        path = os.path.join(self.media_dir, os.path.basename(parts.path))
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path
+
+    def _probe(self, path: str):
+        if path not in self._probes:
+            capture = cv2.VideoCapture(path)
+            try:
+                fps = capture.get(cv2.CAP_PROP_FPS) or 0
+                frames = capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+                self._probes[path] = (frames / fps if fps else None, int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            finally:
+                capture.release()
+        return self._probes[path]
+
+    def _info(self, path: str) -> dict:
+        duration, height = self._probe(path)
+        return {"url": path, "duration": duration, "height": height, "filesize": os.path.getsize(path)}
+
+    def preflight(self, url):
+        try:
+            path = self.path(url)
+        except (ValueError, FileNotFoundError) as e:
+            print(f"Error fetching video metadata: {e}")
+            return None
+        time.sleep(self.latency)
+        info = self._info(path)
+        check_limits(info, check_size=False)
+        return info
+
+    def probe_download(self, url, mode: str = None, frame_size: int = 0):
+        try:
+            info = self._info(self.path(url))
+        except (ValueError, FileNotFoundError) as e:
+            print(f"Error fetching video metadata: {e}")
+            return None
+        check_limits(info)
+        return DownloadPlan(info)
+
+    def download_video(self, url, mode: str = None, filename: str = None, info: dict = None):
+        try:
+            path = self.path(url)
+        except (ValueError, FileNotFoundError) as e:
+            print(f"Error downloading video: {e}")
+            return None
+        # A probed download skips the metadata round trip, as yt-dlp would
+        delay = (0 if info else self.latency) + (os.path.getsize(path) / self.bandwidth if self.bandwidth else 0)
+        time.sleep(delay)
+        filename = filename or f"temp_vid_{uuid.uuid4()}{os.path.splitext(path)[1]}"
+        shutil.copyfile(path, filename)
+        return filename
+
+    def resolve_video(self, url, max_height: int = None, frame_size: int = 0):
+        try:
+            path = self.path(url)
+        except (ValueError, FileNotFoundError) as e:
+            print(f"Error resolving stream URL: {e}")
+            return None
+        info = self._info(path)
+        check_limits(info, check_size=False)
+        return StreamSource(path, {}, info["duration"], info["height"], info)
+
+    def resolve_stream(self, url, max_height: int = None, frame_size: int = 0):
+        return self.resolve_video(url, max_height, frame_size)
+
+    def install(self, module):
+        """
+        Points the download functions imported by `module` (e.g. api) at this resolver.
+        """
+        for name in ("preflight", "probe_download", "download_video", "resolve_video", "resolve_stream"):
+            setattr(module, name, getattr(self, name))
+
+
+# --- Discord stand-in ---
+_ids = itertools.count(1)
+
+class FakeUser:
+    def __init__(self):
+        self.id = next(_ids)
+
+
+class FakeChannel:
+    def __init__(self, latency: float = 0.0):
+        self.id = next(_ids)
+        self.latency = latency
+        self.sends = 0
+        self.edits = 0
+        self.deletes = 0
+
+    async def send(self, content: str):
+        await asyncio.sleep(self.latency)
+        self.sends += 1
+        return FakeMessage(content, self)
+
+
+class FakeMessage:
+    """
+    The parts of discord.Message the bot's reply code uses. Every send, edit and delete waits
+    `channel.latency` seconds, as a round trip to Discord would, and is counted.
+    """
+    def __init__(self, content: str = "", channel: FakeChannel = None, author=None):
+        self.id = next(_ids)
+        self.content = content
+        self.channel = channel or FakeChannel()
+        self.author = author or FakeUser()
+
+    async def reply(self, content: str):
+        return await self.channel.send(content)
+
+    async def edit(self, content: str = None):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.edits += 1
+        self.content = content
+        return self
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.deletes += 1
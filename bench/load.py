@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.common import (
+    MEDIA_DIR, REPO_DIR, RssSampler, free_port, print_summaries, summarize, tree_rss, wait_for, write_result,
+)
+from bench.fakes import FakeChannel, FakeMessage, fake_url
+from bench.videos import ensure_video, parse_resolution
+
+FOLLOW_UP_QUESTION = "What happens at the start of the video?"
+
+
+class Recorder:
+    """
+    Latencies and counts collected while a phase runs.
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.counts = {}
+
+    def add(self, name: str, seconds: float):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def count(self, name: str, amount: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    async def timed(self, name: str, request):
+        started = time.perf_counter()
+        try:
+            return await request
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def summaries(self, prefix: str = ""):
+        return {
+            name[len(prefix):]: summarize(values)
+            for name, values in sorted(self.latencies.items()) if name.startswith(prefix)
+        }
+
+
+async def _run_all(jobs, concurrency: int):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with limit:
+            return await job
+
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+async def analyze_via_api(client: httpx.AsyncClient, url: str, recorder: Recorder, status_interval: float):
+    """
+    Submits one video and polls /status until it finishes. Returns the task ID if it completed.
+    """
+    started = time.perf_counter()
+    response = await recorder.timed("submit", client.post("/analyze", json={"video_url": url, "user_id": url}))
+    if response.status_code == 429:
+        recorder.count("rejected")
+        return None
+    task_id = response.json()["task_id"]
+    while True:
+        status = (await recorder.timed("status", client.get(f"/status/{task_id}"))).json()
+        if status.get("status") in ("completed", "failed"):
+            break
+        await asyncio.sleep(status_interval)
+    recorder.add("end_to_end", time.perf_counter() - started)
+    recorder.count(status["status"])
+
+    for name, seconds in (status.get("timings") or {}).items():
+        recorder.add(f"stage:{name}", seconds)
+    for name, seconds in ((status.get("extraction") or {}).get("timings") or {}).items():
+        recorder.add(f"extraction:{name}", seconds)
+    if status.get("payload"):
+        recorder.add("payload:bytes", status["payload"]["payload_bytes"])
+    return task_id if status["status"] == "completed" else None
+
+async def analyze_via_bot(url: str, recorder: Recorder, discord_latency: float):
+    """
+    Runs one video through the Discord bot's own reply code, with Discord replaced by
+    FakeMessage, so reply streaming and message edits are part of the measurement.
+    """
+    import bot
+    channel = FakeChannel(discord_latency)
+    started = time.perf_counter()
+    await bot.process_video_analysis(FakeMessage(url, channel), url)
+    recorder.add("end_to_end", time.perf_counter() - started)
+    recorder.count("discord_sends", channel.sends)
+    recorder.count("discord_edits", channel.edits)
+    recorder.count("discord_deletes", channel.deletes)
+    task_id = bot.channel_task_ids.get(channel.id)
+    recorder.count("completed" if task_id else "failed")
+    return task_id
+
+async def ask(client: httpx.AsyncClient, task_id: str, recorder: Recorder):
+    response = await recorder.timed("ask", client.post("/ask", json={"task_id": task_id, "question": FOLLOW_UP_QUESTION}))
+    answer = response.json()
+    recorder.count("failed" if "error" in answer or answer.get("answer", "").startswith("Error:") else "completed")
+
+
+def _start(command, env, cwd, log_path):
+    log = open(log_path, "w")
+    return subprocess.Popen(command, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT), log
+
+def _ready(url: str):
+    try:
+        return httpx.get(url, timeout=1).status_code < 500
+    except httpx.HTTPError:
+        return False
+
+def _phase_result(recorder: Recorder, seconds: float, requests: int, peak_rss: int) -> dict:
+    completed = recorder.counts.get("completed", 0)
+    return {
+        "requests": requests,
+        "counts": dict(sorted(recorder.counts.items())),
+        "seconds": round(seconds, 3),
+        "throughput_per_second": round(completed / seconds, 4) if seconds else None,
+        "latency": {name: summary for name, summary in recorder.summaries().items() if ":" not in name},
+        "stages": recorder.summaries("stage:"),
+        "extraction": recorder.summaries("extraction:"),
+        "payload_bytes": recorder.summaries("payload:").get("bytes"),
+        "peak_rss_bytes": peak_rss,
+    }
+
+async def run(args, api_url: str, api_pid: int, openai_url: str, videos: list) -> dict:
+    sampler = RssSampler(api_pid).start()
+    results = {"idle_rss_bytes": tree_rss(api_pid)}
+    try:
+        async with httpx.AsyncClient(base_url=api_url, timeout=None) as client:
+            urls = [
+                fake_url(videos[i % len(videos)], None if args.same_url else i) for i in range(args.requests)
+            ]
+            recorder = Recorder()
+            started = time.perf_counter()
+            with sampler.phase("analyze"):
+                if args.via_bot:
+                    import bot
+                    bot.api_client = client
+                    jobs = [analyze_via_bot(url, recorder, args.discord_latency) for url in urls]
+                else:
+                    jobs = [analyze_via_api(client, url, recorder, args.status_interval) for url in urls]
+                task_ids = await _run_all(jobs, args.concurrency)
+            results["analyze"] = _phase_result(
+                recorder, time.perf_counter() - started, args.requests, sampler.peaks["analyze"]
+            )
+
+            task_ids = [task_id for task_id in task_ids if task_id]
+            if args.asks and task_ids:
+                recorder = Recorder()
+                started = time.perf_counter()
+                with sampler.phase("ask"):
+                    await _run_all(
+                        [ask(client, task_id, recorder) for task_id in task_ids for _ in range(args.asks)],
+                        args.concurrency,
+                    )
+                results["ask"] = _phase_result(
+                    recorder, time.perf_counter() - started, len(task_ids) * args.asks, sampler.peaks["ask"]
+                )
+            async with httpx.AsyncClient(timeout=5) as model_client:
+                results["model"] = (await model_client.get(openai_url.removesuffix("/v1") + "/stats")).json()
+    finally:
+        sampler.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-tests /analyze, /status and /ask against local stand-ins for yt-dlp and the model API."
+    )
+    parser.add_argument("--requests", type=int, default=8, help="Videos to analyze.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once.")
+    parser.add_argument("--asks", type=int, default=1, help="Follow-up questions per completed analysis.")
+    parser.add_argument("--duration", type=float, nargs="+", default=[10], help="Video lengths in seconds.")
+    parser.add_argument("--resolution", nargs="+", default=["1280x720"])
+    parser.add_argument("--codec", default="mp4v")
+    parser.add_argument("--same-url", action="store_true", help="Request one URL repeatedly (coalescing).")
+    parser.add_argument("--cache", action="store_true",
+                        help="Keep the result cache on. Off by default, so repeated videos are analyzed every time.")
+    parser.add_argument("--status-interval", type=float, default=0.25, help="Seconds between /status polls.")
+    parser.add_argument("--via-bot", action="store_true", help="Drive requests through the bot's reply code.")
+    parser.add_argument("--discord-latency", type=float, default=0.1, help="Seconds per fake Discord send/edit.")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="Fake model seconds to first token.")
+    parser.add_argument("--model-token-delay", type=float, default=0.01)
+    parser.add_argument("--model-tokens", type=int, default=200)
+    parser.add_argument("--model-error-rate", type=float, default=0.0)
+    parser.add_argument("--download-latency", type=float, default=0.2)
+    parser.add_argument("--download-bandwidth", type=float, default=20e6, help="Simulated bytes/s; 0 for unlimited.")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the API, e.g. DOWNLOAD_MODE=stream. Repeatable.")
+    parser.add_argument("--label", help="Name of the run, used in the result file name.")
+    parser.add_argument("--output", help="Result file path (default: a new file in bench/results).")
+    args = parser.parse_args()
+
+    videos = []
+    for resolution in args.resolution:
+        for seconds in args.duration:
+            width, height = parse_resolution(resolution)
+            videos.append(ensure_video(seconds, width, height, codec=args.codec))
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    openai_port, api_port = free_port(), free_port()
+    openai_url = f"http://127.0.0.1:{openai_port}/v1"
+    api_url = f"http://127.0.0.1:{api_port}"
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])),
+        "DC_TOKEN": "bench", "OPENAI_API_KEY": "bench",
+        "CACHE_ENABLED": "true" if args.cache else "false",
+        **extra_env,
+    }
+    # The bot reads its settings at import time
+    os.environ.update({"DC_TOKEN": "bench", "OPENAI_API_KEY": "bench"})
+
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        try:
+            processes.append(_start([
+                sys.executable, "-m", "bench.fake_openai", "--port", str(openai_port),
+                "--latency", str(args.model_latency), "--token-delay", str(args.model_token_delay),
+                "--tokens", str(args.model_tokens), "--error-rate", str(args.model_error_rate),
+            ], env, workdir, os.path.join(workdir, "fake_openai.log")))
+            processes.append(_start([
+                sys.executable, "-m", "bench.serve", "--port", str(api_port), "--openai-url", openai_url,
+                "--media-dir", MEDIA_DIR, "--download-latency", str(args.download_latency),
+                "--download-bandwidth", str(args.download_bandwidth),
+            ], env, workdir, os.path.join(workdir, "api.log")))
+            wait_for(lambda: _ready(openai_url.removesuffix("/v1") + "/stats"), 30, "the fake model server")
+            wait_for(lambda: _ready(api_url + "/stats/queue"), 60, "the API")
+
+            results = asyncio.run(run(args, api_url, processes[1][0].pid, openai_url, videos))
+        except BaseException:
+            for name in ("fake_openai.log", "api.log"):
+                path = os.path.join(workdir, name)
+                if os.path.exists(path):
+                    with open(path) as f:
+                        sys.stderr.write(f"--- {name} ---\n{f.read()[-4000:]}")
+            raise
+        finally:
+            for process, log in processes:
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                log.close()
+
+    config = {
+        key: value for key, value in vars(args).items() if key not in ("output", "label", "env")
+    }
+    config["env"] = extra_env
+    config["videos"] = [os.path.basename(video) for video in videos]
+    path = write_result("load", args.label, config, results, args.output)
+
+    for phase in ("analyze", "ask"):
+        if phase in results:
+            phase_result = results[phase]
+            print(
+                f"\n== {phase}: {phase_result['counts']} in {phase_result['seconds']}s, "
+                f"{phase_result['throughput_per_second']}/s, peak RSS {phase_result['peak_rss_bytes'] / 2**20:.0f} MiB"
+            )
+            print_summaries("Request latency", phase_result["latency"])
+            if phase_result["stages"]:
+                print_summaries("Stages (from /status timings)", phase_result["stages"])
+            if phase_result["extraction"]:
+                print_summaries("Frame extraction", phase_result["extraction"])
+    print(f"\nResults written to {path}")
+
+
+if __name__ == "__main__":
+    main()
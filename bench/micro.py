@@ -0,0 +1,175 @@
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+from bench.common import own_peak_rss, print_summaries, summarize, write_result
+from bench.videos import CODECS, ensure_video, parse_resolution
+
+SPLIT_KINDS = ("prose", "code", "cjk", "long_lines", "emoji", "long_code")
+
+
+# --- Frame extraction ---
+def _frames_case(video: str, repeat: int, model_name: str) -> dict:
+    """
+    Runs VideoAnalyzer._process_video_frames on one video `repeat` times. Meant to run
+    in a fresh process, so the peak RSS it reports belongs to this case alone.
+    """
+    from analyze import VideoAnalyzer
+
+    analyzer = VideoAnalyzer(api_key="bench", model_name=model_name)
+    seconds = []
+    stages = {}
+    for _ in range(repeat):
+        started = time.perf_counter()
+        analyzer._process_video_frames(video)
+        seconds.append(time.perf_counter() - started)
+        for name, value in analyzer.extraction.timings.items():
+            stages.setdefault(name, []).append(value)
+    report = analyzer.extraction.payload_report or {}
+    return {
+        "strategy": analyzer.extraction.strategy,
+        "frames": len(analyzer.frames),
+        "payload_bytes": report.get("payload_bytes"),
+        "seconds": summarize(seconds),
+        "stages": {name: summarize(values) for name, values in stages.items()},
+        "peak_rss_bytes": own_peak_rss(),
+    }
+
+def bench_frames(videos, repeat: int, model_name: str) -> dict:
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for video in videos:
+        with context.Pool(1) as pool:
+            results[os.path.basename(video)] = pool.apply(_frames_case, (video, repeat, model_name))
+    return results
+
+
+# --- Message splitting ---
+def make_text(kind: str, size: int, seed: int = 0) -> str:
+    """
+    Generated reply text of about `size` characters: English prose, prose with fenced
+    code blocks, Traditional Chinese prose, prose with lines far over Discord's limit,
+    prose full of emoji outside the BMP and ZWJ sequences, or code blocks longer than a message.
+    """
+    rng = random.Random(seed)
+    words = ["video", "frame", "scene", "the", "camera", "moves", "to", "a", "person", "walking", "street", "light"]
+    if kind == "emoji":
+        words += ["🎬", "📹", "🇹🇼", "👩\u200d💻", "👍🏽", "🚶\u200d♂\ufe0f"]
+    lines = []
+    length = 0
+    while length < size:
+        if kind == "cjk":
+            line = "".join(rng.choice("影片中一個人在街上走著，鏡頭慢慢移動。燈光很亮") for _ in range(rng.randint(20, 60)))
+        elif kind == "long_lines":
+            line = " ".join(rng.choice(words) for _ in range(rng.randint(600, 1200)))
+        else:
+            line = " ".join(rng.choice(words) for _ in range(rng.randint(5, 20)))
+        if kind == "code" and rng.random() < 0.05:
+            block = ["```python", *(f"    frame_{i} = read({i})" for i in range(rng.randint(5, 40))), "```"]
+            lines.extend(block)
+            length += sum(len(item) + 1 for item in block)
+        elif kind == "long_code" and rng.random() < 0.2:
+            block = ["```python", *(f"    frame_{i} = read({i})" for i in range(rng.randint(100, 400))), "```"]
+            lines.extend(block)
+            length += sum(len(item) + 1 for item in block)
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+def _valid_chunk(chunk: str, max_length: int) -> bool:
+    from split import FENCE, message_length
+
+    fences = sum(1 for line in chunk.split("\n") if line.strip().startswith(FENCE))
+    return message_length(chunk) <= max_length and fences % 2 == 0
+
+def _time_split(text: str, repeat: int, stream_step: int):
+    from split import MessageSplitter, splitmsg
+
+    seconds = []
+    chunks = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        chunks = splitmsg(text)
+        seconds.append(time.perf_counter() - started)
+    # As the bot does while streaming: feed each delta, then render the chunks still open
+    started = time.perf_counter()
+    splitter = MessageSplitter()
+    for start in range(0, len(text), stream_step):
+        splitter.feed(text[start:start + stream_step])
+        splitter.pending()
+    splitter.finish()
+    progressive = time.perf_counter() - started
+    return seconds, chunks, progressive, splitter.chunks == chunks
+
+def bench_split(sizes, repeat: int, stream_step: int) -> dict:
+    from split import MAX_MESSAGE_LENGTH, message_length
+
+    results = {}
+    for kind in SPLIT_KINDS:
+        for size in sizes:
+            text = make_text(kind, size)
+            seconds, chunks, progressive, streamed_same = _time_split(text, repeat, stream_step)
+            results[f"{kind}_{size}"] = {
+                "characters": len(text),
+                "chunks": len(chunks),
+                "max_chunk_length": max((message_length(chunk) for chunk in chunks), default=0),
+                "valid": all(_valid_chunk(chunk, MAX_MESSAGE_LENGTH) for chunk in chunks),
+                "streamed_same": streamed_same,
+                "seconds": summarize(seconds),
+                "progressive_seconds": round(progressive, 6),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of frame extraction and message splitting.")
+    parser.add_argument("--suite", nargs="+", choices=("frames", "split"), default=["frames", "split"])
+    parser.add_argument("--duration", type=float, nargs="+", default=[10, 60], help="Video lengths in seconds.")
+    parser.add_argument("--resolution", nargs="+", default=["640x360", "1280x720"])
+    parser.add_argument("--codec", default="mp4v", choices=sorted(CODECS))
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL_NAME", "gpt-4o"), help="Sets the payload budget.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--split-sizes", type=int, nargs="+", default=[2000, 20000, 200000, 500000])
+    parser.add_argument("--split-repeat", type=int, default=20)
+    parser.add_argument("--stream-step", type=int, default=200, help="Characters per delta in the progressive split.")
+    parser.add_argument("--label", help="Name of the run, used in the result file name.")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = {}
+    if "frames" in args.suite:
+        videos = []
+        for resolution in args.resolution:
+            for seconds in args.duration:
+                width, height = parse_resolution(resolution)
+                videos.append(ensure_video(seconds, width, height, codec=args.codec))
+        results["frames"] = bench_frames(videos, args.repeat, args.model)
+        print_summaries("_process_video_frames", {name: case["seconds"] for name, case in results["frames"].items()})
+        for name, case in results["frames"].items():
+            print(
+                f"  {name}: {case['strategy']}, {case['frames']} frames, "
+                f"peak RSS {case['peak_rss_bytes'] / 2**20:.0f} MiB"
+            )
+    if "split" in args.suite:
+        results["split"] = bench_split(args.split_sizes, args.split_repeat, args.stream_step)
+        print_summaries("splitmsg", {name: case["seconds"] for name, case in results["split"].items()}, "ms", 1000)
+        for name, case in results["split"].items():
+            print(
+                f"  {name}: {case['chunks']} chunks, longest {case['max_chunk_length']}, "
+                f"{'valid' if case['valid'] and case['streamed_same'] else 'INVALID'}, "
+                f"progressive {case['progressive_seconds']:.3f}s"
+            )
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "label")}
+    config["env"] = {
+        name: os.environ[name]
+        for name in ("FRAME_STRATEGY", "FRAME_SELECTION", "FFMPEG_BIN", "PAYLOAD_BUDGET_BYTES", "PAYLOAD_TILE_GRID")
+        if name in os.environ
+    }
+    print(f"\nResults written to {write_result('micro', args.label, config, results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import argparse
+import os
+
+import uvicorn
+
+from bench.common import MEDIA_DIR
+from bench.fakes import FakeResolver
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the API with benchmark URLs resolved to local videos instead of through yt-dlp."
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--openai-url", default="http://127.0.0.1:8911/v1", help="Base URL of bench.fake_openai.")
+    parser.add_argument("--media-dir", default=MEDIA_DIR)
+    parser.add_argument("--download-latency", type=float, default=0.0, help="Seconds added to each resolve and download.")
+    parser.add_argument("--download-bandwidth", type=float, default=0.0, help="Simulated download speed in bytes/s.")
+    args = parser.parse_args()
+
+    # The API only needs these to be set; nothing reaches Discord or a real provider
+    os.environ.setdefault("DC_TOKEN", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["OPENAI_BASE_URL"] = args.openai_url
+
+    import api
+    FakeResolver(args.media_dir, args.download_latency, args.download_bandwidth).install(api)
+    uvicorn.run(api.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
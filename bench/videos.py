@@ -0,0 +1,98 @@
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+from bench.common import MEDIA_DIR
+
+# FourCC codes OpenCV can usually write, and the container each needs. "avc1" (H.264)
+# depends on how OpenCV was built and fails with an error when unavailable.
+CODECS = {"mp4v": ".mp4", "avc1": ".mp4", "MJPG": ".avi", "XVID": ".avi"}
+
+
+def video_name(seconds: float, width: int, height: int, fps: float = 30, codec: str = "mp4v") -> str:
+    return f"synthetic_{width}x{height}_{seconds:g}s_{fps:g}fps_{codec}{CODECS[codec]}"
+
+def _draw_frame(index: int, fps: float, width: int, height: int, scene_seconds: float, rng_seed: int):
+    """
+    One frame of a synthetic clip: a new background and set of shapes every
+    `scene_seconds` (a hard cut), with the shapes moving in between, so scene detection
+    and duplicate filtering have something real to work on.
+    """
+    scene = int(index / fps // scene_seconds)
+    rng = np.random.default_rng(rng_seed + scene)
+    background = rng.integers(0, 256, 3).tolist()
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:] = background
+    # A coarse gradient keeps the encoder from reducing scenes to flat colour
+    frame[:, :, 0] = np.clip(frame[:, :, 0].astype(np.int16) + np.linspace(0, 60, width, dtype=np.int16), 0, 255)
+
+    t = index / fps - scene * scene_seconds
+    for _ in range(4):
+        color = rng.integers(0, 256, 3).tolist()
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        dx, dy = rng.integers(-width // 6, width // 6 + 1), rng.integers(-height // 6, height // 6 + 1)
+        x, y = int(x0 + dx * t) % width, int(y0 + dy * t) % height
+        size = int(rng.integers(height // 12, height // 4))
+        if rng.random() < 0.5:
+            cv2.rectangle(frame, (x, y), (x + size, y + size), color, -1)
+        else:
+            cv2.circle(frame, (x, y), size // 2, color, -1)
+    cv2.putText(
+        frame, f"scene {scene} frame {index}", (width // 20, height // 10),
+        cv2.FONT_HERSHEY_SIMPLEX, height / 720, (255, 255, 255), max(1, height // 360),
+    )
+    return frame
+
+def make_video(path: str, seconds: float = 10, width: int = 1280, height: int = 720, fps: float = 30,
+               codec: str = "mp4v", scene_seconds: float = 2.0, seed: int = 0) -> str:
+    """
+    Writes a synthetic clip of the given length, resolution and codec. Returns `path`.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"OpenCV cannot write {codec} video; try another codec ({', '.join(CODECS)})")
+    try:
+        for index in range(round(seconds * fps)):
+            writer.write(_draw_frame(index, fps, width, height, scene_seconds, seed))
+    finally:
+        writer.release()
+    return path
+
+def ensure_video(seconds: float = 10, width: int = 1280, height: int = 720, fps: float = 30,
+                 codec: str = "mp4v", media_dir: str = MEDIA_DIR) -> str:
+    """
+    Returns the path of a cached synthetic clip with these properties, generating it first if needed.
+    """
+    os.makedirs(media_dir, exist_ok=True)
+    path = os.path.join(media_dir, video_name(seconds, width, height, fps, codec))
+    if not os.path.exists(path):
+        # Written under another name first, so an interrupted run leaves no truncated clip behind
+        partial = path + ".part" + CODECS[codec]
+        try:
+            make_video(partial, seconds, width, height, fps, codec)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+    return path
+
+def parse_resolution(value: str):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic benchmark videos (every combination of the options).")
+    parser.add_argument("--duration", type=float, nargs="+", default=[10], help="Lengths in seconds.")
+    parser.add_argument("--resolution", nargs="+", default=["1280x720"], help="Sizes such as 640x360.")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--codec", nargs="+", default=["mp4v"], choices=sorted(CODECS))
+    parser.add_argument("--media-dir", default=MEDIA_DIR)
+    args = parser.parse_args()
+    for codec in args.codec:
+        for resolution in args.resolution:
+            for seconds in args.duration:
+                width, height = parse_resolution(resolution)
+                print(ensure_video(seconds, width, height, args.fps, codec, args.media_dir))
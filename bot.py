@@ -4,82 +4,230 @@ import asyncio
 import os
 import httpx
 import json
+import time
 
+import metrics
 from load_config import discord_token
-from split import splitmsg
+from split import MessageSplitter
 
 LOADING_EMOJI = "<a:loading:1281561134968606750>"
 API_BASE_URL = "http://127.0.0.1:8000" # Make sure this matches your API server address
 
 client = discord.Client(intents=discord.Intents.all())
+# One HTTP client for every API call, so requests reuse the same keep-alive connection
+api_client = httpx.AsyncClient(base_url=API_BASE_URL, timeout=None)
 # Maps a channel ID to the last successful task_id for follow-up questions
 channel_task_ids = {}
 
+# Minimum seconds between edits of a streaming reply; Discord allows about 5 edits per 5 seconds
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Port for the bot's GET /metrics; 0 turns it off
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))
+
+# --- Metrics ---
+REPLY_FLUSH_SECONDS = metrics.Histogram(
+    "discord_reply_flush_seconds", "Time to send or edit the Discord messages of a reply once."
+)
+DISCORD_MESSAGES = metrics.Counter("discord_messages_total", "Discord messages sent, edited or deleted for replies.", ["action"])
+FIRST_TEXT_SECONDS = metrics.Histogram(
+    "discord_first_text_seconds", "Time from a request until its first text shows in Discord, by kind.", ["kind"]
+)
+REPLY_SECONDS = metrics.Histogram(
+    "discord_reply_seconds", "Time from a request until its reply is complete, by kind and outcome.", ["kind", "outcome"]
+)
+_metrics_server = None
+
+class ProgressiveReply:
+    """
+    Shows streamed text in Discord as it arrives. The newest message is edited at most
+    once per STREAM_EDIT_INTERVAL, and a new message is started whenever the text rolls
+    over to another 2000-character chunk.
+
+    Deltas go straight into a MessageSplitter, so each flush only re-renders the chunks
+    that are still open instead of splitting the whole text again.
+    """
+    def __init__(self, message, placeholder=None, kind: str = "reply"):
+        self.message = message
+        self.messages = [placeholder] if placeholder else []
+        self.sent = [None] * len(self.messages)
+        self.kind = kind
+        self.splitter = MessageSplitter()
+        self._pieces = []
+        # Chunks the splitter has finalized and that have been sent in their final form
+        self._settled = 0
+        self._started = time.monotonic()
+        self._shown = False
+        self._last_flush = 0.0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._pieces)
+
+    async def feed(self, delta: str):
+        self._pieces.append(delta)
+        self.splitter.feed(delta)
+        if time.monotonic() - self._last_flush >= STREAM_EDIT_INTERVAL:
+            await self._flush()
+
+    async def finish(self, text: str = None):
+        """
+        Writes the final text (or whatever has been fed so far) without waiting for the rate limit.
+        """
+        if text is not None:
+            streamed = self.text
+            if text.startswith(streamed):
+                self.splitter.feed(text[len(streamed):])
+            else:
+                # The final text differs from the stream: split it from the start
+                self.splitter = MessageSplitter()
+                self.splitter.feed(text)
+                self._settled = 0
+            self._pieces = [text]
+        self.splitter.finish()
+        await self._flush(final=True)
+
+    async def _flush(self, final: bool = False):
+        self._last_flush = time.monotonic()
+        settled = self.splitter.chunks
+        chunks = settled[self._settled:] + self.splitter.pending()
+        count = self._settled + len(chunks)
+        for i, chunk in enumerate(chunks, self._settled):
+            if i < len(self.messages):
+                # Only chunks whose text changed since the last flush need editing again
+                if self.sent[i] != chunk:
+                    await self.messages[i].edit(content=chunk)
+                    self.sent[i] = chunk
+                    DISCORD_MESSAGES.inc(action="edit")
+            else:
+                if i == 0:
+                    sent_message = await self.message.reply(chunk)
+                else:
+                    sent_message = await self.message.channel.send(chunk)
+                self.messages.append(sent_message)
+                self.sent.append(chunk)
+                DISCORD_MESSAGES.inc(action="send")
+        if final and chunks:
+            # A final text shorter than the stream leaves messages with stale text behind
+            for surplus in self.messages[count:]:
+                await surplus.delete()
+                DISCORD_MESSAGES.inc(action="delete")
+            del self.messages[count:]
+            del self.sent[count:]
+        self._settled = len(settled)
+        REPLY_FLUSH_SECONDS.observe(time.monotonic() - self._last_flush)
+        if not self._shown and any(self._pieces):
+            self._shown = True
+            FIRST_TEXT_SECONDS.observe(time.monotonic() - self._started, kind=self.kind)
+
+    def record(self, outcome: str):
+        """
+        Records how long the whole reply took, once it has finished or failed.
+        """
+        REPLY_SECONDS.observe(time.monotonic() - self._started, kind=self.kind, outcome=outcome)
+
 async def send_reply_chunks(message, text):
     """
     Splits a long message into chunks and sends them as replies.
     """
-    reply_chunks = await splitmsg(text)
-    for i, chunk in enumerate(reply_chunks):
-        if i == 0:
-            await message.reply(chunk)
-        else:
-            await message.channel.send(chunk)
+    await ProgressiveReply(message).finish(text)
+
+async def iter_sse(response):
+    """
+    Yields (event, data) pairs from a server-sent events response with JSON data lines.
+    """
+    event = "message"
+    async for line in response.aiter_lines():
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):].strip())
+            event = "message"
 
 async def process_video_analysis(message, url):
     """
-    Handles the video analysis process by calling the backend API.
+    Handles the video analysis process by calling the backend API and streaming the
+    model's description into the reply as it is written.
     """
     reply_msg = await message.reply(f"## {LOADING_EMOJI} Requesting video analysis...")
+    reply = ProgressiveReply(message, placeholder=reply_msg, kind="analysis")
     
     try:
-        async with httpx.AsyncClient(timeout=None) as http_client:
-            # 1. Start the analysis task
-            response = await http_client.post(f"{API_BASE_URL}/analyze", json={"video_url": url})
-            response.raise_for_status()
-            data = response.json()
-            task_id = data.get("task_id")
-
-            if not task_id:
-                await reply_msg.edit(content="❌ **API Error:** Could not start analysis task.")
-                return
-
-            # 2. Poll for the result
-            while True:
-                await asyncio.sleep(5) # Wait for 5 seconds before checking status
-                status_response = await http_client.get(f"{API_BASE_URL}/status/{task_id}")
-                status_response.raise_for_status()
-                status_data = status_response.json()
-                
-                current_status = status_data.get("status")
-                await reply_msg.edit(content=f"## {LOADING_EMOJI} Analysis in progress... (Status: {current_status})")
-
-                if current_status == "completed":
-                    result_response = await http_client.get(f"{API_BASE_URL}/result/{task_id}")
-                    result_response.raise_for_status()
-                    result_data = result_response.json()
-                    
-                    await reply_msg.edit(content="✅ **Analysis Complete!**")
-                    await send_reply_chunks(message, result_data.get("result"))
-                    channel_task_ids[message.channel.id] = task_id # Save task_id for follow-ups
-                    break
-                elif current_status == "failed":
-                    result_response = await http_client.get(f"{API_BASE_URL}/result/{task_id}")
-                    result_data = result_response.json()
-                    error_message = result_data.get("result", "An unknown error occurred.")
-                    await reply_msg.edit(content=f"❌ **Analysis Failed:** {error_message}")
+        # 1. Start the analysis task
+        response = await api_client.post("/analyze", json={"video_url": url, "user_id": str(message.author.id)})
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "?")
+            await reply_msg.edit(content=f"⏳ **Busy:** Too many videos are being analyzed right now. Please try again in {retry_after}s.")
+            reply.record("busy")
+            return
+        response.raise_for_status()
+        data = response.json()
+        task_id = data.get("task_id")
+
+        if not task_id:
+            await reply_msg.edit(content="❌ **API Error:** Could not start analysis task.")
+            reply.record("error")
+            return
+
+        # 2. Follow the task's events: status changes until text arrives, then the text itself
+        finished = False
+        async with api_client.stream("GET", f"/events/{task_id}") as event_response:
+            event_response.raise_for_status()
+            async for event, event_data in iter_sse(event_response):
+                if event == "status" and not reply.text:
+                    await reply_msg.edit(content=f"## {LOADING_EMOJI} Analysis in progress... (Status: {event_data['status']})")
+                elif event == "delta":
+                    await reply.feed(event_data["text"])
+                elif event == "done":
+                    if event_data["status"] == "completed":
+                        await reply.finish(event_data.get("result") or reply.text)
+                        channel_task_ids[message.channel.id] = task_id # Save task_id for follow-ups
+                    else:
+                        error_message = event_data.get("result") or "An unknown error occurred."
+                        await reply_msg.edit(content=f"❌ **Analysis Failed:** {error_message}")
+                    reply.record(event_data["status"])
+                    finished = True
                     break
+        if not finished:
+            await reply_msg.edit(content="❌ **API Error:** The analysis event stream ended unexpectedly.")
+            reply.record("error")
     
     except httpx.RequestError as e:
         print(f"HTTP Request Error: {e}")
         await reply_msg.edit(content="❌ **API Connection Error:** Could not connect to the analysis service.")
+        reply.record("error")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
         await reply_msg.edit(content="❌ **An unexpected error occurred.** Please try again later or contact the administrator.")
+        reply.record("error")
+
+async def ask_follow_up(message, task_id):
+    """
+    Streams the answer to a follow-up question into a reply as it is written.
+    """
+    reply = ProgressiveReply(message, kind="follow_up")
+    async with api_client.stream("POST", "/ask/stream", json={"task_id": task_id, "question": message.content}) as response:
+        response.raise_for_status()
+        if not response.headers.get("content-type", "").startswith("text/event-stream"):
+            # The API answered with a JSON error instead of a stream
+            data = json.loads(await response.aread())
+            await reply.finish(data.get("error", "No answer received."))
+            reply.record("failed")
+            return
+        async for event, event_data in iter_sse(response):
+            if event == "delta":
+                await reply.feed(event_data["text"])
+            elif event == "done":
+                await reply.finish(event_data.get("result") or reply.text or "No answer received.")
+                reply.record(event_data["status"])
+                break
 
 @client.event
 async def on_ready():
+    global _metrics_server
     print(f'Logged in as {client.user}')
+    # on_ready fires again after reconnects; the server is started once
+    if BOT_METRICS_PORT and not _metrics_server:
+        _metrics_server = await metrics.serve(BOT_METRICS_PORT)
 
 @client.event
 async def on_message(message):
@@ -107,14 +255,7 @@ async def on_message(message):
                     task_id = channel_task_ids.get(message.channel.id)
                     if task_id:
                         await message.add_reaction(LOADING_EMOJI)
-                        async with httpx.AsyncClient(timeout=None) as http_client:
-                            response = await http_client.post(
-                                f"{API_BASE_URL}/ask",
-                                json={"task_id": task_id, "question": message.content}
-                            )
-                            response.raise_for_status()
-                            data = response.json()
-                            await send_reply_chunks(message, data.get("answer", "No answer received."))
+                        await ask_follow_up(message, task_id)
                         await message.remove_reaction(LOADING_EMOJI, client.user)
                         return # Stop further processing
                 
@@ -133,4 +274,5 @@ async def on_message(message):
     elif (isinstance(message.channel, discord.DMChannel) or message.content.startswith(f"<@{str(client.user.id)}>")):
         await message.reply("請提供一個有效的影片 URL。")
 
-client.run(discord_token)
\ No newline at end of file
+if __name__ == "__main__":
+    client.run(discord_token)
@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# --- Configuration ---
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("true", "1", "t")
+CACHE_PATH = os.getenv("CACHE_PATH", "video_cache.sqlite3")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS frames (
+    fingerprint TEXT PRIMARY KEY,
+    frames TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    fingerprint TEXT NOT NULL,
+    model TEXT NOT NULL,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (fingerprint, model)
+);
+"""
+
+
+class CacheEntry:
+    def __init__(self, fingerprint: str, result: str, frames: list):
+        self.fingerprint = fingerprint
+        self.result = result
+        self.frames = frames
+
+
+class ResultCache:
+    """
+    Persistent SQLite cache of sampled frames and analysis results.
+
+    Results are stored per frame fingerprint and model; canonical video keys point at a
+    fingerprint, so a repeated URL is answered without downloading anything, and the same
+    clip under a different URL is answered once its frames have been sampled.
+    Entries expire after `ttl` seconds, and the least recently used ones are evicted
+    once the stored frames and results exceed `max_bytes`.
+    """
+    def __init__(self, path: str = CACHE_PATH, ttl: int = CACHE_TTL_SECONDS, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = {"video": 0, "fingerprint": 0}
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # WAL lets API and worker processes (see state.py) share the file
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def _fetch(self, fingerprint: str, model: str, now: float):
+        row = self._db.execute(
+            "SELECT r.result, f.frames FROM results r JOIN frames f ON f.fingerprint = r.fingerprint "
+            "WHERE r.fingerprint = ? AND r.model = ? AND r.created > ?",
+            (fingerprint, model, now - self.ttl),
+        ).fetchone()
+        if not row:
+            return None
+        self._db.execute("UPDATE results SET accessed = ? WHERE fingerprint = ? AND model = ?", (now, fingerprint, model))
+        self._db.execute("UPDATE frames SET accessed = ? WHERE fingerprint = ?", (now, fingerprint))
+        self._db.commit()
+        return CacheEntry(fingerprint, row[0], json.loads(row[1]))
+
+    def get_by_video(self, video_key: str, model: str):
+        """
+        Looks up a result by canonical video key. Does not count a miss, since the
+        fingerprint lookup after frame extraction gets a second chance.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT fingerprint FROM videos WHERE video_key = ?", (video_key,)).fetchone()
+            entry = self._fetch(row[0], model, now) if row else None
+            if entry:
+                self.hits["video"] += 1
+            return entry
+
+    def get_by_fingerprint(self, fingerprint: str, model: str, video_key: str = None):
+        """
+        Looks up a result by frame fingerprint, and remembers `video_key` for it on a hit.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._fetch(fingerprint, model, now)
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits["fingerprint"] += 1
+            if video_key:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO videos (video_key, fingerprint, created) VALUES (?, ?, ?)",
+                    (video_key, fingerprint, now),
+                )
+                self._db.commit()
+            return entry
+
+    def put(self, video_key: str, fingerprint: str, model: str, frames: list, result: str):
+        now = time.time()
+        frames_json = json.dumps(frames)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO frames (fingerprint, frames, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, frames_json, len(frames_json), now, now),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (fingerprint, model, result, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (fingerprint, model, result, len(result.encode("utf-8")), now, now),
+            )
+            if video_key:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO videos (video_key, fingerprint, created) VALUES (?, ?, ?)",
+                    (video_key, fingerprint, now),
+                )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float):
+        cutoff = now - self.ttl
+        self.evictions += self._db.execute("DELETE FROM results WHERE created <= ?", (cutoff,)).rowcount
+        self._db.execute("DELETE FROM frames WHERE fingerprint NOT IN (SELECT fingerprint FROM results)")
+        self._db.execute("DELETE FROM videos WHERE created <= ? OR fingerprint NOT IN (SELECT fingerprint FROM frames)", (cutoff,))
+
+        total = self._total_bytes()
+        while total > self.max_bytes:
+            row = self._db.execute("SELECT fingerprint, size FROM frames ORDER BY accessed LIMIT 1").fetchone()
+            if not row:
+                break
+            fingerprint = row[0]
+            removed = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM results WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()[0] + row[1]
+            self.evictions += self._db.execute("DELETE FROM results WHERE fingerprint = ?", (fingerprint,)).rowcount
+            self._db.execute("DELETE FROM frames WHERE fingerprint = ?", (fingerprint,))
+            self._db.execute("DELETE FROM videos WHERE fingerprint = ?", (fingerprint,))
+            total -= removed
+
+    def _total_bytes(self) -> int:
+        frames_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM frames").fetchone()[0]
+        results_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        return frames_size + results_size
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            total_bytes = self._total_bytes()
+        lookups = sum(self.hits.values()) + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_ratio": round(sum(self.hits.values()) / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+        }
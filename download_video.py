@@ -1,25 +1,459 @@
+import copy
+import json
+import math
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import yt_dlp
 import uuid
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from yt_dlp.extractor import gen_extractor_classes
+from yt_dlp.networking import Request
 
-def download_video(url):
+import metrics
+from media_store import media_store
+
+# --- Configuration ---
+# "full" downloads best video+audio and merges them (the original behaviour),
+# "frames" downloads one video-only stream capped at FRAMES_MAX_HEIGHT,
+# "stream" reads frames straight from the stream URL and only downloads if that is not possible,
+# "pipe" decodes and encodes frames while the video downloads (see analyze.build_pipelined_payload),
+# "storyboard" takes frames from the site's storyboard images and only downloads if there are none.
+DOWNLOAD_MODE = os.getenv("DOWNLOAD_MODE", "frames").lower()
+FRAMES_MAX_HEIGHT = int(os.getenv("FRAMES_MAX_HEIGHT", "720"))
+# Largest download allowed, checked against yt-dlp's metadata before it starts and
+# enforced by yt-dlp while it runs; 0 means no limit.
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(1024 ** 3)))
+# Longest video accepted for analysis, in seconds; 0 means no limit.
+MAX_VIDEO_DURATION_SECONDS = float(os.getenv("MAX_VIDEO_DURATION_SECONDS", "0"))
+# Size assumed for a download whose metadata gives no size or bitrate
+UNKNOWN_SIZE_BYTES = 256 * 1024 ** 2
+# How long extracted metadata is reused. Stream URLs in it expire after a few hours on most sites.
+METADATA_TTL_SECONDS = float(os.getenv("METADATA_TTL_SECONDS", "600"))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "256"))
+
+# Protocols ffmpeg/OpenCV can read directly from a single URL.
+STREAMABLE_PROTOCOLS = {"http", "https", "m3u8", "m3u8_native"}
+# Query parameters that never change which video a URL points to.
+TRACKING_PARAMS = {"si", "feature", "fbclid", "igshid", "igsh", "ref", "ref_src", "t", "s"}
+
+@lru_cache(maxsize=1)
+def _extractor_classes():
+    return [ie for ie in gen_extractor_classes() if ie.ie_key() != "Generic"]
+
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower().removeprefix("www.")
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and not key.startswith("utm_")
+    )
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip("/"), urlencode(query), ""))
+
+def _is_single_video(ie) -> bool:
+    return ie._RETURN_TYPE == 'video'
+
+@lru_cache(maxsize=4096)
+def canonical_video_key(url: str) -> str:
     """
-    Downloads a video from a URL to a temporary file with a unique name.
-    Returns the filename on success, None on failure.
+    Returns a key that is the same for every URL of one video, e.g. "Youtube:dQw4w9WgXcQ"
+    for both youtu.be and youtube.com links. Uses the extractors' URL patterns only, so
+    no network request is made. Unknown sites fall back to the URL minus tracking parameters.
+
+    A video link that also names a playlist (watch?v=...&list=...) is claimed by the
+    playlist extractor first; like the downloader's `noplaylist`, it is keyed on the video.
+    Links to a playlist alone get the URL key, since they name no single video.
+    """
+    for ie in _extractor_classes():
+        if ie.suitable(url):
+            if not _is_single_video(ie):
+                break
+            video_id = ie.get_temp_id(url)
+            if video_id:
+                return f"{ie.ie_key()}:{video_id}"
+            return f"url:{_normalize_url(url)}"
+    for ie in _extractor_classes():
+        # suitable() turns these URLs down because of the playlist, so match the pattern alone
+        if _is_single_video(ie) and ie._match_valid_url(url):
+            video_id = ie.get_temp_id(url)
+            if video_id:
+                return f"{ie.ie_key()}:{video_id}"
+    return f"url:{_normalize_url(url)}"
+
+def is_video_key(key: str) -> bool:
+    """
+    Whether a canonical_video_key() names one video, rather than being a fallback URL key.
+    """
+    return not key.startswith("url:")
+
+
+# --- Metadata pre-flight ---
+METADATA_LOOKUPS = metrics.Counter(
+    "video_metadata_lookups_total", "Video metadata requests, by whether the cache answered them.", ["result"]
+)
+
+class MetadataCache:
+    """
+    yt-dlp's metadata per video (formats, duration, chapters, thumbnails), as extracted
+    before any format is chosen, kept for `ttl` seconds in LRU order.
+    """
+    def __init__(self, ttl: float = METADATA_TTL_SECONDS, max_entries: int = METADATA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, info: dict):
+        if not self.ttl or not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+metadata_cache = MetadataCache()
+# One YoutubeDL per thread and set of options: building one loads the extractors and
+# opens a new HTTP session, and an instance must not be used by two threads at once.
+_ydl_local = threading.local()
+
+def _ydl(options: dict) -> yt_dlp.YoutubeDL:
+    instances = _ydl_local.__dict__.setdefault("instances", {})
+    key = repr(sorted(options.items()))
+    if key not in instances:
+        instances[key] = yt_dlp.YoutubeDL({'quiet': True, **options})
+    return instances[key]
+
+def preflight(url):
+    """
+    Returns yt-dlp's metadata for a video without downloading it, from the cache when
+    another request fetched it within METADATA_TTL_SECONDS. Raises VideoRejected for
+    live streams and videos over MAX_VIDEO_DURATION_SECONDS; returns None if the
+    metadata cannot be fetched. Formats are not selected yet (see _select_format()).
     """
-    # Generate a unique filename to prevent conflicts
-    unique_id = uuid.uuid4()
-    filename = f"temp_vid_{unique_id}.mp4"
+    key = canonical_video_key(url)
+    # Only metadata known to belong to one video is shared between URLs
+    cacheable = is_video_key(key)
+    info = metadata_cache.get(key) if cacheable else None
+    METADATA_LOOKUPS.inc(result="hit" if info else "miss")
+    if info is None:
+        try:
+            info = _ydl({'noplaylist': True}).extract_info(url, download=False, process=False)
+        except Exception as e:
+            print(f"Error fetching video metadata: {e}")
+            return None
+        if cacheable:
+            metadata_cache.put(key, info)
+    check_limits(info, check_size=False)
+    return info
+
+def _select_format(info: dict, options: dict) -> dict:
+    """
+    Runs yt-dlp's format selection with `options` on a copy of pre-flight metadata.
+    """
+    ydl = _ydl(options)
+    return ydl.sanitize_info(ydl.process_ie_result(copy.deepcopy(info), download=False))
+
+def _is_storyboard(fmt: dict) -> bool:
+    return fmt.get('format_note') == 'storyboard' or fmt.get('protocol') == 'mhtml'
+
+def _frames_height(info: dict, max_height: int, frame_size: int) -> int:
+    """
+    The resolution (shorter side) to ask for: the smallest one the video offers that
+    still gives frames `frame_size` pixels long on their longer side, up to `max_height`.
+    """
+    if not frame_size or not info:
+        return max_height
+    needed = math.ceil(frame_size * 9 / 16)
+    available = sorted({
+        min(fmt['width'], fmt['height']) for fmt in info.get('formats') or []
+        if fmt.get('width') and fmt.get('height') and fmt.get('vcodec') != 'none' and not _is_storyboard(fmt)
+    })
+    return next((height for height in available if needed <= height <= max_height), max_height)
+
+def _frames_format_options(max_height: int):
+    """
+    yt-dlp options that pick the cheapest stream still good enough for still frames:
+    video-only, at most `max_height` tall, preferring H.264 (cheapest to decode) and small files.
+    """
+    return {
+        'format': 'bv/b',
+        'format_sort': [f'res:{max_height}', 'vcodec:h264', '+size', 'proto'],
+        'noplaylist': True,
+    }
 
+class VideoRejected(Exception):
+    """
+    Raised when a video's metadata shows it is over a configured limit. The message is
+    meant for the user.
+    """
+
+
+def check_limits(info: dict, check_size: bool = True):
+    """
+    Raises VideoRejected if the video is live, longer than MAX_VIDEO_DURATION_SECONDS,
+    or (with `check_size`) known to be larger than MAX_DOWNLOAD_BYTES.
+    """
+    if info.get('is_live'):
+        raise VideoRejected("Live streams cannot be analyzed; try again once the stream has ended.")
+    duration = info.get('duration')
+    if MAX_VIDEO_DURATION_SECONDS and duration and duration > MAX_VIDEO_DURATION_SECONDS:
+        raise VideoRejected(
+            f"The video is {duration / 60:.0f} minutes long; videos up to "
+            f"{MAX_VIDEO_DURATION_SECONDS / 60:.0f} minutes can be analyzed."
+        )
+    if check_size and MAX_DOWNLOAD_BYTES:
+        size = _known_size(info)
+        if size and size > MAX_DOWNLOAD_BYTES:
+            raise VideoRejected(
+                f"The video is about {size / 2**20:.0f} MiB; downloads up to "
+                f"{MAX_DOWNLOAD_BYTES / 2**20:.0f} MiB are allowed."
+            )
+
+def _known_size(info: dict):
+    """
+    The download size yt-dlp reports for the selected format(s), exact or approximate, or None.
+    """
+    total = 0
+    for selected in info.get('requested_formats') or [info]:
+        size = selected.get('filesize') or selected.get('filesize_approx')
+        if not size:
+            # Bitrate in KBit/s times duration
+            if not (selected.get('tbr') and info.get('duration')):
+                return None
+            size = selected['tbr'] * 1000 / 8 * info['duration']
+        total += size
+    return int(total)
+
+def estimated_size(info: dict) -> int:
+    """
+    Bytes to reserve for downloading the format(s) selected in `info`.
+    """
+    return _known_size(info) or MAX_DOWNLOAD_BYTES or UNKNOWN_SIZE_BYTES
+
+class DownloadPlan:
+    """
+    What probe_download() learned about a video before downloading it: yt-dlp's metadata
+    with the format already selected, and the bytes to reserve for it.
+    """
+    def __init__(self, info: dict):
+        self.info = info
+        self.estimated_bytes = estimated_size(info)
+        self.duration = info.get('duration')
+
+class StreamSource:
+    """
+    A directly readable media URL resolved by yt-dlp, plus what the decoder needs to open it.
+    `url` is None when the stream can only be fetched by yt-dlp itself (e.g. split DASH
+    fragments); `info` keeps yt-dlp's metadata so VideoPipe can fetch it without resolving again.
+    """
+    def __init__(self, url: str, http_headers: dict, duration: float, height: int, info: dict = None):
+        self.url = url
+        self.http_headers = http_headers or {}
+        self.duration = duration
+        self.height = height
+        self.info = info or {}
+
+def resolve_video(url, max_height: int = FRAMES_MAX_HEIGHT, frame_size: int = 0):
+    """
+    Resolves a page URL to the single video stream frames would be taken from, the
+    smallest that still gives frames of `frame_size` pixels (see _frames_height()).
+    Returns None if resolution fails or the chosen format needs merging, and raises
+    VideoRejected if the video is over the duration limit.
+    """
+    info = preflight(url)
+    if not info:
+        return None
+    try:
+        info = _select_format(info, _frames_format_options(_frames_height(info, max_height, frame_size)))
+    except Exception as e:
+        print(f"Error resolving stream URL: {e}")
+        return None
+
+    if info.get('requested_formats'):
+        # A merged selection means there is no single stream to read
+        return None
+    readable = info.get('url') and info.get('protocol') in STREAMABLE_PROTOCOLS
+    return StreamSource(
+        info['url'] if readable else None, info.get('http_headers'), info.get('duration'), info.get('height'), info,
+    )
+
+def resolve_stream(url, max_height: int = FRAMES_MAX_HEIGHT, frame_size: int = 0):
+    """
+    Resolves a page URL to a single video stream URL that frames can be decoded from
+    without writing a file. Returns None if the chosen format is not a single readable URL
+    (e.g. split DASH fragments) or resolution fails.
+    """
+    source = resolve_video(url, max_height, frame_size)
+    return source if source and source.url else None
+
+class Storyboard:
+    """
+    A site's storyboard: sprite sheets of small preview frames, `rows` x `columns` per
+    sheet, one every 1/`fps` seconds. Frames can be cut from it without fetching the video.
+    """
+    def __init__(self, fmt: dict, duration: float):
+        self.sheets = [fragment['url'] for fragment in fmt['fragments']]
+        self.rows = fmt['rows']
+        self.columns = fmt['columns']
+        self.fps = fmt['fps']
+        self.width = fmt.get('width') or 0
+        self.height = fmt.get('height') or 0
+        self.duration = duration
+        self.http_headers = fmt.get('http_headers') or {}
+
+    def fetch(self, index: int) -> bytes:
+        """
+        Downloads sprite sheet `index`.
+        """
+        request = Request(self.sheets[index], headers=self.http_headers)
+        with _ydl({}).urlopen(request) as response:
+            return response.read()
+
+def storyboard(info: dict):
+    """
+    The storyboard with the largest frames in pre-flight metadata, or None if the site offers none.
+    """
+    duration = info.get('duration') if info else None
+    boards = [
+        fmt for fmt in (info.get('formats') or [] if info else [])
+        if _is_storyboard(fmt) and fmt.get('fragments') and fmt.get('rows') and fmt.get('columns') and fmt.get('fps')
+    ]
+    if not boards or not duration:
+        return None
+    return Storyboard(max(boards, key=lambda fmt: (fmt.get('width') or 0) * (fmt.get('height') or 0)), duration)
+
+def chapters(info: dict) -> list:
+    """
+    The video's chapter markers from pre-flight metadata, as [{"start", "end", "title"}, ...].
+    """
+    return [
+        {"start": chapter.get('start_time') or 0.0, "end": chapter.get('end_time'), "title": chapter.get('title') or ""}
+        for chapter in (info.get('chapters') or [] if info else [])
+    ]
+
+class VideoPipe:
+    """
+    A yt-dlp process writing one resolved video stream to `stdout` as it downloads, so
+    frames can be decoded before the download finishes. Fragmented formats (DASH, HLS)
+    come out as a stream a decoder can read from a pipe.
+    """
+    def __init__(self, source: StreamSource):
+        # Hands yt-dlp the metadata already resolved instead of extracting it again
+        fd, self._info_path = tempfile.mkstemp(prefix="temp_info_", suffix=".json", dir=media_store.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(source.info, f)
+        command = [
+            sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings", "--no-progress",
+            "--load-info-json", self._info_path, "-o", "-",
+        ]
+        if source.info.get("formats"):
+            # Fetch the format resolve_video() picked; single-format results have nothing to pick from
+            command += ["-f", str(source.info["format_id"])]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.stdout = self.process.stdout
+
+    def wait(self) -> int:
+        return self.process.wait()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.stdout.close()
+        if os.path.exists(self._info_path):
+            os.remove(self._info_path)
+
+def _download_options(mode: str, filename: str = None, max_height: int = FRAMES_MAX_HEIGHT):
     ydl_opts = {
         'format': 'bestvideo+bestaudio/best',
-        'outtmpl': filename,
         'quiet': True,
         'overwrite': True,
     }
+    if filename:
+        ydl_opts['outtmpl'] = filename
+    if MAX_DOWNLOAD_BYTES:
+        ydl_opts['max_filesize'] = MAX_DOWNLOAD_BYTES
+    if mode != "full":
+        ydl_opts.update(_frames_format_options(max_height))
+    return ydl_opts
+
+def probe_download(url, mode: str = None, frame_size: int = 0):
+    """
+    Chooses the format download_video() should fetch, from pre-flight metadata, and
+    checks it against MAX_VIDEO_DURATION_SECONDS and MAX_DOWNLOAD_BYTES. In "frames"
+    mode it is the smallest stream that still gives frames of `frame_size` pixels.
+    Returns a DownloadPlan, None if the metadata cannot be fetched, and raises
+    VideoRejected if the video is over a limit.
+    """
+    mode = mode or DOWNLOAD_MODE
+    info = preflight(url)
+    if not info:
+        return None
+    try:
+        info = _select_format(info, _download_options(mode, max_height=_frames_height(info, FRAMES_MAX_HEIGHT, frame_size)))
+    except Exception as e:
+        print(f"Error fetching video metadata: {e}")
+        return None
+    check_limits(info)
+    return DownloadPlan(info)
+
+def download_video(url, mode: str = None, filename: str = None, info: dict = None):
+    """
+    Downloads a video from a URL to `filename`, by default a temporary file with a unique name.
+    In "frames" mode only a single, resolution-capped video stream is fetched (no audio, no merge).
+    With `info` from probe_download(), the metadata is not fetched again.
+    Returns the filename on success, None on failure.
+    """
+    mode = mode or DOWNLOAD_MODE
+    if not filename:
+        # Generate a unique filename to prevent conflicts
+        media_store.open()
+        filename = os.path.join(media_store.directory, f"temp_vid_{uuid.uuid4()}.mp4")
+
+    ydl_opts = _download_options(mode, filename)
+    if info:
+        # The format probe_download() chose, not a new choice from the full list
+        ydl_opts['format'] = info['format_id']
     try:
+        # A fresh instance: the output file is an option, so it cannot be reused
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+            if info:
+                ydl.process_ie_result(info, download=True)
+            else:
+                ydl.download([url])
+        if not os.path.exists(filename):
+            # yt-dlp skips rather than fails a download over max_filesize
+            print(f"Error downloading video: no file written for {url}, it may be over the size limit")
+            return None
         return filename
     except Exception as e:
         print(f"Error downloading video: {e}")
@@ -36,4 +470,4 @@ def remove_video(filename):
         try:
             os.remove(filename)
         except OSError as e:
-            print(f"Error removing file {filename}: {e}")
\ No newline at end of file
+            print(f"Error removing file {filename}: {e}")
@@ -0,0 +1,165 @@
+import asyncio
+import base64
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+
+import metrics
+
+# --- Configuration ---
+# Number of warm extraction processes; 0 runs extraction in a thread of the API process instead.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+
+
+def _init_worker():
+    """
+    Imports OpenCV once per worker and stops it from spawning its own thread pool,
+    since parallelism comes from running several workers side by side.
+    """
+    import cv2
+    cv2.setNumThreads(1)
+
+def _warm_up():
+    return os.getpid()
+
+def _run_to_shared_memory(name: str, function, args, kwargs):
+    """
+    Runs `function` in a worker and moves the JPEG bytes of its result into a shared
+    memory block called `name`, so they are not pickled back to the parent. The parent
+    picks the name, so it can read and unlink the block, or unlink it if it never reads it.
+    """
+    payload = function(*args, **kwargs)
+    jpegs = payload.jpegs or []
+    payload.jpegs = None
+    sizes = [len(jpeg) for jpeg in jpegs]
+    if not jpegs:
+        return payload, sizes
+
+    block = SharedMemory(name=name, create=True, size=sum(sizes), track=False)
+    offset = 0
+    for jpeg in jpegs:
+        block.buf[offset:offset + len(jpeg)] = jpeg
+        offset += len(jpeg)
+    block.close()
+    return payload, sizes
+
+def _read_shared_memory(name: str, sizes: list):
+    """
+    Base64-encodes each JPEG straight from the shared memory block, then frees the block.
+    """
+    block = SharedMemory(name=name, track=False)
+    try:
+        view = block.buf
+        encoded = []
+        offset = 0
+        for size in sizes:
+            encoded.append(base64.b64encode(view[offset:offset + size]).decode("utf-8"))
+            offset += size
+        del view
+    finally:
+        block.close()
+        block.unlink()
+    return encoded
+
+def _unlink_shared_memory(name: str):
+    """
+    Frees a block whose result is not going to be read, if the worker created it.
+    """
+    try:
+        block = SharedMemory(name=name, track=False)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+def _discard_when_done(future, name: str):
+    if future is None:
+        return
+    # The job may still be running in its worker, and create the block after this
+    future.add_done_callback(lambda _: _unlink_shared_memory(name))
+
+
+class ExtractionService:
+    """
+    Runs CPU-bound frame extraction in a pool of warm worker processes, so several
+    videos are decoded and encoded truly in parallel instead of contending for the GIL
+    in the default thread pool.
+
+    `function` passed to extract() must be a module-level function returning an object
+    with a `jpegs` list; the result comes back with `base64_frames` filled in instead.
+    """
+    def __init__(self, workers: int = EXTRACT_WORKERS):
+        self.workers = workers
+        self._pool = None
+        # Extractions submitted and not yet finished; more than `workers` means jobs wait for a process
+        self.in_flight = 0
+
+    def _create_pool(self):
+        # "spawn" keeps workers free of the event loop's threads and locks
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def start(self):
+        """
+        Starts the workers ahead of the first job so OpenCV is already imported when it arrives.
+        """
+        if self.workers <= 0 or self._pool:
+            return
+        self._pool = self._create_pool()
+        for _ in range(self.workers):
+            self._pool.submit(_warm_up)
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def extract(self, function, *args, **kwargs):
+        if self.workers <= 0:
+            return await asyncio.to_thread(self._extract_in_thread, function, args, kwargs)
+
+        self.start()
+        name = f"psm_{uuid.uuid4().hex[:16]}"
+        self.in_flight += 1
+        future = None
+        try:
+            future = self._pool.submit(_run_to_shared_memory, name, function, args, kwargs)
+            payload, sizes = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            _discard_when_done(future, name)
+            # A worker died (e.g. a decoder crash); replace the pool and retry this job in a thread
+            print("Frame extraction worker crashed; restarting the process pool.")
+            self.shutdown()
+            return await asyncio.to_thread(self._extract_in_thread, function, args, kwargs)
+        except BaseException:
+            # Cancelled, or failed after the worker may have created the block
+            _discard_when_done(future, name)
+            raise
+        finally:
+            self.in_flight -= 1
+
+        # Once started, the read runs to the end and unlinks the block even if this task is cancelled
+        payload.base64_frames = await asyncio.to_thread(_read_shared_memory, name, sizes) if sizes else []
+        return payload
+
+    @staticmethod
+    def _extract_in_thread(function, args, kwargs):
+        payload = function(*args, **kwargs)
+        payload.base64_frames = [base64.b64encode(jpeg).decode("utf-8") for jpeg in payload.jpegs or []]
+        payload.jpegs = None
+        return payload
+
+
+extraction_service = ExtractionService()
+
+def _collect_pool():
+    metrics.EXTRACT_POOL_WORKERS.set(extraction_service.workers)
+    metrics.EXTRACT_POOL_IN_FLIGHT.set(extraction_service.in_flight)
+
+metrics.add_collector(_collect_pool)
@@ -0,0 +1,447 @@
+import math
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# --- Configuration ---
+# "auto" picks a strategy from the container metadata; any strategy name forces that strategy.
+FRAME_STRATEGY = os.getenv("FRAME_STRATEGY", "auto").lower()
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+# Past this many frames between two samples, decoding every frame costs more than seeking to each one.
+SEQUENTIAL_MAX_INTERVAL = int(os.getenv("SEQUENTIAL_MAX_INTERVAL", "300"))
+# At or above this many pixels per frame, ffmpeg's threaded decode + scale beats the OpenCV loop.
+FFMPEG_MIN_PIXELS = 1920 * 1080
+
+_SHOWINFO_PTS_RE = re.compile(r"pts_time:\s*(-?[0-9.]+)")
+_JPEG_SOI = b"\xff\xd8"
+_JPEG_EOI = b"\xff\xd9"
+# Storyboard sprite sheets fetched at once
+STORYBOARD_FETCH_WORKERS = 8
+
+
+class VideoInfo:
+    """
+    Container metadata used to choose an extraction strategy.
+    """
+    def __init__(self, source: str, total_frames: int, fps: float, width: int, height: int, codec: str, duration: float):
+        self.source = source
+        self.total_frames = total_frames
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.codec = codec
+        self.duration = duration
+        self.is_stream = "://" in source
+        # Extra request headers for stream URLs (only ffmpeg can send them)
+        self.http_headers = {}
+
+    def as_dict(self):
+        return {
+            "total_frames": self.total_frames,
+            "fps": round(self.fps, 3),
+            "width": self.width,
+            "height": self.height,
+            "codec": self.codec,
+            "duration": round(self.duration, 3),
+            "is_stream": self.is_stream,
+        }
+
+
+class ExtractedFrame:
+    """
+    A single sampled frame. `image` is a BGR array; `jpeg` holds the encoded bytes
+    when the strategy already produced them (ffmpeg pipes), so they can be reused as-is.
+    """
+    def __init__(self, timestamp: float, image, jpeg: bytes = None):
+        self.timestamp = timestamp
+        self.image = image
+        self.jpeg = jpeg
+
+
+class ExtractionResult:
+    def __init__(self, frames, strategy: str, info: VideoInfo, timings: dict, runs: list):
+        self.frames = frames
+        self.strategy = strategy
+        self.info = info
+        self.timings = timings
+        # (strategy, seconds, frame count, failed) for every strategy tried
+        self.runs = runs
+
+
+# --- Per-strategy statistics ---
+_stats_lock = threading.Lock()
+_strategy_stats = {}
+
+def record_strategy_runs(runs):
+    """
+    Adds the runs of one extraction to the cumulative statistics. Kept separate from
+    extract_frames() so runs made in worker processes can be recorded in the parent.
+    """
+    with _stats_lock:
+        for name, seconds, frame_count, failed in runs:
+            stats = _strategy_stats.setdefault(name, {"runs": 0, "failures": 0, "frames": 0, "seconds": 0.0})
+            stats["runs"] += 1
+            stats["frames"] += frame_count
+            stats["seconds"] += seconds
+            if failed:
+                stats["failures"] += 1
+
+def strategy_stats():
+    """
+    Returns cumulative run count, frame count and decode time for each strategy used so far.
+    """
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _strategy_stats.items()}
+
+
+# --- Helpers ---
+def ffmpeg_available() -> bool:
+    return shutil.which(FFMPEG_BIN) is not None
+
+def _fourcc_to_str(fourcc: int) -> str:
+    return "".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip("\x00 ")
+
+def probe_video(source: str, duration_hint: float = None, http_headers: dict = None) -> VideoInfo:
+    """
+    Reads frame count, frame rate, resolution and codec from the container without decoding.
+    """
+    video = cv2.VideoCapture(source)
+    try:
+        total_frames = max(int(video.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+        fps = video.get(cv2.CAP_PROP_FPS) or 0.0
+        width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        codec = _fourcc_to_str(int(video.get(cv2.CAP_PROP_FOURCC)))
+    finally:
+        video.release()
+
+    duration = total_frames / fps if fps > 0 and total_frames > 0 else 0.0
+    if duration_hint and (duration <= 0 or total_frames <= 0):
+        # Network streams often report no frame count; trust the extractor's duration instead.
+        duration = float(duration_hint)
+        if fps > 0:
+            total_frames = int(duration * fps)
+    info = VideoInfo(source, total_frames, fps, width, height, codec, duration)
+    info.http_headers = dict(http_headers or {})
+    return info
+
+def downscale(image, max_dimension: int = None):
+    """
+    Shrinks an image so its longest side is at most `max_dimension`, using area interpolation.
+    """
+    if not max_dimension:
+        return image
+    height, width = image.shape[:2]
+    longest = max(height, width)
+    if longest <= max_dimension:
+        return image
+    scale = max_dimension / longest
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def _evenly_spaced_frame_ids(total_frames: int, max_frames: int):
+    max_frames = min(max_frames, total_frames)
+    if max_frames <= 0:
+        return []
+    interval = total_frames // max_frames
+    return [i * interval for i in range(max_frames)]
+
+def _pick_evenly(items: list, count: int) -> list:
+    if count <= 0:
+        return []
+    if len(items) <= count:
+        return items
+    step = len(items) / count
+    return [items[int(i * step)] for i in range(count)]
+
+def _take_jpegs(data: bytes):
+    """
+    Splits the output of ffmpeg's image2pipe/mjpeg muxer into individual JPEG images.
+    Returns the complete images and the bytes after the last one, which may hold the
+    beginning of an image not fully written yet.
+    """
+    images = []
+    consumed = 0
+    start = data.find(_JPEG_SOI)
+    while start != -1:
+        end = data.find(_JPEG_EOI, start + 2)
+        if end == -1:
+            break
+        images.append(data[start:end + 2])
+        consumed = end + 2
+        start = data.find(_JPEG_SOI, consumed)
+    return images, data[consumed:]
+
+
+# --- Strategies ---
+class SequentialStrategy:
+    """
+    Decodes the video once from the start, calling grab() on every frame and retrieve()
+    only on the sampled ones. No seeks, so no repeated decoding from the previous keyframe.
+    """
+    name = "sequential"
+
+    def supports(self, info: VideoInfo) -> bool:
+        return info.total_frames > 0
+
+    def extract(self, info: VideoInfo, max_frames: int, max_dimension: int = None):
+        frame_ids = _evenly_spaced_frame_ids(info.total_frames, max_frames)
+        if not frame_ids:
+            return []
+        wanted = set(frame_ids)
+        last_id = frame_ids[-1]
+        fps = info.fps or 1.0
+
+        frames = []
+        video = cv2.VideoCapture(info.source)
+        try:
+            for frame_id in range(last_id + 1):
+                if not video.grab():
+                    break
+                if frame_id not in wanted:
+                    continue
+                success, frame = video.retrieve()
+                if success:
+                    frames.append(ExtractedFrame(frame_id / fps, downscale(frame, max_dimension)))
+        finally:
+            video.release()
+        return frames
+
+
+class SeekStrategy:
+    """
+    Seeks to each sampled frame. Only worthwhile when samples are so far apart that
+    decoding everything in between costs more than re-decoding from each keyframe.
+    """
+    name = "seek"
+
+    def supports(self, info: VideoInfo) -> bool:
+        return info.total_frames > 0 and not info.is_stream
+
+    def extract(self, info: VideoInfo, max_frames: int, max_dimension: int = None):
+        fps = info.fps or 1.0
+        frames = []
+        video = cv2.VideoCapture(info.source)
+        try:
+            for frame_id in _evenly_spaced_frame_ids(info.total_frames, max_frames):
+                video.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+                success, frame = video.read()
+                if success:
+                    frames.append(ExtractedFrame(frame_id / fps, downscale(frame, max_dimension)))
+        finally:
+            video.release()
+        return frames
+
+
+class FFmpegPipeStrategy:
+    """
+    Runs ffmpeg as a subprocess that selects, scales and JPEG-encodes the sampled frames
+    and writes them to a pipe. Decoding and scaling happen in ffmpeg's own threads.
+    """
+    name = "ffmpeg"
+    input_args = ()
+
+    def supports(self, info: VideoInfo) -> bool:
+        return ffmpeg_available() and info.duration > 0
+
+    def _command(self, info: VideoInfo, max_frames: int, max_dimension: int = None):
+        interval = info.duration / max(max_frames, 1)
+        filters = [f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{interval:.3f})'"]
+        if max_dimension:
+            filters.append(
+                f"scale='min(iw\\,{max_dimension})':'min(ih\\,{max_dimension})'"
+                ":force_original_aspect_ratio=decrease:flags=area"
+            )
+        filters.append("showinfo")
+        header_args = []
+        if info.is_stream and info.http_headers:
+            header_args = ["-headers", "".join(f"{key}: {value}\r\n" for key, value in info.http_headers.items())]
+        return [
+            FFMPEG_BIN, "-hide_banner", "-nostdin", "-loglevel", "info",
+            *self.input_args,
+            *header_args,
+            "-i", info.source,
+            "-an", "-sn", "-dn",
+            "-vf", ",".join(filters),
+            "-fps_mode", "vfr",
+            "-f", "image2pipe", "-c:v", "mjpeg", "-q:v", "3",
+            "pipe:1",
+        ]
+
+    def extract(self, info: VideoInfo, max_frames: int, max_dimension: int = None):
+        return _pick_evenly(list(self.iter_frames(info, max_frames, max_dimension)), max_frames)
+
+    def iter_frames(self, info: VideoInfo, max_frames: int, max_dimension: int = None, stdin=None):
+        """
+        Yields each sampled frame as soon as ffmpeg has written it, so the caller can work
+        on it while later frames are still being decoded. With `stdin` (a pipe, e.g. from
+        a download still in progress) the video is read from it instead of `info.source`.
+        Raises RuntimeError once the output is exhausted if ffmpeg failed.
+        """
+        process = subprocess.Popen(
+            self._command(info, max_frames, max_dimension),
+            stdin=stdin if stdin is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        # showinfo logs each frame's timestamp on stderr before the frame is encoded
+        timestamps = []
+        stderr_tail = []
+        stderr_done = threading.Event()
+        logged = threading.Condition()
+
+        def read_stderr():
+            for raw in process.stderr:
+                line = raw.decode("utf-8", "replace")
+                match = _SHOWINFO_PTS_RE.search(line) if "Parsed_showinfo" in line else None
+                with logged:
+                    if match:
+                        timestamps.append(float(match.group(1)))
+                    else:
+                        stderr_tail[:] = [line.strip()]
+                    logged.notify_all()
+            with logged:
+                stderr_done.set()
+                logged.notify_all()
+
+        reader = threading.Thread(target=read_stderr, daemon=True)
+        reader.start()
+        try:
+            buffer = b""
+            index = 0
+            for chunk in iter(lambda: process.stdout.read1(1 << 16), b""):
+                jpegs, buffer = _take_jpegs(buffer + chunk)
+                for jpeg in jpegs:
+                    image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    with logged:
+                        logged.wait_for(lambda: len(timestamps) > index or stderr_done.is_set(), timeout=5)
+                        timestamp = timestamps[index] if index < len(timestamps) else index * info.duration / max(max_frames, 1)
+                    index += 1
+                    if image is not None:
+                        yield ExtractedFrame(timestamp, image, jpeg=jpeg)
+            process.wait()
+            reader.join()
+            if process.returncode != 0:
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {' '.join(stderr_tail)}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+class KeyframeStrategy(FFmpegPipeStrategy):
+    """
+    Like the ffmpeg strategy, but tells the decoder to skip every non-keyframe, so only
+    keyframes are ever decoded. Samples land on the nearest keyframe, not an exact spacing.
+    """
+    name = "keyframe"
+    input_args = ("-skip_frame", "nokey")
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (SequentialStrategy(), SeekStrategy(), FFmpegPipeStrategy(), KeyframeStrategy())
+}
+
+def choose_strategy(info: VideoInfo, max_frames: int) -> str:
+    """
+    Picks the cheapest strategy for this container. Explicit FRAME_STRATEGY settings win.
+    """
+    if FRAME_STRATEGY in STRATEGIES and STRATEGIES[FRAME_STRATEGY].supports(info):
+        return FRAME_STRATEGY
+
+    has_ffmpeg = ffmpeg_available()
+    if info.is_stream:
+        # Seeking over the network is the worst case; decode in one forward pass.
+        return "ffmpeg" if has_ffmpeg and info.duration > 0 else "sequential"
+
+    interval = info.total_frames // max(max_frames, 1)
+    if interval > SEQUENTIAL_MAX_INTERVAL:
+        return "keyframe" if has_ffmpeg and info.duration > 0 else "seek"
+    if has_ffmpeg and info.duration > 0 and info.width * info.height >= FFMPEG_MIN_PIXELS:
+        return "ffmpeg"
+    return "sequential"
+
+def extract_frames(source: str, max_frames: int = 20, max_dimension: int = None,
+                   duration_hint: float = None, http_headers: dict = None, info: VideoInfo = None) -> ExtractionResult:
+    """
+    Samples up to `max_frames` frames from a file path or stream URL.
+    Falls back to the plain OpenCV strategies if the chosen one fails or returns nothing.
+    Pass `info` from an earlier probe_video() call to skip probing again.
+    """
+    start_time = time.perf_counter()
+    info = info or probe_video(source, duration_hint, http_headers)
+    probe_end_time = time.perf_counter()
+    timings = {"probe": probe_end_time - start_time}
+
+    chosen = choose_strategy(info, max_frames)
+    frames = []
+    runs = []
+    used = chosen
+    for name in dict.fromkeys((chosen, "sequential", "seek")):
+        strategy = STRATEGIES[name]
+        if not strategy.supports(info):
+            continue
+        strategy_start = time.perf_counter()
+        try:
+            frames = strategy.extract(info, max_frames, max_dimension)
+        except Exception as e:
+            print(f"Frame extraction strategy '{name}' failed for {source}: {e}")
+            frames = []
+        elapsed = time.perf_counter() - strategy_start
+        runs.append((name, elapsed, len(frames), not frames))
+        timings[name] = elapsed
+        if frames:
+            used = name
+            break
+
+    timings["total"] = time.perf_counter() - start_time
+    return ExtractionResult(frames, used, info, timings, runs)
+
+
+# --- Storyboards ---
+def _fetch_sheet(board, index: int):
+    try:
+        data = board.fetch(index)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except Exception as e:
+        print(f"Error fetching storyboard sheet {index}: {e}")
+        return None
+
+def extract_storyboard(board, max_frames: int = 20, max_dimension: int = None) -> ExtractionResult:
+    """
+    Samples up to `max_frames` evenly spaced frames from a site's storyboard (a
+    download_video.Storyboard), fetching only the sprite sheets they are on. The frames
+    are small, often 160x90, but nothing is downloaded or decoded beyond a few JPEGs.
+    """
+    start_time = time.perf_counter()
+    per_sheet = board.rows * board.columns
+    total = min(len(board.sheets) * per_sheet, max(1, math.ceil(board.duration * board.fps)))
+    info = VideoInfo(board.sheets[0], total, board.fps, board.width, board.height, "storyboard", board.duration)
+    indices = _pick_evenly(list(range(total)), max_frames)
+    needed = sorted({index // per_sheet for index in indices})
+    with ThreadPoolExecutor(min(STORYBOARD_FETCH_WORKERS, len(needed) or 1)) as pool:
+        sheets = dict(zip(needed, pool.map(lambda sheet: _fetch_sheet(board, sheet), needed)))
+
+    frames = []
+    for index in indices:
+        sheet = sheets[index // per_sheet]
+        if sheet is None:
+            continue
+        # The last sheet can have fewer rows than the others
+        width = board.width or sheet.shape[1] // board.columns
+        height = board.height or sheet.shape[0] // board.rows
+        row, column = divmod(index % per_sheet, board.columns)
+        tile = sheet[row * height:(row + 1) * height, column * width:(column + 1) * width]
+        if tile.shape[0] == height and tile.shape[1] == width:
+            frames.append(ExtractedFrame(index / board.fps, downscale(tile.copy(), max_dimension)))
+
+    elapsed = time.perf_counter() - start_time
+    timings = {"storyboard": elapsed, "total": elapsed}
+    return ExtractionResult(frames, "storyboard", info, timings, [("storyboard", elapsed, len(frames), not frames)])
@@ -0,0 +1,232 @@
+import hashlib
+import os
+import re
+
+import cv2
+import numpy as np
+
+# --- Configuration ---
+# "content" picks frames by scene changes and drops near-duplicates; "uniform" keeps the even spacing.
+FRAME_SELECTION = os.getenv("FRAME_SELECTION", "content").lower()
+# How many candidates to decode per frame we finally keep.
+CANDIDATE_FACTOR = int(os.getenv("FRAME_CANDIDATE_FACTOR", "3"))
+# Candidates are all held in memory at once, so they are decoded at a bounded resolution.
+CANDIDATE_MAX_DIMENSION = int(os.getenv("FRAME_CANDIDATE_MAX_DIMENSION", "1280"))
+# Two frames whose 64-bit dHashes differ in at most this many bits, and whose histograms
+# are closer than SCENE_CHANGE_THRESHOLD, are near-duplicates.
+DUPLICATE_MAX_DISTANCE = int(os.getenv("FRAME_DUPLICATE_DISTANCE", "6"))
+# L1 distance (0..2) between consecutive grayscale histograms that counts as a scene change.
+SCENE_CHANGE_THRESHOLD = float(os.getenv("SCENE_CHANGE_THRESHOLD", "0.5"))
+
+# Frames attached to a text-only follow-up question, picked by relevance to the question.
+FOLLOW_UP_KEYFRAMES = int(os.getenv("FOLLOW_UP_KEYFRAMES", "4"))
+
+HISTOGRAM_BINS = 32
+_HISTOGRAM_SIZE = (64, 64)
+_DHASH_SIZE = (9, 8)
+
+
+def _gray_thumbnails(frames, size):
+    """
+    Stacks grayscale, area-downscaled copies of each frame into one (N, h, w) array.
+    """
+    return np.stack([
+        cv2.resize(cv2.cvtColor(frame.image, cv2.COLOR_BGR2GRAY), size, interpolation=cv2.INTER_AREA)
+        for frame in frames
+    ])
+
+def dhash_bits(frames) -> np.ndarray:
+    """
+    Difference hash of each frame as an (N, 64) boolean array: each bit says whether a
+    pixel of the 9x8 thumbnail is brighter than its right-hand neighbour.
+    """
+    thumbs = _gray_thumbnails(frames, _DHASH_SIZE).astype(np.int16)
+    return (thumbs[:, :, 1:] > thumbs[:, :, :-1]).reshape(len(frames), -1)
+
+def frame_fingerprint(frames) -> str:
+    """
+    Content fingerprint of a set of sampled frames: a SHA-1 over their dHashes, so the
+    same clip gives the same fingerprint regardless of container or download URL.
+    """
+    if not frames:
+        return ""
+    return hashlib.sha1(np.packbits(dhash_bits(frames)).tobytes()).hexdigest()
+
+def hamming_matrix(bits: np.ndarray) -> np.ndarray:
+    """
+    Pairwise Hamming distances between the rows of an (N, 64) boolean hash array.
+    """
+    return (bits[:, None, :] != bits[None, :, :]).sum(axis=-1)
+
+def gray_histograms(frames) -> np.ndarray:
+    """
+    Normalised grayscale histograms of each frame as an (N, HISTOGRAM_BINS) array.
+    """
+    thumbs = _gray_thumbnails(frames, _HISTOGRAM_SIZE)
+    count = len(frames)
+    bins = (thumbs.astype(np.int64) * HISTOGRAM_BINS) >> 8
+    bins += (np.arange(count) * HISTOGRAM_BINS)[:, None, None]
+    hists = np.bincount(bins.ravel(), minlength=count * HISTOGRAM_BINS).reshape(count, HISTOGRAM_BINS)
+    return hists / float(_HISTOGRAM_SIZE[0] * _HISTOGRAM_SIZE[1])
+
+def scene_scores(hists: np.ndarray) -> np.ndarray:
+    """
+    Histogram distance of each candidate to the one before it. The first candidate
+    always opens a scene, so it gets the maximum score.
+    """
+    scores = np.empty(len(hists))
+    scores[0] = 2.0
+    scores[1:] = np.abs(hists[1:] - hists[:-1]).sum(axis=1)
+    return scores
+
+def select_frames(frames, max_frames: int):
+    """
+    Chooses up to `max_frames` representative frames from a larger, time-ordered candidate list.
+
+    Scene cuts are taken first (strongest first), then the remaining slots go to the
+    candidates furthest in time from anything already chosen. A candidate is skipped
+    whenever it is a near-duplicate of a frame already chosen: same structure (dHash)
+    and same tonal distribution (histogram), so fades and lighting changes still count.
+    Returns the chosen frames in time order and a dict of selection statistics.
+    """
+    stats = {"candidates": len(frames), "scene_changes": 0, "duplicates_dropped": 0, "selected": 0}
+    if len(frames) <= 1 or max_frames <= 0:
+        chosen = frames[:max(max_frames, 0)]
+        stats["selected"] = len(chosen)
+        return chosen, stats
+
+    hists = gray_histograms(frames)
+    scores = scene_scores(hists)
+    histogram_distances = np.abs(hists[:, None, :] - hists[None, :, :]).sum(axis=-1)
+    duplicates = (
+        (hamming_matrix(dhash_bits(frames)) <= DUPLICATE_MAX_DISTANCE)
+        & (histogram_distances < SCENE_CHANGE_THRESHOLD)
+    )
+    timestamps = np.array([frame.timestamp for frame in frames], dtype=np.float64)
+    count = len(frames)
+
+    selected = []
+    # Whether each candidate near-duplicates any selected frame
+    duplicate = np.zeros(count, dtype=bool)
+    available = np.ones(count, dtype=bool)
+
+    def take(index):
+        selected.append(index)
+        available[index] = False
+        np.logical_or(duplicate, duplicates[:, index], out=duplicate)
+
+    cuts = [i for i in np.argsort(-scores, kind="stable") if scores[i] >= SCENE_CHANGE_THRESHOLD]
+    stats["scene_changes"] = len(cuts)
+    for index in cuts:
+        if len(selected) >= max_frames:
+            break
+        if not duplicate[index]:
+            take(index)
+
+    while len(selected) < max_frames:
+        eligible = available & ~duplicate
+        if not eligible.any():
+            break
+        gaps = np.abs(timestamps[:, None] - timestamps[selected][None, :]).min(axis=1)
+        gaps[~eligible] = -1.0
+        take(int(np.argmax(gaps)))
+
+    selected.sort()
+    stats["selected"] = len(selected)
+    stats["duplicates_dropped"] = int((available & duplicate).sum())
+    return [frames[i] for i in selected], stats
+
+
+# --- Follow-up keyframes ---
+_CLOCK_TIME = re.compile(r"\b(?:(\d+):)?(\d{1,2}):(\d{2})\b")
+_SECONDS = re.compile(r"(\d+(?:\.\d+)?)\s*(?:秒|s\b|sec|second)", re.IGNORECASE)
+_FRAME_NUMBER = re.compile(r"frame\s*#?\s*(\d+)|第\s*(\d+)\s*(?:張|幀|格)", re.IGNORECASE)
+_ASCII_WORD = re.compile(r"[a-z0-9]{3,}")
+_CJK_RUN = re.compile(r"[\u3400-\u9fff]+")
+# Common function characters that say nothing about what is on screen
+_CJK_STOP_CHARS = set("的了是在有一個這那些什麼嗎呢吧和與也就都我你他她它們不到說要會可以怎樣誰哪裡")
+# Words that point at a part of the video, as a position from 0 (start) to 1 (end)
+_POSITION_WORDS = {
+    0.0: ("beginning", "start", "opening", "開頭", "一開始", "開始", "最初", "剛開始"),
+    0.5: ("middle", "halfway", "中間", "中段", "一半"),
+    1.0: ("ending", "end", "last", "final", "結尾", "最後", "結束", "片尾"),
+}
+
+def _terms(text: str) -> set:
+    """
+    Words of three or more letters, plus the characters and character pairs of CJK
+    text (which has no spaces), leaving out common function characters.
+    """
+    text = text.lower()
+    terms = set(_ASCII_WORD.findall(text))
+    for run in _CJK_RUN.findall(text):
+        terms.update(char for char in run if char not in _CJK_STOP_CHARS)
+        terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def _question_targets(question: str, timestamps: list, count: int):
+    """
+    Frame indices a question points at explicitly: clock times, seconds, frame numbers
+    and words such as "beginning" or "結尾".
+    """
+    targets = []
+    times = [
+        int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+        for hours, minutes, seconds in _CLOCK_TIME.findall(question)
+    ]
+    times += [float(value) for value in _SECONDS.findall(question)]
+    if timestamps:
+        for time in times:
+            targets.append(min(range(count), key=lambda i: abs(timestamps[i] - time)))
+    for english, chinese in _FRAME_NUMBER.findall(question):
+        number = int(english or chinese)
+        if 1 <= number <= count:
+            targets.append(number - 1)
+    lowered = question.lower()
+    for position, words in _POSITION_WORDS.items():
+        if any(word in lowered for word in words):
+            targets.append(round(position * (count - 1)))
+    return targets
+
+def _description_target(question: str, description: str, count: int):
+    """
+    The frame matching the part of the description that shares most terms with the
+    question, assuming the description follows the video in order. None if nothing matches.
+    """
+    paragraphs = [line for line in description.splitlines() if line.strip()]
+    question_terms = _terms(question)
+    if not paragraphs or not question_terms:
+        return None
+    overlaps = [len(question_terms & _terms(paragraph)) for paragraph in paragraphs]
+    best = max(range(len(paragraphs)), key=overlaps.__getitem__)
+    if not overlaps[best]:
+        return None
+    position = (best + 0.5) / len(paragraphs)
+    return min(count - 1, int(position * count))
+
+def pick_keyframes(question: str, description: str, count: int, timestamps: list = None,
+                   keyframes: int = FOLLOW_UP_KEYFRAMES):
+    """
+    Chooses up to `keyframes` of `count` frames to attach to a text-only follow-up.
+    Frames the question refers to come first, then the frame for the best-matching part
+    of the description, then evenly spaced frames. Returns sorted frame indices.
+    `timestamps` (seconds, one per frame) lets clock times in the question be matched.
+    """
+    if count <= 0 or keyframes <= 0:
+        return []
+    if timestamps and len(timestamps) != count:
+        timestamps = None
+    chosen = []
+    candidates = _question_targets(question, timestamps, count)
+    matched = _description_target(question, description or "", count)
+    if matched is not None:
+        candidates.append(matched)
+    if len(candidates) < keyframes:
+        step = count / keyframes
+        candidates += [min(count - 1, int(step * (i + 0.5))) for i in range(keyframes)]
+    for index in candidates:
+        if index not in chosen:
+            chosen.append(index)
+        if len(chosen) >= keyframes:
+            break
+    return sorted(chosen)
@@ -0,0 +1,135 @@
+import asyncio
+import os
+import random
+import time
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+# --- Configuration ---
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "300"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# One client (and connection pool) per API key and base URL, shared by every analyzer
+_clients = {}
+
+
+def get_async_client(api_key: str, base_url: str = None) -> AsyncOpenAI:
+    """
+    Returns the process-wide AsyncOpenAI client for this key and base URL, so every
+    request reuses the same pool of keep-alive connections instead of opening new TLS sessions.
+    """
+    key = (api_key, base_url)
+    client = _clients.get(key)
+    if client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=60,
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+        )
+        # Retries are handled by complete() so streamed requests are never replayed mid-answer
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url or None, max_retries=0, http_client=http_client)
+        _clients[key] = client
+    return client
+
+async def close_clients():
+    for client in _clients.values():
+        await client.close()
+    _clients.clear()
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Exponential backoff with full jitter, honouring a Retry-After header when the provider sends one.
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+def usage_counts(usage) -> dict:
+    """
+    Prompt, cached-prompt and completion token counts from a response's usage. Cached
+    tokens are read from OpenAI's `prompt_tokens_details.cached_tokens`, or from the
+    Anthropic-style `cache_read_input_tokens` some compatible proxies report instead.
+    """
+    if usage is None:
+        return {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "cache_read_input_tokens", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens or 0,
+        "cached_tokens": cached or 0,
+        "completion_tokens": usage.completion_tokens or 0,
+    }
+
+class Completion:
+    def __init__(self, text: str, usage=None, first_token_seconds: float = None):
+        self.text = text
+        self.usage = usage
+        # Seconds from sending a streamed request to its first piece of text
+        self.first_token_seconds = first_token_seconds
+
+async def complete(client: AsyncOpenAI, on_delta=None, **params) -> Completion:
+    """
+    Runs a chat completion with retries on 429/5xx and connection errors.
+
+    With `on_delta`, the response is streamed and `on_delta(text)` is called for each
+    piece as it arrives. A streamed request is only retried if it failed before the
+    first piece was delivered.
+    """
+    attempt = 0
+    while True:
+        delivered = False
+        try:
+            if on_delta is None:
+                response = await client.chat.completions.create(**params)
+                return Completion(response.choices[0].message.content or "", response.usage)
+
+            parts = []
+            usage = None
+            first_token_seconds = None
+            started = time.perf_counter()
+            # include_usage adds a final chunk with token counts, which streams otherwise omit
+            stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **params)
+            # Closes the response on errors and cancellation too, so its connection returns to the pool
+            async with stream:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not delivered:
+                            first_token_seconds = time.perf_counter() - started
+                        delivered = True
+                        parts.append(delta)
+                        on_delta(delta)
+            return Completion("".join(parts), usage, first_token_seconds)
+        except Exception as e:
+            if delivered or attempt >= OPENAI_MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _retry_delay(attempt, e)
+            attempt += 1
+            print(f"Model request failed ({e.__class__.__name__}), retry {attempt}/{OPENAI_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
@@ -4,11 +4,19 @@ import sys
 import time
 import os
 
+# More than one API process or any worker processes need STATE_BACKEND=sqlite or redis
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+# Worker i serves its metrics on WORKER_METRICS_PORT + i
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
 def start_api():
     """Starts the FastAPI server using uvicorn."""
     print("Starting API server on http://127.0.0.1:8000...")
     # Using sys.executable ensures we use the python from the current environment
     command = [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", "8000"]
+    if API_WORKERS > 1:
+        command += ["--workers", str(API_WORKERS)]
     try:
         subprocess.run(command, check=True)
     except subprocess.CalledProcessError as e:
@@ -32,27 +40,46 @@ def start_bot():
         print("Error: 'bot.py' not found.", file=sys.stderr)
         print(f"Attempted to run: {' '.join(command)}", file=sys.stderr)
 
+def start_worker(index: int = 0):
+    """Starts an analysis worker that takes jobs from the shared queue."""
+    command = [sys.executable, "worker.py"]
+    env = dict(os.environ)
+    if WORKER_METRICS_PORT:
+        env["WORKER_METRICS_PORT"] = str(WORKER_METRICS_PORT + index)
+    try:
+        subprocess.run(command, check=True, env=env)
+    except subprocess.CalledProcessError as e:
+        print(f"Analysis worker failed: {e}", file=sys.stderr)
+
 
 if __name__ == "__main__":
     # Set start method for compatibility with macOS and Windows
     if sys.platform.startswith('darwin') or sys.platform.startswith('win'):
         multiprocessing.set_start_method('spawn')
 
+    if (API_WORKERS > 1 or WORKER_PROCESSES) and os.getenv("STATE_BACKEND", "memory").lower() == "memory":
+        print("API_WORKERS > 1 and WORKER_PROCESSES need STATE_BACKEND=sqlite or redis.", file=sys.stderr)
+        sys.exit(1)
+
     print("Launching API server and Discord bot...")
     
     api_process = multiprocessing.Process(target=start_api, name="API_Process")
     bot_process = multiprocessing.Process(target=start_bot, name="Bot_Process")
+    worker_processes = [
+        multiprocessing.Process(target=start_worker, args=(i,), name=f"Worker_Process_{i}") for i in range(WORKER_PROCESSES)
+    ]
+    processes = [api_process, bot_process, *worker_processes]
 
-    api_process.start()
-    bot_process.start()
+    for process in processes:
+        process.start()
 
     try:
-        api_process.join()
-        bot_process.join()
+        for process in processes:
+            process.join()
     except KeyboardInterrupt:
         print("\nShutting down services...")
-        api_process.terminate()
-        bot_process.terminate()
-        api_process.join()
-        bot_process.join()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
         print("Services terminated.")
\ No newline at end of file
@@ -0,0 +1,285 @@
+import asyncio
+import glob
+import os
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: orphans are found by age instead of by lock
+    fcntl = None
+
+import metrics
+
+# --- Configuration ---
+# Where downloads are written. Point it at a tmpfs (e.g. /dev/shm/video-analyze) to decode from RAM.
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+# Bytes all downloads in MEDIA_DIR may use together, counted across processes; 0 means no quota.
+MEDIA_QUOTA_BYTES = int(os.getenv("MEDIA_QUOTA_BYTES", str(4 * 1024 ** 3)))
+# Space always left free on the filesystem holding MEDIA_DIR.
+MEDIA_MIN_FREE_BYTES = int(os.getenv("MEDIA_MIN_FREE_BYTES", str(256 * 1024 ** 2)))
+# How long a download waits for space before the task fails.
+MEDIA_QUOTA_WAIT_SECONDS = float(os.getenv("MEDIA_QUOTA_WAIT_SECONDS", "60"))
+# How often a waiting download checks for space again
+ADMISSION_POLL_SECONDS = 0.5
+# Without file locks, directories untouched for this long count as left behind
+ORPHAN_AGE_SECONDS = 24 * 3600
+# Directories younger than this are never swept, so one still being set up is left alone
+ORPHAN_GRACE_SECONDS = 60
+RESERVATION_SUFFIX = ".reserved"
+
+
+class MediaQuotaExceeded(Exception):
+    """
+    Raised when a download cannot get disk space within MEDIA_QUOTA_WAIT_SECONDS, or
+    needs more than the quota allows at all.
+    """
+
+
+class Reservation:
+    """
+    Space set aside for one download. Every file it produces (the video, yt-dlp's
+    .part and .ytdl files, merge intermediates) starts with `path`'s name, so
+    release() removes them all.
+    """
+    def __init__(self, store, token: str, size: int):
+        self.store = store
+        self.token = token
+        self.size = size
+        self.path = os.path.join(store.directory, f"{token}.mp4")
+
+    def release(self):
+        self.store.release(self)
+
+
+class MediaStore:
+    """
+    The directory downloads are written to. Each process writes into its own
+    subdirectory and holds a lock on it while it runs, so a directory whose lock is
+    free belongs to a process that is gone and is swept with everything in it.
+
+    Each download reserves its estimated size first (admit()). Reservations are marker
+    files, so the quota holds across every process sharing MEDIA_DIR; a download that
+    outgrows its estimate counts at its real size.
+    """
+    def __init__(self, root: str = MEDIA_DIR, quota_bytes: int = MEDIA_QUOTA_BYTES,
+                 min_free_bytes: int = MEDIA_MIN_FREE_BYTES):
+        self.root = os.path.abspath(root)
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.directory = None
+        self.rejected = 0
+        self.waited = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._pid = None
+
+    def open(self):
+        """
+        Creates this process's directory and sweeps those left behind by processes that
+        exited without cleaning up. Safe to call more than once.
+        """
+        with self._lock:
+            # A forked child must not share its parent's directory or lock
+            if self.directory and self._pid == os.getpid():
+                return
+            os.makedirs(self.root, exist_ok=True)
+            self._pid = os.getpid()
+            name = f"{self._pid}-{uuid.uuid4().hex[:8]}"
+            self.directory = os.path.join(self.root, name)
+            # Locked under a hidden name and then renamed, so a sweep never finds it unlocked
+            staging = os.path.join(self.root, f".{name}") if fcntl else self.directory
+            os.makedirs(staging)
+            self._lock_file = open(os.path.join(staging, ".lock"), "w")
+            if fcntl:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.rename(staging, self.directory)
+        self.sweep()
+
+    def close(self):
+        """
+        Removes this process's directory and everything still in it.
+        """
+        with self._lock:
+            if not self.directory:
+                return
+            self._lock_file.close()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def _is_orphan(self, name: str) -> bool:
+        path = os.path.join(self.root, name)
+        if path == self.directory or not os.path.isdir(path):
+            return False
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            return False
+        if age < ORPHAN_GRACE_SECONDS:
+            return False
+        if not fcntl:
+            return age > ORPHAN_AGE_SECONDS
+        try:
+            # Without O_CREAT, so checking a directory never gives it a lock file
+            fd = os.open(os.path.join(path, ".lock"), os.O_RDWR)
+        except FileNotFoundError:
+            # No lock file: the process died while creating its directory
+            return True
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
+
+    def sweep(self) -> int:
+        """
+        Deletes the directories of processes that are no longer running. Returns the bytes freed.
+        """
+        freed = 0
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if not self._is_orphan(name):
+                continue
+            path = os.path.join(self.root, name)
+            freed += sum(size for _, size in self._files(path))
+            shutil.rmtree(path, ignore_errors=True)
+        if freed:
+            print(f"Removed {freed / 2**20:.1f} MiB of media left behind by stopped processes.")
+        return freed
+
+    # --- Accounting ---
+    @staticmethod
+    def _files(directory: str):
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            # Swept or closed by its process meanwhile
+            return
+        for entry in entries:
+            if entry.is_file() and entry.name != ".lock":
+                try:
+                    yield entry.name, entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+
+    def _usage(self):
+        """
+        (bytes counted against the quota, bytes reserved but not yet written) over all processes.
+        """
+        counted = 0
+        unwritten = 0
+        for directory in glob.glob(os.path.join(self.root, "*", "")):
+            reserved = {}
+            written = {}
+            for name, size in self._files(directory):
+                token = name.split(".", 1)[0]
+                if name.endswith(RESERVATION_SUFFIX):
+                    try:
+                        with open(os.path.join(directory, name)) as f:
+                            reserved[token] = int(f.read() or 0)
+                    except (OSError, ValueError):
+                        reserved[token] = 0
+                else:
+                    written[token] = written.get(token, 0) + size
+            for token in reserved.keys() | written.keys():
+                counted += max(reserved.get(token, 0), written.get(token, 0))
+                unwritten += max(0, reserved.get(token, 0) - written.get(token, 0))
+        return counted, unwritten
+
+    def _locked(self):
+        """
+        Serializes admission across the processes sharing the root directory.
+        """
+        lock_file = open(os.path.join(self.root, ".admission.lock"), "a")
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _fits(self, size: int, counted: int, unwritten: int) -> bool:
+        if self.quota_bytes and counted + size > self.quota_bytes:
+            return False
+        free = shutil.disk_usage(self.root).free - unwritten
+        return free - size >= self.min_free_bytes
+
+    def try_reserve(self, size: int):
+        """
+        Reserves `size` bytes if they fit in the quota and the free disk space, else returns None.
+        """
+        self.open()
+        with self._lock, self._locked():
+            counted, unwritten = self._usage()
+            if not self._fits(size, counted, unwritten):
+                return None
+            reservation = Reservation(self, uuid.uuid4().hex, size)
+            # Only a sweep without file locks can have removed it
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, reservation.token + RESERVATION_SUFFIX), "w") as f:
+                f.write(str(size))
+            return reservation
+
+    async def admit(self, size: int, timeout: float = MEDIA_QUOTA_WAIT_SECONDS) -> Reservation:
+        """
+        Waits up to `timeout` seconds for `size` bytes of space and reserves them.
+        Raises MediaQuotaExceeded if the space does not become free in time.
+        """
+        if self.quota_bytes and size > self.quota_bytes:
+            self.rejected += 1
+            raise MediaQuotaExceeded(
+                f"The video needs about {size / 2**20:.0f} MiB, more than the {self.quota_bytes / 2**20:.0f} MiB "
+                "download quota."
+            )
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            reservation = await asyncio.to_thread(self.try_reserve, size)
+            if reservation:
+                return reservation
+            if time.monotonic() >= deadline:
+                self.rejected += 1
+                raise MediaQuotaExceeded("The server is out of space for downloads right now. Please try again later.")
+            if not waited:
+                waited = True
+                self.waited += 1
+            await asyncio.sleep(ADMISSION_POLL_SECONDS)
+
+    def release(self, reservation: Reservation):
+        """
+        Deletes every file the reservation's download produced, and the reservation itself.
+        """
+        for path in glob.glob(os.path.join(glob.escape(self.directory or ""), glob.escape(reservation.token) + ".*")):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Error removing file {path}: {e}")
+
+    def stats(self):
+        if not os.path.isdir(self.root):
+            return {"directory": self.root, "quota_bytes": self.quota_bytes, "used_bytes": 0}
+        counted, unwritten = self._usage()
+        return {
+            "directory": self.root,
+            "quota_bytes": self.quota_bytes,
+            "used_bytes": counted,
+            "unwritten_bytes": unwritten,
+            "free_disk_bytes": shutil.disk_usage(self.root).free,
+            "waited": self.waited,
+            "rejected": self.rejected,
+        }
+
+
+media_store = MediaStore()
+
+MEDIA_USED = metrics.Gauge("media_used_bytes", "Bytes of downloads on disk or reserved, across processes.")
+MEDIA_QUOTA = metrics.Gauge("media_quota_bytes", "Download quota; 0 means none.")
+
+def _collect_media():
+    stats = media_store.stats()
+    MEDIA_USED.set(stats["used_bytes"])
+    MEDIA_QUOTA.set(stats["quota_bytes"])
+
+metrics.add_collector(_collect_media)
@@ -0,0 +1,323 @@
+import asyncio
+import bisect
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# --- Configuration ---
+# Threads for asyncio.to_thread() work (downloads, cache and session I/O, encoding); 0 keeps Python's default
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "0"))
+
+# Bucket upper bounds shared by several histograms
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(2 ** exponent for exponent in range(16, 26))  # 64 KiB to 32 MiB
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        _metrics.append(self)
+
+    def _key(self, labels: dict):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """
+    A total that only goes up, e.g. tokens used or messages sent.
+    """
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. Gauges describing other objects (queue depth, pool
+    usage) are usually set by a collector just before each scrape.
+    """
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations into cumulative buckets, so quantiles can be computed across
+    scrapes and instances (e.g. `histogram_quantile(0.95, ...)` in Prometheus).
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            for key, series in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip((*self.buckets, math.inf), series["counts"]):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(round(series['sum'], 6))}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def add_collector(callback):
+    """
+    Registers a function that is called before every scrape to refresh gauges.
+    """
+    _collectors.append(callback)
+
+def render() -> str:
+    """
+    All metrics of this process in the Prometheus text exposition format.
+    """
+    for callback in _collectors:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Metrics collector {getattr(callback, '__name__', callback)} failed: {e}")
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Pipeline metrics ---
+DOWNLOAD_SECONDS = Histogram(
+    "video_download_seconds", "Time to download or resolve a video, by source (download, stream, pipe).", ["source"]
+)
+DECODE_SECONDS = Histogram(
+    "frame_decode_seconds", "Time spent seeking and decoding frames, by extraction strategy.", ["strategy"]
+)
+SELECT_SECONDS = Histogram("frame_select_seconds", "Time spent picking frames from the decoded candidates.")
+ENCODE_SECONDS = Histogram("frame_encode_seconds", "Time spent resizing and JPEG-encoding the frames of one video.")
+EXTRACTION_SECONDS = Histogram("frame_extraction_seconds", "Total frame extraction time per video, by strategy.", ["strategy"])
+PAYLOAD_BYTES = Histogram(
+    "payload_bytes", "Base64 image bytes sent with one analysis request.", buckets=BYTES_BUCKETS
+)
+PAYLOAD_IMAGES = Histogram("payload_images", "Images sent with one analysis request.", buckets=(1, 2, 4, 8, 12, 16, 20, 32, 64, 96))
+MODEL_SECONDS = Histogram("model_request_seconds", "Latency of one model request, by phase.", ["phase"])
+MODEL_FIRST_TOKEN_SECONDS = Histogram(
+    "model_first_token_seconds", "Time until the first streamed token of a model request, by phase.", ["phase"]
+)
+MODEL_TOKENS = Histogram(
+    "model_request_tokens", "Tokens used by one model request, by phase and kind (prompt, cached, completion).",
+    ["phase", "kind"], buckets=TOKEN_BUCKETS,
+)
+MODEL_TOKENS_TOTAL = Counter("model_tokens_total", "Tokens used by model requests, by phase and kind.", ["phase", "kind"])
+MODEL_ERRORS = Counter("model_request_errors_total", "Model requests that raised an error, by phase.", ["phase"])
+ANALYSIS_SECONDS = Histogram("analysis_seconds", "End-to-end time of an analysis job, by outcome.", ["outcome"])
+QUEUE_WAIT_SECONDS = Histogram("analysis_queue_wait_seconds", "Time analysis jobs spent waiting in the queue.")
+
+# --- Saturation gauges ---
+QUEUE_DEPTH = Gauge("analysis_queue_depth", "Analysis jobs waiting in the queue.")
+QUEUE_ACTIVE = Gauge("analysis_jobs_active", "Analysis jobs running, as reported by the state backend.")
+LIVE_ANALYZERS = Gauge("video_analyzers_live", "VideoAnalyzer objects alive in this process, i.e. frames held in memory.")
+STAGE_ACTIVE = Gauge("stage_active", "Jobs inside a concurrency-limited stage in this process.", ["stage"])
+STAGE_WAITING = Gauge("stage_waiting", "Jobs waiting to enter a concurrency-limited stage in this process.", ["stage"])
+STAGE_LIMIT = Gauge("stage_limit", "Concurrency limit of a stage in this process.", ["stage"])
+THREAD_POOL_WORKERS = Gauge("thread_pool_max_workers", "Size of the thread pool behind asyncio.to_thread().")
+THREAD_POOL_ACTIVE = Gauge("thread_pool_active", "Thread pool tasks running.")
+THREAD_POOL_QUEUED = Gauge("thread_pool_queued", "Thread pool tasks waiting for a free thread.")
+EXTRACT_POOL_WORKERS = Gauge("extraction_pool_workers", "Frame extraction worker processes.")
+EXTRACT_POOL_IN_FLIGHT = Gauge("extraction_pool_in_flight", "Frame extractions submitted to the process pool and not yet done.")
+
+
+# --- Thread pool ---
+class InstrumentedThreadPool(ThreadPoolExecutor):
+    """
+    The event loop's default executor, counting running and waiting tasks so
+    saturation of asyncio.to_thread() shows up in /metrics.
+    """
+    def __init__(self, max_workers: int = None):
+        super().__init__(max_workers=max_workers, thread_name_prefix="asyncio")
+        self.active = 0
+        self.queued = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with _lock:
+            self.queued += 1
+
+        def run():
+            with _lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with _lock:
+                    self.active -= 1
+        return super().submit(run)
+
+_thread_pool = None
+
+def install_thread_pool(loop: asyncio.AbstractEventLoop = None):
+    """
+    Makes an InstrumentedThreadPool the default executor of the running event loop.
+    """
+    global _thread_pool
+    _thread_pool = InstrumentedThreadPool(THREAD_POOL_SIZE or None)
+    (loop or asyncio.get_running_loop()).set_default_executor(_thread_pool)
+
+def _collect_thread_pool():
+    if _thread_pool:
+        THREAD_POOL_WORKERS.set(_thread_pool._max_workers)
+        THREAD_POOL_ACTIVE.set(_thread_pool.active)
+        THREAD_POOL_QUEUED.set(_thread_pool.queued)
+
+add_collector(_collect_thread_pool)
+
+
+# --- Recording helpers ---
+def observe_extraction(strategy: str, timings: dict, payload_report: dict = None):
+    """
+    Records the timings of one frame extraction (see FramePayload.timings) and its payload size.
+    """
+    if strategy in timings:
+        DECODE_SECONDS.observe(timings[strategy], strategy=strategy)
+    if "select" in timings:
+        SELECT_SECONDS.observe(timings["select"])
+    if "encode" in timings:
+        ENCODE_SECONDS.observe(timings["encode"])
+    if "total" in timings:
+        EXTRACTION_SECONDS.observe(timings["total"], strategy=strategy)
+    if payload_report:
+        PAYLOAD_BYTES.observe(payload_report["payload_bytes"])
+        PAYLOAD_IMAGES.observe(payload_report["images"])
+
+def observe_model_request(phase: str, seconds: float, counts: dict, first_token_seconds: float = None):
+    """
+    Records the latency and token usage of one model request (`counts` as from llm_client.usage_counts).
+    """
+    MODEL_SECONDS.observe(seconds, phase=phase)
+    if first_token_seconds is not None:
+        MODEL_FIRST_TOKEN_SECONDS.observe(first_token_seconds, phase=phase)
+    for key, value in counts.items():
+        kind = key.removesuffix("_tokens")
+        MODEL_TOKENS.observe(value, phase=phase, kind=kind)
+        MODEL_TOKENS_TOTAL.inc(value, phase=phase, kind=kind)
+
+
+class Timings:
+    """
+    Wall-clock seconds of the stages of one task, kept as the structured `timings`
+    shown in /status. `stage()` can be used around a block or `add()` for a known duration.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = round(self.stages.get(name, 0.0) + seconds, 4)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        return {**self.stages, "total": round(self.elapsed(), 4)}
+
+
+# --- Standalone endpoint ---
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else "/"
+        if path.split("?")[0] == "/metrics":
+            body = render().encode()
+            status = "200 OK"
+        else:
+            body = b"Not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(port: int, host: str = "127.0.0.1"):
+    """
+    Serves GET /metrics on its own port, for processes without a web server of their
+    own (the Discord bot and worker.py). Returns the asyncio server.
+    """
+    server = await asyncio.start_server(_handle_scrape, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# --- Configuration ---
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "4"))
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", "32"))
+STAGE_LIMITS = {
+    "download": int(os.getenv("DOWNLOAD_CONCURRENCY", "2")),
+    "decode": int(os.getenv("DECODE_CONCURRENCY", str(os.cpu_count() or 2))),
+    "model": int(os.getenv("MODEL_CONCURRENCY", "4")),
+}
+
+
+class QueueFull(Exception):
+    """
+    Raised by JobScheduler.submit when the queue is full. `retry_after` is a
+    suggested number of seconds to wait before trying again.
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f"Analysis queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class StageLimits:
+    """
+    Separate concurrency limits for the download, decode and model stages, so a burst
+    of jobs cannot run an unbounded number of any one of them at the same time.
+    """
+    def __init__(self, limits: dict):
+        self.limits = dict(limits)
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+        self.active = {name: 0 for name in limits}
+        self.waiting = {name: 0 for name in limits}
+
+    @asynccontextmanager
+    async def stage(self, name: str, timings=None):
+        """
+        Holds one slot of stage `name`. With `timings` (a metrics.Timings), the time spent
+        waiting for the slot is added as "<name>_wait" and the time holding it as `name`.
+        """
+        semaphore = self._semaphores[name]
+        self.waiting[name] += 1
+        requested = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[name] -= 1
+        acquired = time.perf_counter()
+        self.active[name] += 1
+        try:
+            yield
+        finally:
+            self.active[name] -= 1
+            semaphore.release()
+            if timings is not None:
+                timings.add(f"{name}_wait", acquired - requested)
+                timings.add(name, time.perf_counter() - acquired)
+
+    def stats(self):
+        return {
+            name: {"limit": self.limits[name], "active": self.active[name], "waiting": self.waiting[name]}
+            for name in self.limits
+        }
+
+
+class Job:
+    def __init__(self, job_id: str, run, user_id: str, priority: int):
+        self.id = job_id
+        self.run = run
+        self.user_id = user_id
+        self.priority = priority
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def wait_seconds(self):
+        return (self.started_at or time.time()) - self.enqueued_at
+
+
+class JobScheduler:
+    """
+    A bounded priority queue of analysis jobs drained by a fixed pool of worker tasks.
+
+    Jobs run in order of priority (lower numbers first). Within one priority, users
+    take turns: each job gets the next round number for its user, and a new user starts
+    at the current round, so one user's burst cannot starve everyone else.
+    """
+    def __init__(self, workers: int = ANALYSIS_WORKERS, max_queue: int = ANALYSIS_QUEUE_SIZE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._heap = []
+        self._jobs = {}
+        self._sequence = itertools.count()
+        self._user_rounds = {}
+        self._current_round = 0
+        self._ready = None
+        self._worker_tasks = []
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self._recent_waits = deque(maxlen=100)
+        self._recent_durations = deque(maxlen=100)
+
+    def _ensure_workers(self):
+        if self._worker_tasks:
+            return
+        self._ready = asyncio.Semaphore(0)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def retry_after(self) -> int:
+        average = sum(self._recent_durations) / len(self._recent_durations) if self._recent_durations else 30.0
+        return max(1, math.ceil(average * (len(self._heap) + 1) / self.workers))
+
+    def submit(self, job_id: str, run, user_id: str = None, priority: int = 0) -> Job:
+        """
+        Queues `run` (a zero-argument coroutine function). Raises QueueFull when the queue is at capacity.
+        """
+        self._ensure_workers()
+        if len(self._heap) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+
+        user_key = user_id or job_id
+        user_round = max(self._current_round, self._user_rounds.get(user_key, -1) + 1)
+        self._user_rounds[user_key] = user_round
+
+        job = Job(job_id, run, user_id, priority)
+        self._jobs[job_id] = job
+        heapq.heappush(self._heap, (priority, user_round, next(self._sequence), job))
+        self._ready.release()
+        return job
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            _, user_round, _, job = heapq.heappop(self._heap)
+            self._current_round = max(self._current_round, user_round)
+            job.started_at = time.time()
+            self._recent_waits.append(job.wait_seconds)
+            self.active += 1
+            try:
+                await job.run()
+            except Exception as e:
+                print(f"Job {job.id} raised an unexpected error: {e}")
+            finally:
+                self.active -= 1
+                self.completed += 1
+                job.finished_at = time.time()
+                self._recent_durations.append(job.finished_at - job.started_at)
+                self._jobs.pop(job.id, None)
+
+    def position(self, job_id: str):
+        """
+        1-based position of a queued job in run order, or None if it is not waiting.
+        """
+        job = self._jobs.get(job_id)
+        if not job or job.started_at:
+            return None
+        return sum(1 for entry in self._heap if entry[:3] < self._entry_key(job)) + 1
+
+    def _entry_key(self, job: Job):
+        for entry in self._heap:
+            if entry[3] is job:
+                return entry[:3]
+        return (math.inf,)
+
+    def job(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        waits = self._recent_waits
+        return {
+            "depth": len(self._heap),
+            "max_depth": self.max_queue,
+            "active": self.active,
+            "workers": self.workers,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(sum(waits) / len(waits), 3) if waits else None,
+            "max_wait_seconds": round(max(waits), 3) if waits else None,
+        }
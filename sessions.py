@@ -0,0 +1,298 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# --- Configuration ---
+# Memory budget for follow-up sessions and their frames; least recently used sessions spill to disk above it.
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(128 * 1024 * 1024)))
+# Sessions not used for this long are deleted, from memory and disk alike.
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(24 * 3600)))
+# SQLite file that evicted sessions spill to; empty drops them instead.
+SESSION_SPILL_PATH = os.getenv("SESSION_SPILL_PATH", "sessions.sqlite3")
+# Follow-up turns older than this many (estimated) tokens are folded into a short summary.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+SUMMARY_QUESTION_CHARS = 200
+SUMMARY_ANSWER_CHARS = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    task_id TEXT PRIMARY KEY,
+    frames_key TEXT NOT NULL,
+    description TEXT NOT NULL,
+    history TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    timestamps TEXT NOT NULL,
+    usage TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    fingerprint TEXT,
+    chapters TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS session_frames (
+    frames_key TEXT PRIMARY KEY,
+    frames TEXT NOT NULL
+);
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count without a tokenizer: about four ASCII characters per token,
+    and one token per other character (CJK text is mostly one token per character).
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + len(text) - ascii_chars
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+def compact_history(history: list, summary: list, budget: int = HISTORY_TOKEN_BUDGET):
+    """
+    Keeps the newest question/answer pairs of `history` that fit in `budget` tokens and
+    folds the older ones into `summary`, a list of short "Q: ... A: ..." notes. The
+    summary itself is held to a quarter of the budget by dropping its oldest notes.
+    Returns the new (history, summary).
+    """
+    used = 0
+    keep_from = len(history)
+    for start in range(len(history) - 2, -1, -2):
+        tokens = sum(estimate_tokens(message["content"]) for message in history[start:start + 2])
+        if used + tokens > budget:
+            break
+        used += tokens
+        keep_from = start
+    if keep_from == 0:
+        return history, summary
+
+    summary = list(summary)
+    for i in range(0, keep_from, 2):
+        question, answer = history[i]["content"], history[i + 1]["content"]
+        summary.append(f"Q: {_clip(question, SUMMARY_QUESTION_CHARS)}\nA: {_clip(answer, SUMMARY_ANSWER_CHARS)}")
+    while summary and sum(estimate_tokens(note) for note in summary) > budget // 4:
+        summary.pop(0)
+    return history[keep_from:], summary
+
+
+class Session:
+    """
+    What a follow-up conversation needs: the analysis text, the follow-up turns since,
+    a summary of compacted turns, and a reference to the frames (shared between sessions
+    of the same video) with their timestamps. `usage` carries the task's token counts;
+    `fingerprint` and `chapters` rebuild the same prompt prefix and cache key for follow-ups.
+    """
+    def __init__(self, task_id: str, frames_key: str, description: str, history: list = None,
+                 summary: list = None, timestamps: list = None, usage: dict = None, accessed: float = None,
+                 fingerprint: str = None, chapters: list = None):
+        self.task_id = task_id
+        self.frames_key = frames_key
+        self.description = description
+        self.history = history or []
+        self.summary = summary or []
+        self.timestamps = timestamps or []
+        self.usage = usage or {}
+        self.accessed = accessed or time.time()
+        self.fingerprint = fingerprint
+        self.chapters = chapters or []
+        self.frames = None
+
+    @property
+    def size(self) -> int:
+        text = [self.description, *self.summary, *(message["content"] for message in self.history)]
+        return sum(len(part.encode("utf-8")) for part in text)
+
+
+class SessionStore:
+    """
+    Bounded store of follow-up sessions.
+
+    Sessions live in memory in LRU order. Frames are stored once per `frames_key` and
+    reference-counted, so every session of one video shares a single copy. When sessions
+    and frames together exceed `max_bytes`, the least recently used sessions are written
+    to SQLite at `spill_path` (or dropped, without one) and loaded back on their next use.
+    A `max_bytes` of 0 writes every session straight through to disk, so processes
+    sharing `spill_path` see each other's sessions.
+    """
+    def __init__(self, max_bytes: int = SESSION_MAX_BYTES, ttl: int = SESSION_TTL_SECONDS,
+                 spill_path: str = SESSION_SPILL_PATH):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        # frames_key -> [frames, reference count, size in bytes]
+        self._frames = {}
+        self._bytes = 0
+        self.spills = 0
+        self.restores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if spill_path:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+            # Spill files written before sessions kept their fingerprint and chapters
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(sessions)")}
+            if "fingerprint" not in columns:
+                self._db.execute("ALTER TABLE sessions ADD COLUMN fingerprint TEXT")
+            if "chapters" not in columns:
+                self._db.execute("ALTER TABLE sessions ADD COLUMN chapters TEXT NOT NULL DEFAULT '[]'")
+
+    def _hold_frames(self, frames_key: str, frames: list):
+        held = self._frames.get(frames_key)
+        if held:
+            held[1] += 1
+            return
+        size = sum(len(frame) for frame in frames)
+        self._frames[frames_key] = [frames, 1, size]
+        self._bytes += size
+
+    def _release_frames(self, frames_key: str):
+        held = self._frames[frames_key]
+        held[1] -= 1
+        if held[1] > 0:
+            return
+        if self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO session_frames (frames_key, frames) VALUES (?, ?)",
+                (frames_key, json.dumps(held[0])),
+            )
+        del self._frames[frames_key]
+        self._bytes -= held[2]
+
+    def _add(self, session: Session, frames: list):
+        self._hold_frames(session.frames_key, frames)
+        session.frames = self._frames[session.frames_key][0]
+        self._sessions[session.task_id] = session
+        self._bytes += session.size
+
+    def _remove(self, task_id: str) -> Session:
+        session = self._sessions.pop(task_id)
+        self._bytes -= session.size
+        self._release_frames(session.frames_key)
+        return session
+
+    def _spill(self):
+        while self._bytes > self.max_bytes and self._sessions:
+            task_id = next(iter(self._sessions))
+            session = self._remove(task_id)
+            if self._db:
+                self._write(session)
+                self.spills += 1
+            else:
+                self.evictions += 1
+        if self._db:
+            self._db.commit()
+
+    def _write(self, session: Session):
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions "
+            "(task_id, frames_key, description, history, summary, timestamps, usage, accessed, fingerprint, chapters) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (session.task_id, session.frames_key, session.description, json.dumps(session.history),
+             json.dumps(session.summary), json.dumps(session.timestamps), json.dumps(session.usage), session.accessed,
+             session.fingerprint, json.dumps(session.chapters)),
+        )
+
+    def save(self, session: Session, frames: list):
+        """
+        Stores a new or updated session. `frames` is only kept if no session holds
+        frames under the same key yet.
+        """
+        session.accessed = time.time()
+        with self._lock:
+            previous = self._sessions.get(session.task_id)
+            if previous:
+                # An updated conversation keeps the frames it already holds
+                session.frames_key = previous.frames_key
+                session.frames = previous.frames
+                self._sessions[session.task_id] = session
+                self._sessions.move_to_end(session.task_id)
+                self._bytes += session.size - previous.size
+            else:
+                self._add(session, frames)
+            self._spill()
+
+    def load(self, task_id: str):
+        """
+        Returns the session with its `frames` filled in, reading it back from disk if it
+        was spilled, or None if it does not exist or has expired.
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(task_id)
+            if session:
+                if now - session.accessed > self.ttl:
+                    self._remove(task_id)
+                    return None
+                session.accessed = now
+                self._sessions.move_to_end(task_id)
+                return session
+            if not self._db:
+                return None
+
+            row = self._db.execute(
+                "SELECT s.frames_key, s.description, s.history, s.summary, s.timestamps, s.usage, s.fingerprint, "
+                "s.chapters, f.frames FROM sessions s "
+                "LEFT JOIN session_frames f ON f.frames_key = s.frames_key WHERE s.task_id = ? AND s.accessed > ?",
+                (task_id, now - self.ttl),
+            ).fetchone()
+            if not row:
+                return None
+            frames_key, description, history, summary, timestamps, usage, fingerprint, chapters, frames = row
+            # Frames still in memory for another session are shared, not read back
+            held = self._frames.get(frames_key)
+            if not held and frames is None:
+                return None
+            session = Session(
+                task_id, frames_key, description, json.loads(history), json.loads(summary),
+                json.loads(timestamps), json.loads(usage), now, fingerprint, json.loads(chapters),
+            )
+            self._add(session, held[0] if held else json.loads(frames))
+            self._db.execute("DELETE FROM sessions WHERE task_id = ?", (task_id,))
+            self.restores += 1
+            self._spill()
+            return session
+
+    def expire(self):
+        """
+        Deletes sessions idle for longer than the TTL, in memory and on disk.
+        """
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [task_id for task_id, session in self._sessions.items() if session.accessed <= cutoff]
+            for task_id in expired:
+                self._remove(task_id)
+            if self._db:
+                expired_rows = self._db.execute("DELETE FROM sessions WHERE accessed <= ?", (cutoff,)).rowcount
+                self._db.execute("DELETE FROM session_frames WHERE frames_key NOT IN (SELECT frames_key FROM sessions)")
+                self._db.commit()
+                return len(expired) + expired_rows
+            return len(expired)
+
+    def close(self):
+        """
+        Spills every session to disk so they survive a restart.
+        """
+        with self._lock:
+            if not self._db:
+                return
+            while self._sessions:
+                self._write(self._remove(next(iter(self._sessions))))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            on_disk = self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] if self._db else 0
+            return {
+                "in_memory": len(self._sessions),
+                "frame_sets": len(self._frames),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "on_disk": on_disk,
+                "spills": self.spills,
+                "restores": self.restores,
+                "evictions": self.evictions,
+                "ttl_seconds": self.ttl,
+            }
@@ -1,39 +1,302 @@
+import copy
 import re
+import unicodedata
 
-async def splitmsg(text: str, max_length: int = 2000):
+# Discord 的訊息長度上限，以 UTF-16 字元單位計算（表情符號等 BMP 以外的字元佔 2）
+MAX_MESSAGE_LENGTH = 2000
+FENCE = "```"
+# 重新開啟程式碼區塊時沿用的開頭行（如 ```python）最多這麼長，否則只用 ```
+MAX_FENCE_HEADER = 100
+# 斷行時若最後一個空白落在視窗前半段，就直接硬切，不為了空白浪費半個區塊
+MIN_BREAK_FRACTION = 0.5
+
+ZWJ = "\u200d"
+# 斷開後的下一段若以 ``` 開頭（前面可有空白），會被當成程式碼區塊的開頭或結尾
+_FENCE_AHEAD = re.compile(r"\s*```")
+
+
+def message_length(text: str) -> int:
+    """
+    以 UTF-16 字元單位計算文字長度，與 Discord 的計算方式相同。
+    """
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+def _prefix_for_length(text: str, length: int) -> int:
+    """
+    回傳 UTF-16 長度不超過 `length` 的最長前綴所含的字元數。
+    """
+    prefix = text[:length]
+    if prefix.isascii() or message_length(prefix) == len(prefix):
+        return len(prefix)
+    units = 0
+    for i, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > length:
+            return i
+    return len(text)
+
+def _is_extender(char: str) -> bool:
+    """
+    是否為必須與前一個字元留在一起的字元：組合符號、ZWJ、變體選擇符、膚色修飾符與標籤字元。
+    """
+    code = ord(char)
+    return (
+        char == ZWJ
+        or 0xFE00 <= code <= 0xFE0F
+        or 0x1F3FB <= code <= 0x1F3FF
+        or 0xE0020 <= code <= 0xE007F
+        or 0xE0100 <= code <= 0xE01EF
+        or unicodedata.combining(char) != 0
+    )
+
+def _is_regional_indicator(char: str) -> bool:
+    return 0x1F1E6 <= ord(char) <= 0x1F1FF
+
+def _splits_cluster(text: str, index: int) -> bool:
+    """
+    在 `index` 之前斷開是否會拆散一個字素（例如國旗、ZWJ 組合表情或帶附加符號的字母）。
+    """
+    if not 0 < index < len(text):
+        return False
+    char, previous = text[index], text[index - 1]
+    if _is_extender(char) or previous == ZWJ:
+        return True
+    if _is_regional_indicator(char) and _is_regional_indicator(previous):
+        # 國旗由兩個區域指示符組成；前面連續奇數個時，這裡正好在一面國旗中間
+        run = 0
+        while index - run - 1 >= 0 and _is_regional_indicator(text[index - run - 1]):
+            run += 1
+        return run % 2 == 1
+    return False
+
+def _bad_break(text: str, index: int) -> bool:
+    return _splits_cluster(text, index) or _FENCE_AHEAD.match(text, index) is not None
+
+def _break_index(text: str, start: int, length: int) -> int:
+    """
+    找出把過長的一行從 `start` 起切下不超過 `length` 單位的位置（在 `text` 中的索引）：
+    優先在空白之後斷開，否則硬切（中日韓文字本來就可以在任意字元之間斷行），
+    但不拆散字素，也不讓下一段以 ``` 開頭。
+    """
+    # 斷點只看得到視窗內的文字，所以每一段只需要複製視窗大小
+    limit = start + max(1, _prefix_for_length(text[start:start + length], length))
+    space = max(text.rfind(" ", start, limit), text.rfind("\t", start, limit))
+    cut = space + 1 if space - start >= (limit - start) * MIN_BREAK_FRACTION else limit
+    while cut > start + 1 and _bad_break(text, cut):
+        cut -= 1
+    # 整個視窗都找不到合適的位置時只能硬切
+    return limit if _bad_break(text, cut) else cut
+
+def _is_fence(line: str) -> bool:
+    return line.strip().startswith(FENCE)
+
+
+class MessageSplitter:
+    """
+    把文字切成不超過 `max_length` 的 Discord 訊息區塊，可以一次給完整文字，
+    也可以像模型串流輸出那樣一段一段餵入。
+
+    文字以行為單位累積在清單中，每個區塊只在定案時 join 一次，整體為線性時間。
+    超過一個區塊的行會被斷開（見 _break_index）。程式碼區塊跨越區塊邊界時，
+    會在前一個區塊結尾補上 ```，並在下一個區塊開頭以相同的開頭行（如 ```python）重新開啟。
+
+    已定案的區塊放在 `chunks`，之後不會再改變；pending() 回傳尚未定案的部分目前的樣子。
+    """
+    def __init__(self, max_length: int = MAX_MESSAGE_LENGTH):
+        self.max_length = max_length
+        self.chunks = []
+        # 目前區塊的各行，與其 UTF-16 長度（含換行）
+        self._parts = []
+        self._size = 0
+        # 目前區塊中除了重新開啟的開頭行以外是否有內容
+        self._has_content = False
+        # 目前所在程式碼區塊的開頭行，不在程式碼區塊內時為 None
+        self._fence = None
+        # 目前區塊的最後一行是否是剛開啟程式碼區塊的那一行
+        self._just_opened = False
+        # 尚未收到換行的最後一行，以片段清單保存
+        self._line = []
+        self._line_chars = 0
+        # 這一行是否已被斷開過；斷開過的行不再視為程式碼區塊的開頭或結尾
+        self._line_wrapped = False
+
+    # --- 餵入文字 ---
+    def feed(self, text: str) -> list:
+        """
+        加入一段文字，回傳因此定案的區塊。
+        """
+        start = len(self.chunks)
+        lines = text.split("\n")
+        self._extend_line(lines[0])
+        for line in lines[1:]:
+            self._end_line()
+            self._extend_line(line)
+        return self.chunks[start:]
+
+    def finish(self) -> list:
+        """
+        結束輸入，回傳最後定案的區塊。
+        """
+        start = len(self.chunks)
+        self._end_line()
+        self._flush_chunk(final=True)
+        return self.chunks[start:]
+
+    def pending(self) -> list:
+        """
+        尚未定案的文字若現在結束輸入會切成的區塊，供串流時顯示。不改變狀態。
+        """
+        clone = copy.copy(self)
+        clone.chunks = []
+        clone._parts = list(self._parts)
+        clone.finish()
+        return clone.chunks
+
+    def _extend_line(self, piece: str):
+        if not piece:
+            return
+        self._line.append(piece)
+        self._line_chars += len(piece)
+        if self._line_chars > self.max_length:
+            # 這行無論如何都放不進一個區塊：先切下確定的部分，讓未完成的行維持在一個區塊以內
+            line = "".join(self._line)
+            line = self._wrap(line, toggles=_is_fence(line) and not self._line_wrapped)
+            self._line = [line] if line else []
+            self._line_chars = len(line)
+            self._line_wrapped = True
+
+    def _end_line(self):
+        line = "".join(self._line)
+        toggles = _is_fence(line) and not self._line_wrapped
+        self._line = []
+        self._line_chars = 0
+        self._line_wrapped = False
+        if message_length(line) > self._fresh_room(self._open_after(toggles)):
+            line = self._wrap(line, toggles)
+            toggles = False
+        self._add_line(line, toggles)
+
+    # --- 區塊 ---
+    def _open_after(self, toggles: bool) -> bool:
+        """
+        加入一行後是否位於程式碼區塊內，也就是區塊結尾是否得補上 ```。
+        """
+        return self._fence is None if toggles else self._fence is not None
+
+    def _room(self, closing: bool) -> int:
+        """
+        目前區塊還能放下的一行長度；`closing` 表示結尾還得補上 ```。
+        """
+        separator = 1 if self._parts else 0
+        return self.max_length - self._size - separator - (len(FENCE) + 1 if closing else 0)
+
+    def _fresh_room(self, closing: bool) -> int:
+        """
+        一個新區塊（在程式碼區塊內時含重新開啟的開頭行）能放下的一行長度。
+        """
+        header = message_length(self._header()) + 1 if self._fence else 0
+        return self.max_length - header - (len(FENCE) + 1 if closing else 0)
+
+    def _header(self) -> str:
+        limit = min(MAX_FENCE_HEADER, self.max_length // 4)
+        return self._fence if message_length(self._fence) <= limit else FENCE
+
+    def _append(self, line: str, length: int):
+        self._size += length + (1 if self._parts else 0)
+        self._parts.append(line)
+        self._has_content = True
+        self._just_opened = False
+
+    def _add_line(self, line: str, toggles: bool):
+        length = message_length(line)
+        closing = self._open_after(toggles)
+        # 移到下一個區塊的開頭行可能比重新開啟的開頭行長，所以可能要再定案一次
+        while length > self._room(closing) and self._has_content:
+            self._flush_chunk()
+        self._append(line, length)
+        if toggles:
+            self._fence = None if self._fence else line.strip()
+            self._just_opened = self._fence is not None
+
+    def _wrap(self, line: str, toggles: bool) -> str:
+        """
+        從過長的一行前面切下完整區塊，直到剩下的部分放得進一個新區塊，回傳剩下的部分。
+        `toggles` 表示這行是程式碼區塊的開頭或結尾；切下的第一段會開啟或關閉程式碼區塊。
+        """
+        if not self._just_opened:
+            self._flush_chunk()
+        start = 0
+        remaining = message_length(line)
+        while toggles or remaining > self._fresh_room(self._open_after(False)):
+            closing = self._open_after(toggles)
+            room = self._room(closing)
+            if self._just_opened and room < self._fresh_room(closing) * MIN_BREAK_FRACTION:
+                # 剛開啟程式碼區塊的那一行佔掉了大半個區塊
+                self._flush_chunk()
+                continue
+            end = _break_index(line, start, room)
+            piece = line[start:end]
+            self._add_line(piece, toggles)
+            self._flush_chunk()
+            toggles = False
+            start = end
+            remaining -= message_length(piece)
+        return line[start:]
+
+    def _flush_chunk(self, final: bool = False):
+        """
+        定案目前的區塊，必要時關閉並在下一個區塊重新開啟程式碼區塊。
+        """
+        parts = self._parts
+        if not self._has_content:
+            return
+        opener = None
+        if self._fence and self._just_opened and len(parts) > 1 and not final:
+            # 區塊最後一行剛開啟程式碼區塊：把它原樣移到下一個區塊，不送出空的程式碼區塊
+            opener = parts.pop()
+        elif self._fence:
+            parts.append(FENCE)
+        chunk = "\n".join(parts)
+        # Discord 不接受空白訊息
+        if chunk.strip():
+            self.chunks.append(chunk)
+        self._parts = []
+        self._size = 0
+        self._has_content = False
+        self._just_opened = False
+        if opener is not None:
+            self._append(opener, message_length(opener))
+            self._just_opened = True
+        elif self._fence and not final:
+            header = self._header()
+            self._size = message_length(header)
+            self._parts = [header]
+
+
+def iter_chunks(pieces, max_length: int = MAX_MESSAGE_LENGTH):
+    """
+    逐段讀入文字（例如模型的串流輸出），每當一個區塊定案就產生它。
+    """
+    splitter = MessageSplitter(max_length)
+    for piece in pieces:
+        yield from splitter.feed(piece)
+    yield from splitter.finish()
+
+def splitmsg(text: str, max_length: int = MAX_MESSAGE_LENGTH):
     """
-    將長訊息分割成多個較短的區塊，同時避免在程式碼區塊內分割。
+    將長訊息分割成多個較短的區塊，每個區塊都不超過 Discord 的長度上限。
+    程式碼區塊跨越區塊時會被關閉並重新開啟，過長的單行會被斷開。
 
     Args:
         text (str): 要分割的原始文字。
-        max_length (int): 每個區塊的最大長度。
+        max_length (int): 每個區塊的最大長度（UTF-16 字元單位）。
 
     Returns:
         list[str]: 分割後的訊息區塊列表。
     """
-    chunks = []
-    current_chunk = ""
-    in_code_block = False
-    lines = text.split('\n')
-
-    for line in lines:
-        # 檢查是否為程式碼區塊的開頭或結尾
-        if line.strip().startswith('```'):
-            in_code_block = not in_code_block
-        
-        # 如果將此行加入目前的區塊會超過最大長度，且不在程式碼區塊內
-        if len(current_chunk) + len(line) + 1 > max_length and not in_code_block:
-            if current_chunk:
-                chunks.append(current_chunk)
-            current_chunk = line
-        else:
-            if current_chunk:
-                current_chunk += '\n' + line
-            else:
-                current_chunk = line
-
-    # 加入最後剩餘的區塊
-    if current_chunk:
-        chunks.append(current_chunk)
-
-    return chunks
\ No newline at end of file
+    splitter = MessageSplitter(max_length)
+    splitter.feed(text)
+    splitter.finish()
+    return splitter.chunks
@@ -0,0 +1,615 @@
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from scheduler import ANALYSIS_QUEUE_SIZE, ANALYSIS_WORKERS, JobScheduler, QueueFull
+
+# --- Configuration ---
+# "memory" keeps task state and the job queue in this process (one API process only);
+# "sqlite" shares them between processes on one host through STATE_PATH;
+# "redis" shares them between hosts through REDIS_URL.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_PATH = os.getenv("STATE_PATH", "state.sqlite3")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "video-analyze:")
+# How often shared backends are polled for new task events and queued jobs
+STATE_POLL_INTERVAL = float(os.getenv("STATE_POLL_INTERVAL", "0.2"))
+# An in-flight analysis older than this is assumed to belong to a dead worker
+FLIGHT_TIMEOUT_SECONDS = 3600
+# A claimed job whose worker has not renewed its claim for this long is queued again
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Redis keys expire on their own instead of being swept
+REDIS_TASK_TTL_SECONDS = 2 * 3600
+# Weight of the newest job in the moving averages of queue wait and job duration
+_AVERAGE_WEIGHT = 0.2
+
+
+class StateBackend:
+    """
+    Where task state lives: each task's fields, its event log ("status", "delta" and a
+    final "done" event), in-flight analyses for request coalescing, and the job queue.
+
+    A task that joined another task's analysis follows it: get_task() returns the leader's
+    fields plus its own, and read_events() reads the leader's log. start_flight() links
+    a joining task to the leader in the same step. The leader ends its flight before it
+    reads its followers, so no task can join after that.
+
+    Subclasses provide the storage. Shared backends block on disk or network I/O, so the
+    event loop reaches them through call(); they are polled for new events and jobs.
+    Workers renew the claim on their job while it runs, and jobs of workers that stopped
+    renewing are queued again.
+    """
+    shared = True
+
+    async def call(self, method, *args):
+        """
+        Runs one of this backend's methods, in a thread if it does blocking I/O.
+        """
+        if not self.shared:
+            return method(*args)
+        return await asyncio.to_thread(method, *args)
+
+    # --- Tasks ---
+    def get_task(self, task_id: str):
+        task = self._load_task(task_id)
+        if not task or "follows" not in task:
+            return task
+        leader = self._load_task(task["follows"]) or {}
+        return {**task, **leader, "coalesced": True, "follows": task["follows"], "start_time": task["start_time"]}
+
+    def _resolve(self, task_id: str) -> str:
+        task = self._load_task(task_id)
+        return task.get("follows", task_id) if task else task_id
+
+    def read_events(self, task_id: str, start: int = 0) -> list:
+        return self._read_events(self._resolve(task_id), start)
+
+    async def wait_events(self, task_id: str, start: int, timeout: float) -> list:
+        """
+        Returns the task's events from index `start` on, waiting up to `timeout`
+        seconds for at least one to arrive.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = await self.call(self.read_events, task_id, start)
+            if events or time.monotonic() >= deadline:
+                return events
+            await asyncio.sleep(STATE_POLL_INTERVAL)
+
+    # --- Job queue ---
+    def start_workers(self, runner, count: int = ANALYSIS_WORKERS):
+        """
+        Starts `count` worker tasks that take jobs from the queue and await `runner(job)`.
+        """
+        return [asyncio.create_task(self._work(runner)) for _ in range(count)]
+
+    async def _work(self, runner):
+        while True:
+            try:
+                job = await self.call(self.claim_job)
+            except Exception as e:
+                print(f"Could not claim a job: {e}")
+                job = None
+            if not job:
+                await asyncio.sleep(STATE_POLL_INTERVAL)
+                continue
+            started = time.time()
+            heartbeat = asyncio.create_task(self._renew(job["task_id"]))
+            try:
+                await runner(job)
+            except Exception as e:
+                print(f"Job {job['task_id']} raised an unexpected error: {e}")
+            finally:
+                heartbeat.cancel()
+                await self.call(self.finish_job, job["task_id"], time.time() - started)
+
+    async def _renew(self, task_id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await self.call(self.renew_job, task_id)
+            except Exception as e:
+                print(f"Could not renew the claim on job {task_id}: {e}")
+
+    def _retry_after(self, depth: int, average_duration: float) -> int:
+        return max(1, math.ceil((average_duration or 30.0) * (depth + 1) / ANALYSIS_WORKERS))
+
+
+class MemoryState(StateBackend):
+    """
+    Everything in this process, as plain dicts, with jobs run by an in-process
+    JobScheduler. Only works with a single API process.
+    """
+    shared = False
+
+    def __init__(self, max_queue: int = ANALYSIS_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self._tasks = {}
+        self._events = {}
+        self._followers = {}
+        self._flights = {}
+        self._changed = {}
+        self._scheduler = JobScheduler(max_queue=max_queue)
+        self._runner = None
+
+    def create_task(self, task_id: str, fields: dict):
+        self._tasks[task_id] = dict(fields)
+
+    def update_task(self, task_id: str, fields: dict):
+        if task_id in self._tasks:
+            self._tasks[task_id].update(fields)
+
+    def _load_task(self, task_id: str):
+        task = self._tasks.get(task_id)
+        return dict(task) if task is not None else None
+
+    def link_task(self, task_id: str, leader_id: str):
+        self._tasks[task_id]["follows"] = leader_id
+        self._followers.setdefault(leader_id, []).append(task_id)
+
+    def followers(self, leader_id: str) -> list:
+        return list(self._followers.get(leader_id, []))
+
+    def delete_tasks(self, before: float) -> int:
+        expired = [task_id for task_id, task in self._tasks.items() if task["start_time"] < before]
+        for task_id in expired:
+            del self._tasks[task_id]
+            self._events.pop(task_id, None)
+            self._followers.pop(task_id, None)
+            self._changed.pop(task_id, None)
+        return len(expired)
+
+    def append_events(self, task_id: str, events: list):
+        self._events.setdefault(task_id, []).extend(events)
+        changed = self._changed.pop(task_id, None)
+        if changed:
+            changed.set()
+
+    def _read_events(self, task_id: str, start: int) -> list:
+        return self._events.get(task_id, [])[start:]
+
+    async def wait_events(self, task_id: str, start: int, timeout: float) -> list:
+        # Woken by append_events instead of polling
+        events = self.read_events(task_id, start)
+        if events:
+            return events
+        changed = self._changed.setdefault(self._resolve(task_id), asyncio.Event())
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.read_events(task_id, start)
+
+    def start_flight(self, video_key: str, task_id: str) -> str:
+        leader = self._flights.setdefault(video_key, task_id)
+        if leader != task_id:
+            self.link_task(task_id, leader)
+        return leader
+
+    def end_flight(self, video_key: str, task_id: str):
+        if self._flights.get(video_key) == task_id:
+            del self._flights[video_key]
+
+    def start_workers(self, runner, count: int = ANALYSIS_WORKERS):
+        # JobScheduler starts its workers with the first job
+        self._scheduler.workers = count
+        self._runner = runner
+        return []
+
+    def enqueue(self, job: dict):
+        runner = self._runner
+        self._scheduler.submit(
+            job["task_id"], lambda: runner(job), user_id=job.get("user_id"), priority=job.get("priority", 0)
+        )
+
+    def queue_info(self, task_id: str):
+        job = self._scheduler.job(task_id)
+        if not job:
+            return None
+        return {"position": self._scheduler.position(task_id), "wait_seconds": round(job.wait_seconds, 3)}
+
+    def queue_stats(self):
+        return self._scheduler.stats()
+
+
+class SQLiteState(StateBackend):
+    """
+    Task state and the job queue in one SQLite file, shared by every API and worker
+    process on the host that opens it. Jobs are ordered like JobScheduler's: by
+    priority, then by per-user round, then by arrival.
+    """
+    def __init__(self, path: str = STATE_PATH, max_queue: int = ANALYSIS_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        # Transactions are opened explicitly, so they can take the write lock up front
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, fields TEXT NOT NULL, start_time REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS events (
+                task_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, PRIMARY KEY (task_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS followers (leader_id TEXT NOT NULL, task_id TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS flights (video_key TEXT PRIMARY KEY, task_id TEXT NOT NULL, created REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS jobs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT UNIQUE NOT NULL, job TEXT NOT NULL,
+                priority INTEGER NOT NULL, round INTEGER NOT NULL, enqueued REAL NOT NULL, claimed REAL, lease REAL
+            );
+            CREATE TABLE IF NOT EXISTS user_rounds (user_key TEXT PRIMARY KEY, round INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL NOT NULL);
+        """)
+        # State files written before claims had a lease
+        if "lease" not in {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN lease REAL")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _counter(self, db, name: str) -> float:
+        row = db.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0.0
+
+    def _set_counter(self, db, name: str, value: float):
+        db.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, value))
+
+    def create_task(self, task_id: str, fields: dict):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, fields, start_time) VALUES (?, ?, ?)",
+                (task_id, json.dumps(fields), fields["start_time"]),
+            )
+
+    def update_task(self, task_id: str, fields: dict):
+        with self._transaction() as db:
+            row = db.execute("SELECT fields FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE tasks SET fields = ? WHERE task_id = ?", (json.dumps({**json.loads(row[0]), **fields}), task_id)
+                )
+
+    def _load_task(self, task_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT fields FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def link_task(self, task_id: str, leader_id: str):
+        with self._transaction() as db:
+            self._link(db, task_id, leader_id)
+
+    def _link(self, db, task_id: str, leader_id: str):
+        row = db.execute("SELECT fields FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row:
+            fields = {**json.loads(row[0]), "follows": leader_id}
+            db.execute("UPDATE tasks SET fields = ? WHERE task_id = ?", (json.dumps(fields), task_id))
+        db.execute("INSERT INTO followers (leader_id, task_id) VALUES (?, ?)", (leader_id, task_id))
+
+    def followers(self, leader_id: str) -> list:
+        with self._lock:
+            rows = self._db.execute("SELECT task_id FROM followers WHERE leader_id = ?", (leader_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def delete_tasks(self, before: float) -> int:
+        with self._transaction() as db:
+            expired = db.execute("DELETE FROM tasks WHERE start_time < ?", (before,)).rowcount
+            db.execute("DELETE FROM events WHERE task_id NOT IN (SELECT task_id FROM tasks)")
+            db.execute("DELETE FROM followers WHERE leader_id NOT IN (SELECT task_id FROM tasks)")
+        return expired
+
+    def append_events(self, task_id: str, events: list):
+        with self._transaction() as db:
+            start = db.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM events WHERE task_id = ?", (task_id,)).fetchone()[0]
+            db.executemany(
+                "INSERT INTO events (task_id, seq, event) VALUES (?, ?, ?)",
+                [(task_id, start + i, json.dumps(event)) for i, event in enumerate(events)],
+            )
+
+    def _read_events(self, task_id: str, start: int) -> list:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT event FROM events WHERE task_id = ? AND seq >= ? ORDER BY seq", (task_id, start)
+            ).fetchall()
+        return [tuple(json.loads(row[0])) for row in rows]
+
+    def start_flight(self, video_key: str, task_id: str) -> str:
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("DELETE FROM flights WHERE created < ?", (now - FLIGHT_TIMEOUT_SECONDS,))
+            db.execute("INSERT OR IGNORE INTO flights (video_key, task_id, created) VALUES (?, ?, ?)", (video_key, task_id, now))
+            leader = db.execute("SELECT task_id FROM flights WHERE video_key = ?", (video_key,)).fetchone()[0]
+            if leader != task_id:
+                self._link(db, task_id, leader)
+            return leader
+
+    def end_flight(self, video_key: str, task_id: str):
+        with self._transaction() as db:
+            db.execute("DELETE FROM flights WHERE video_key = ? AND task_id = ?", (video_key, task_id))
+
+    def enqueue(self, job: dict):
+        now = time.time()
+        retry_after = None
+        with self._transaction() as db:
+            depth = db.execute("SELECT COUNT(*) FROM jobs WHERE claimed IS NULL").fetchone()[0]
+            if depth >= self.max_queue:
+                # Raised after the commit, so the rejection is still counted
+                self._set_counter(db, "rejected", self._counter(db, "rejected") + 1)
+                retry_after = self._retry_after(depth, self._counter(db, "avg_duration"))
+            else:
+                user_key = job.get("user_id") or job["task_id"]
+                row = db.execute("SELECT round FROM user_rounds WHERE user_key = ?", (user_key,)).fetchone()
+                user_round = max(int(self._counter(db, "current_round")), (row[0] + 1) if row else 0)
+                db.execute("INSERT OR REPLACE INTO user_rounds (user_key, round) VALUES (?, ?)", (user_key, user_round))
+                db.execute(
+                    "INSERT INTO jobs (task_id, job, priority, round, enqueued) VALUES (?, ?, ?, ?, ?)",
+                    (job["task_id"], json.dumps(job), job.get("priority", 0), user_round, now),
+                )
+        if retry_after is not None:
+            raise QueueFull(retry_after)
+
+    def claim_job(self):
+        now = time.time()
+        with self._transaction() as db:
+            # Jobs of workers that died keep their place in the order
+            requeued = db.execute(
+                "UPDATE jobs SET claimed = NULL, lease = NULL "
+                "WHERE claimed IS NOT NULL AND COALESCE(lease, claimed + ?) < ?",
+                (JOB_LEASE_SECONDS, now),
+            ).rowcount
+            if requeued:
+                self._set_counter(db, "requeued", self._counter(db, "requeued") + requeued)
+            row = db.execute(
+                "SELECT task_id, job, round, enqueued FROM jobs WHERE claimed IS NULL ORDER BY priority, round, seq LIMIT 1"
+            ).fetchone()
+            if not row:
+                return None
+            task_id, job, user_round, enqueued = row
+            db.execute("UPDATE jobs SET claimed = ?, lease = ? WHERE task_id = ?", (now, now + JOB_LEASE_SECONDS, task_id))
+            self._set_counter(db, "current_round", max(self._counter(db, "current_round"), user_round))
+            average = self._counter(db, "avg_wait")
+            self._set_counter(db, "avg_wait", average + _AVERAGE_WEIGHT * ((now - enqueued) - average))
+        return json.loads(job)
+
+    def renew_job(self, task_id: str):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET lease = ? WHERE task_id = ? AND claimed IS NOT NULL",
+                (time.time() + JOB_LEASE_SECONDS, task_id),
+            )
+
+    def finish_job(self, task_id: str, seconds: float):
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+            self._set_counter(db, "completed", self._counter(db, "completed") + 1)
+            average = self._counter(db, "avg_duration")
+            self._set_counter(db, "avg_duration", average + _AVERAGE_WEIGHT * (seconds - average) if average else seconds)
+
+    def queue_info(self, task_id: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT priority, round, seq, enqueued, claimed FROM jobs WHERE task_id = ?", (task_id,)
+            ).fetchone()
+            if not row:
+                return None
+            priority, user_round, seq, enqueued, claimed = row
+            position = None
+            if claimed is None:
+                position = self._db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE claimed IS NULL AND (priority, round, seq) < (?, ?, ?)",
+                    (priority, user_round, seq),
+                ).fetchone()[0] + 1
+        return {"position": position, "wait_seconds": round((claimed or time.time()) - enqueued, 3)}
+
+    def queue_stats(self):
+        with self._lock:
+            depth = self._db.execute("SELECT COUNT(*) FROM jobs WHERE claimed IS NULL").fetchone()[0]
+            active = self._db.execute("SELECT COUNT(*) FROM jobs WHERE claimed IS NOT NULL").fetchone()[0]
+            counters = dict(self._db.execute("SELECT name, value FROM counters").fetchall())
+        return {
+            "depth": depth,
+            "max_depth": self.max_queue,
+            "active": active,
+            "completed": int(counters.get("completed", 0)),
+            "rejected": int(counters.get("rejected", 0)),
+            "requeued": int(counters.get("requeued", 0)),
+            "avg_wait_seconds": round(counters["avg_wait"], 3) if "avg_wait" in counters else None,
+            "avg_duration_seconds": round(counters["avg_duration"], 3) if "avg_duration" in counters else None,
+        }
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class RedisState(StateBackend):
+    """
+    Task state and the job queue in Redis, shared by API and worker processes on any host.
+
+    `client` is a redis-py style client (redis.Redis, or a stand-in with the same methods,
+    such as fakeredis for tests). Tasks, events and flights expire on their own. Queue
+    admission checks the depth before adding, so concurrent submissions can overshoot
+    the limit slightly. Each claim holds a lease key that expires unless renewed; a claim
+    whose lease is gone is queued again by whichever process notices first.
+    """
+    def __init__(self, client, prefix: str = REDIS_PREFIX, max_queue: int = ANALYSIS_QUEUE_SIZE):
+        self.redis = client
+        self.prefix = prefix
+        self.max_queue = max_queue
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(parts)
+
+    def create_task(self, task_id: str, fields: dict):
+        key = self._key("task", task_id)
+        self.redis.hset(key, mapping={name: json.dumps(value) for name, value in fields.items()})
+        self.redis.expire(key, REDIS_TASK_TTL_SECONDS)
+
+    def update_task(self, task_id: str, fields: dict):
+        key = self._key("task", task_id)
+        if self.redis.exists(key):
+            self.redis.hset(key, mapping={name: json.dumps(value) for name, value in fields.items()})
+
+    def _load_task(self, task_id: str):
+        fields = self.redis.hgetall(self._key("task", task_id))
+        return {_text(name): json.loads(value) for name, value in fields.items()} or None
+
+    def link_task(self, task_id: str, leader_id: str):
+        self.update_task(task_id, {"follows": leader_id})
+        key = self._key("followers", leader_id)
+        self.redis.rpush(key, task_id)
+        self.redis.expire(key, REDIS_TASK_TTL_SECONDS)
+
+    def followers(self, leader_id: str) -> list:
+        return [_text(task_id) for task_id in self.redis.lrange(self._key("followers", leader_id), 0, -1)]
+
+    def delete_tasks(self, before: float) -> int:
+        # Task keys expire by themselves
+        return 0
+
+    def append_events(self, task_id: str, events: list):
+        key = self._key("events", task_id)
+        self.redis.rpush(key, *(json.dumps(event) for event in events))
+        self.redis.expire(key, REDIS_TASK_TTL_SECONDS)
+
+    def _read_events(self, task_id: str, start: int) -> list:
+        return [tuple(json.loads(event)) for event in self.redis.lrange(self._key("events", task_id), start, -1)]
+
+    def start_flight(self, video_key: str, task_id: str) -> str:
+        key = self._key("flight", video_key)
+        while True:
+            if self.redis.set(key, task_id, nx=True, ex=FLIGHT_TIMEOUT_SECONDS):
+                return task_id
+            leader = _text(self.redis.get(key))
+            if not leader:
+                continue
+            followers = self._key("followers", leader)
+            self.redis.rpush(followers, task_id)
+            self.redis.expire(followers, REDIS_TASK_TTL_SECONDS)
+            # The leader ends its flight before reading its followers, so if the flight
+            # is still its own now, this task is among those it reads
+            if _text(self.redis.get(key)) == leader:
+                self.update_task(task_id, {"follows": leader})
+                return leader
+            self.redis.lrem(followers, 0, task_id)
+
+    def end_flight(self, video_key: str, task_id: str):
+        key = self._key("flight", video_key)
+        if _text(self.redis.get(key)) == task_id:
+            self.redis.delete(key)
+
+    def _stat(self, name: str) -> float:
+        value = self.redis.hget(self._key("stats"), name)
+        return float(value) if value is not None else 0.0
+
+    def enqueue(self, job: dict):
+        queue = self._key("queue")
+        depth = self.redis.zcard(queue)
+        if depth >= self.max_queue:
+            self.redis.hincrby(self._key("stats"), "rejected", 1)
+            raise QueueFull(self._retry_after(depth, self._stat("avg_duration")))
+        user_key = job.get("user_id") or job["task_id"]
+        last_round = self.redis.hget(self._key("rounds"), user_key)
+        user_round = max(int(self._stat("current_round")), int(last_round) + 1 if last_round is not None else 0)
+        self.redis.hset(self._key("rounds"), user_key, user_round)
+        seq = self.redis.incr(self._key("seq"))
+        # Equal scores sort by member, so the member spells out the run order
+        member = f"{job.get('priority', 0) + 1_000_000:07d}:{user_round:010d}:{seq:012d}:{job['task_id']}"
+        job = {**job, "enqueued_at": job.get("enqueued_at", time.time()), "member": member}
+        self.redis.hset(self._key("jobs"), job["task_id"], json.dumps(job))
+        self.redis.zadd(queue, {member: 0})
+
+    def _requeue_expired(self):
+        for task_id, claimed in self.redis.hgetall(self._key("active")).items():
+            task_id, claimed = _text(task_id), _text(claimed)
+            if self.redis.exists(self._key("lease", task_id)):
+                continue
+            # Only one process requeues a given claim; a later claim of the job has another time
+            if not self.redis.set(self._key("requeued", task_id, claimed), 1, nx=True, ex=FLIGHT_TIMEOUT_SECONDS):
+                continue
+            self.redis.hdel(self._key("active"), task_id)
+            job = self.redis.hget(self._key("jobs"), task_id)
+            if job is not None:
+                self.redis.zadd(self._key("queue"), {json.loads(job)["member"]: 0})
+                self.redis.hincrby(self._key("stats"), "requeued", 1)
+
+    def claim_job(self):
+        self._requeue_expired()
+        popped = self.redis.zpopmin(self._key("queue"), 1)
+        if not popped:
+            return None
+        member = _text(popped[0][0])
+        task_id = member.rsplit(":", 1)[1]
+        job = json.loads(self.redis.hget(self._key("jobs"), task_id))
+        now = time.time()
+        # The lease exists before the claim is visible, so no one takes the claim for expired
+        self.redis.set(self._key("lease", task_id), now, ex=math.ceil(JOB_LEASE_SECONDS))
+        self.redis.hset(self._key("active"), task_id, now)
+        user_round = int(member.split(":")[1])
+        if user_round > self._stat("current_round"):
+            self.redis.hset(self._key("stats"), "current_round", user_round)
+        average = self._stat("avg_wait")
+        self.redis.hset(self._key("stats"), "avg_wait", average + _AVERAGE_WEIGHT * ((now - job["enqueued_at"]) - average))
+        return job
+
+    def renew_job(self, task_id: str):
+        self.redis.expire(self._key("lease", task_id), math.ceil(JOB_LEASE_SECONDS))
+
+    def finish_job(self, task_id: str, seconds: float):
+        self.redis.hdel(self._key("jobs"), task_id)
+        self.redis.hdel(self._key("active"), task_id)
+        self.redis.delete(self._key("lease", task_id))
+        self.redis.hincrby(self._key("stats"), "completed", 1)
+        average = self._stat("avg_duration")
+        self.redis.hset(self._key("stats"), "avg_duration", average + _AVERAGE_WEIGHT * (seconds - average) if average else seconds)
+
+    def queue_info(self, task_id: str):
+        job = self.redis.hget(self._key("jobs"), task_id)
+        if job is None:
+            return None
+        job = json.loads(job)
+        claimed = self.redis.hget(self._key("active"), task_id)
+        if claimed is not None:
+            return {"position": None, "wait_seconds": round(float(claimed) - job["enqueued_at"], 3)}
+        rank = self.redis.zrank(self._key("queue"), job["member"])
+        return {"position": rank + 1 if rank is not None else None, "wait_seconds": round(time.time() - job["enqueued_at"], 3)}
+
+    def queue_stats(self):
+        stats = {_text(name): float(value) for name, value in self.redis.hgetall(self._key("stats")).items()}
+        return {
+            "depth": self.redis.zcard(self._key("queue")),
+            "max_depth": self.max_queue,
+            "active": self.redis.hlen(self._key("active")),
+            "completed": int(stats.get("completed", 0)),
+            "rejected": int(stats.get("rejected", 0)),
+            "requeued": int(stats.get("requeued", 0)),
+            "avg_wait_seconds": round(stats["avg_wait"], 3) if "avg_wait" in stats else None,
+            "avg_duration_seconds": round(stats["avg_duration"], 3) if "avg_duration" in stats else None,
+        }
+
+
+def create_state(backend: str = STATE_BACKEND, redis_client=None) -> StateBackend:
+    """
+    Builds the backend named by STATE_BACKEND. A Redis client can be passed in;
+    otherwise one is created from REDIS_URL (which needs the `redis` package).
+    """
+    if backend == "sqlite":
+        return SQLiteState()
+    if backend == "redis":
+        if redis_client is None:
+            import redis
+            redis_client = redis.Redis.from_url(REDIS_URL)
+        return RedisState(redis_client)
+    if backend != "memory":
+        print(f"Unknown STATE_BACKEND '{backend}', keeping state in memory.")
+    return MemoryState()
@@ -0,0 +1,29 @@
+import pytest
+
+from download_video import canonical_video_key, is_video_key
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=aaaaaaaaaaa",
+    "https://youtu.be/aaaaaaaaaaa?si=tracking",
+    "https://www.youtube.com/watch?v=aaaaaaaaaaa&list=PLxyz",
+    "https://www.youtube.com/watch?v=aaaaaaaaaaa&list=RDaaaaaaaaaaa&index=2",
+    "https://youtu.be/aaaaaaaaaaa?list=PLxyz",
+])
+def test_watch_url_is_keyed_on_its_video(url):
+    assert canonical_video_key(url) == "Youtube:aaaaaaaaaaa"
+
+def test_videos_of_one_playlist_get_their_own_keys():
+    first = canonical_video_key("https://www.youtube.com/watch?v=aaaaaaaaaaa&list=PLxyz")
+    second = canonical_video_key("https://www.youtube.com/watch?v=bbbbbbbbbbb&list=PLxyz")
+    assert first != second
+    assert is_video_key(first) and is_video_key(second)
+
+def test_playlist_url_is_not_a_video_key():
+    key = canonical_video_key("https://www.youtube.com/playlist?list=PLxyz")
+    assert not is_video_key(key)
+
+def test_unknown_site_drops_tracking_parameters():
+    key = canonical_video_key("https://example.com/clip.mp4?utm_source=feed")
+    assert key == canonical_video_key("https://example.com/clip.mp4")
+    assert not is_video_key(key)
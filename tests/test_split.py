@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from split import FENCE, iter_chunks, message_length, splitmsg
+
+WORDS = ["hello", "world", "中文字", "😀", "👨‍👩‍👧", "🇹🇼🇯🇵", "é", "x" * 30, " ", "\t", "`", "``", "a```b"]
+
+
+def _line(rng: random.Random, max_length: int) -> str:
+    kind = rng.random()
+    if kind < 0.15:
+        return rng.choice([
+            FENCE, "```py", "  ```", FENCE + "i" * rng.randint(90, 130), "```py " + "x" * rng.randint(1, 3 * max_length),
+        ])
+    if kind < 0.25:
+        return ""
+    if kind < 0.4:
+        # One line longer than a message, with or without places to break it
+        return rng.choice(["x", "中", "😀", "ab "]) * rng.randint(max_length // 2, 3 * max_length)
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, max_length // 3 + 2)))
+
+def _fences(chunk: str) -> int:
+    return sum(1 for line in chunk.split("\n") if line.strip().startswith(FENCE))
+
+def _assert_valid(chunks: list, max_length: int):
+    for chunk in chunks:
+        assert message_length(chunk) <= max_length, chunk
+        assert _fences(chunk) % 2 == 0, chunk
+        assert chunk.strip()
+
+
+@pytest.mark.parametrize("max_length", [50, 120, 300, 2000])
+def test_random_text_fits_and_keeps_fences_balanced(max_length):
+    rng = random.Random(max_length)
+    for _ in range(200):
+        text = "\n".join(_line(rng, max_length) for _ in range(rng.randint(1, 40)))
+        _assert_valid(splitmsg(text, max_length), max_length)
+        # Streamed in small pieces, as the model's output arrives
+        step = rng.randint(1, 40)
+        pieces = [text[i:i + step] for i in range(0, len(text), step)]
+        _assert_valid(list(iter_chunks(pieces, max_length)), max_length)
+
+def test_code_block_is_reopened_in_the_next_chunk():
+    text = "```py\n" + "\n".join(f"print({i})" for i in range(100)) + "\n```"
+    chunks = splitmsg(text, 120)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.startswith("```py\n")
+        assert chunk.endswith("\n```")
+    assert "".join(chunks).count("print(") == 100
+
+def test_long_fence_opener_does_not_overflow():
+    chunks = splitmsg("```py " + "x" * 900 + "\n" + "y" * 1801)
+    _assert_valid(chunks, 2000)
+    assert chunks[0].startswith("```py " + "x" * 900)
+
+def test_wrapped_line_never_starts_a_fence():
+    # The last space that fits is right before the backticks
+    chunks = splitmsg("a" * 44 + " ```js" + " b" * 30, 50)
+    _assert_valid(chunks, 50)
+    assert not chunks[1].startswith(FENCE)
+
+@pytest.mark.parametrize("max_length", [10, 11, 50])
+def test_flags_and_emoji_are_not_split(max_length):
+    for text in ["🇹🇼" * 40, "😀" * 40, "👨‍👩‍👧" * 20]:
+        chunks = splitmsg(text, max_length)
+        _assert_valid(chunks, max_length)
+        assert "".join(chunks) == text
+        if text.startswith("🇹🇼"):
+            assert all(len(chunk) % 2 == 0 for chunk in chunks)
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+import state
+from state import RedisState, SQLiteState
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def open_backend(request, tmp_path, monkeypatch):
+    """
+    Returns a function that opens one more handle on the same shared backend, as
+    another API or worker process would.
+    """
+    monkeypatch.setattr(state, "STATE_POLL_INTERVAL", 0.01)
+    if request.param == "sqlite":
+        path = str(tmp_path / "state.sqlite3")
+        return lambda: SQLiteState(path)
+    server = fakeredis.FakeServer()
+    return lambda: RedisState(fakeredis.FakeRedis(server=server))
+
+def _job(task_id: str, user_id: str = None) -> dict:
+    return {"task_id": task_id, "video_url": f"https://example.com/{task_id}", "video_key": task_id, "user_id": user_id}
+
+async def _run_until(backends, runners, done, timeout: float = 10):
+    workers = [task for backend, runner in zip(backends, runners) for task in backend.start_workers(runner, 1)]
+    deadline = time.monotonic() + timeout
+    try:
+        while not done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+def test_two_workers_run_each_job_once(open_backend):
+    backends = [open_backend(), open_backend()]
+    task_ids = [f"task-{i}" for i in range(8)]
+    for i, task_id in enumerate(task_ids):
+        backends[0].enqueue(_job(task_id, user_id=f"user-{i % 3}"))
+    ran = []
+
+    def runner(name):
+        async def run(job):
+            ran.append((name, job["task_id"]))
+            await asyncio.sleep(0.05)
+        return run
+
+    asyncio.run(_run_until(backends, [runner("a"), runner("b")], lambda: len(ran) == len(task_ids)))
+
+    assert sorted(task_id for _, task_id in ran) == sorted(task_ids)
+    assert {name for name, _ in ran} == {"a", "b"}
+    stats = backends[1].queue_stats()
+    assert stats["depth"] == 0
+    assert stats["active"] == 0
+    assert stats["completed"] == len(task_ids)
+
+def test_job_of_a_dead_worker_is_requeued(open_backend, monkeypatch):
+    monkeypatch.setattr(state, "JOB_LEASE_SECONDS", 1)
+    dead, alive = open_backend(), open_backend()
+    dead.enqueue(_job("task-1"))
+    # Claimed by a worker that then stops without finishing or renewing it
+    assert dead.claim_job()["task_id"] == "task-1"
+    assert alive.claim_job() is None
+    ran = []
+
+    async def run(job):
+        ran.append(job["task_id"])
+
+    asyncio.run(_run_until([alive], [run], lambda: ran))
+
+    assert ran == ["task-1"]
+    stats = alive.queue_stats()
+    assert stats["requeued"] == 1
+    assert stats["active"] == 0
+    assert stats["completed"] == 1
+
+def test_running_job_keeps_its_claim(open_backend, monkeypatch):
+    monkeypatch.setattr(state, "JOB_LEASE_SECONDS", 1)
+    backends = [open_backend(), open_backend()]
+    backends[0].enqueue(_job("task-1"))
+    ran = []
+
+    async def run(job):
+        ran.append(job["task_id"])
+        # Longer than the lease: the worker's renewals must keep the job from being run twice
+        await asyncio.sleep(2.5)
+
+    asyncio.run(_run_until(backends, [run, run], lambda: backends[0].queue_stats()["completed"] == 1))
+
+    assert ran == ["task-1"]
+    assert backends[0].queue_stats()["requeued"] == 0
+
+def test_flight_takes_no_followers_once_ended(open_backend):
+    first, second = open_backend(), open_backend()
+    for task_id in ("leader", "early", "late"):
+        first.create_task(task_id, {"status": "pending", "start_time": time.time()})
+    assert first.start_flight("Youtube:aaaaaaaaaaa", "leader") == "leader"
+    assert second.start_flight("Youtube:aaaaaaaaaaa", "early") == "leader"
+    # A finishing leader ends its flight, then opens sessions for the followers it reads
+    first.end_flight("Youtube:aaaaaaaaaaa", "leader")
+    assert second.start_flight("Youtube:aaaaaaaaaaa", "late") == "late"
+
+    assert first.followers("leader") == ["early"]
+    assert second.get_task("early")["follows"] == "leader"
+    assert "follows" not in second.get_task("late")
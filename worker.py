@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sys
+
+import metrics
+from api import run_job, sessions, state
+from extraction_service import extraction_service
+from llm_client import close_clients
+from media_store import media_store
+from scheduler import ANALYSIS_WORKERS
+
+# Port for this worker's GET /metrics; 0 turns it off
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+
+async def main():
+    """
+    Runs analysis jobs from the shared queue without serving HTTP, so analysis can be
+    spread over more processes (or hosts, with Redis) than the API itself.
+    """
+    if not state.shared:
+        print("worker.py needs a shared state backend: set STATE_BACKEND to sqlite or redis.", file=sys.stderr)
+        sys.exit(1)
+    metrics.install_thread_pool()
+    if WORKER_METRICS_PORT:
+        await metrics.serve(WORKER_METRICS_PORT)
+    extraction_service.start()
+    media_store.open()
+    print(f"Analysis worker running {ANALYSIS_WORKERS} jobs at a time ({type(state).__name__}).")
+    try:
+        await asyncio.gather(*state.start_workers(run_job, ANALYSIS_WORKERS))
+    finally:
+        extraction_service.shutdown()
+        await close_clients()
+        sessions.close()
+        media_store.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass